@@ -1,56 +1,247 @@
-import pandas as pd
-from influxdb_client import InfluxDBClient, Point, WritePrecision
+import sys, time
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+from influxdb_client import InfluxDBClient, WritePrecision
 from influxdb_client.client.write_api import SYNCHRONOUS
-from datetime import datetime
+from influxdb_client.rest import ApiException
+from loguru import logger
 
-class InfluxClient:
-    def __init__(self, influx_db_address, token, bucket, org, point_name, fields = None, time_key = "send.timestamp"):
+from edaf.core.uplink.schema import UL_SCHEMA
+
+import os
+if not os.getenv('DEBUG'):
+    logger.remove()
+    logger.add(sys.stdout, level="INFO")
+
+# points are written in batches of up to INFLUX_BATCH_LINES lines, or once the oldest
+# waited INFLUX_FLUSH_SEC, optionally gzip compressed, see InfluxWriter
+INFLUX_BATCH_LINES = int(os.getenv('INFLUX_BATCH_LINES', 5000))
+INFLUX_FLUSH_SEC = float(os.getenv('INFLUX_FLUSH_SEC', 1.0))
+INFLUX_GZIP = os.getenv('INFLUX_GZIP', '').lower() in ['true', '1', 'yes']
+# failed writes are retried after INFLUX_RETRY_SEC, doubling up to INFLUX_RETRY_MAX_SEC.
+# Meanwhile the points go to a spill file of up to INFLUX_SPILL_BYTES, see Spill
+INFLUX_RETRY_SEC = float(os.getenv('INFLUX_RETRY_SEC', 0.5))
+INFLUX_RETRY_MAX_SEC = float(os.getenv('INFLUX_RETRY_MAX_SEC', 30))
+INFLUX_SPILL_FILE = os.getenv('INFLUX_SPILL_FILE', '/EDAF/influx_spill.lp')
+INFLUX_SPILL_BYTES = int(os.getenv('INFLUX_SPILL_BYTES', 1 << 30))
+
+ESCAPE_MEASUREMENT = str.maketrans({ ',': r'\,', ' ': r'\ ' })
+ESCAPE_KEY = str.maketrans({ ',': r'\,', '=': r'\=', ' ': r'\ ' })
+
+def field_text(name, column, schema):
+    # line protocol values of a column, null where the field is left out
+    values = pa.array(column, from_pandas=True)
+    if pa.types.is_boolean(values.type):
+        return pc.if_else(values, 'true', 'false')
+    if pa.types.is_integer(values.type) or pa.types.is_floating(values.type):
+        if pa.types.is_floating(values.type):
+            values = pc.if_else(pc.is_finite(values), values, pa.scalar(None, values.type))
+        if name in schema.integers or pa.types.is_integer(values.type):
+            return pc.binary_join_element_wise(pc.cast(values, pa.int64(), safe=False).cast(pa.string()), 'i', '')
+        # whole numbers come out without a trailing .0, like the influx client writes them
+        return pc.cast(values, pa.string())
+    values = pc.replace_substring(pc.cast(values, pa.string()), '\\', '\\\\')
+    return pc.binary_join_element_wise('"', pc.replace_substring(values, '"', '\\"'), '"', '')
+
+def line_protocol(df, measurement, time_key, fields=None, schema=UL_SCHEMA):
+    # One line per packet with all its fields, built a column at a time with arrow
+    # kernels. Missing and non-finite values are left out, packets without fields or
+    # time are skipped.
+    names = [name for name in (fields or df.columns) if name in df.columns]
+    pieces = []
+    for name in names:
+        values = field_text(name, df[name], schema)
+        if values.null_count < len(values):
+            pieces.append(pc.binary_join_element_wise(name.translate(ESCAPE_KEY) + '=', values, ''))
+    if len(pieces) == 0:
+        return []
+    text = pc.binary_join_element_wise(*pieces, ',', null_handling='skip')
+    times = df[time_key].to_numpy(dtype=float, na_value=np.nan)
+    keep = pa.array((pc.utf8_length(text).to_numpy() > 0) & np.isfinite(times))
+    stamps = pa.array(np.round(np.nan_to_num(times) * 1e9).astype(np.int64)).cast(pa.string())
+    lines = pc.binary_join_element_wise(measurement.translate(ESCAPE_MEASUREMENT), text, stamps, ' ')
+    return lines.filter(keep).to_pylist()
+
+class Spill:
+    # Line protocol that could not be written, appended to a local file and read back
+    # from an offset. The file is emptied once all of it was read back. A spill left
+    # from an earlier run is read back from the start, points written twice are
+    # overwritten with the same values by influxdb.
+    def __init__(self, path, max_bytes):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.offset = 0
+        self.size = os.path.getsize(path) if os.path.exists(path) else 0
+
+    def __len__(self):
+        # bytes not read back yet
+        return self.size - self.offset
+
+    def append(self, lines):
+        data = ('\n'.join(lines) + '\n').encode()
+        if self.size + len(data) > self.max_bytes:
+            return False
+        with open(self.path, 'ab') as f:
+            f.write(data)
+        self.size = self.size + len(data)
+        return True
+
+    def read(self, max_lines):
+        # up to max_lines lines from the offset, and the offset after them
+        lines = []
+        with open(self.path, 'rb') as f:
+            f.seek(self.offset)
+            while len(lines) < max_lines:
+                line = f.readline()
+                if not line:
+                    break
+                lines.append(line.decode().rstrip('\n'))
+            return lines, f.tell()
+
+    def advance(self, offset):
+        self.offset = offset
+        if self.offset >= self.size:
+            os.truncate(self.path, 0)
+            self.offset = 0
+            self.size = 0
+
+class InfluxWriter:
+    # Writes dataframes to influxdb as one point per packet, fields picks the columns
+    # (all by default). The lines are sent in large batches over the client's kept
+    # alive connection, once INFLUX_BATCH_LINES are pending or the oldest waited
+    # INFLUX_FLUSH_SEC, see add, remaining and poll. A batch that fails goes to the
+    # spill, which is written back once the database is reachable again, retried
+    # with exponential backoff. Later batches queue behind the spill, to keep order.
+    # Batches the database rejects (4xx) are not retried.
+    def __init__(self, influx_db_address, token, bucket, org, point_name, fields = None, time_key = "send.timestamp",
+                 batch_lines = INFLUX_BATCH_LINES, flush_sec = INFLUX_FLUSH_SEC, gzip = INFLUX_GZIP,
+                 spill_file = INFLUX_SPILL_FILE, spill_bytes = INFLUX_SPILL_BYTES):
         self.point_name = point_name
         self.bucket = bucket
         self.org = org
         self.time_key = time_key
         self.fields = fields
-        self.influx_db_address = influx_db_address
-        self.token = token
-        self.client = InfluxDBClient(url=influx_db_address, token=token)
+        self.batch_lines = batch_lines
+        self.flush_sec = flush_sec
+        self.client = InfluxDBClient(url=influx_db_address, token=token, org=org, enable_gzip=gzip)
         self.write_api = self.client.write_api(write_options=SYNCHRONOUS)
+        self.spill = Spill(spill_file, spill_bytes)
+        self.batch = []
+        self.since = None
+        # seconds to wait before the next attempt after a failure, and when it is due
+        self.backoff = 0.0
+        self.retry_at = None
+        self.written = 0
+        self.rejected = 0
+        self.spilled = 0
+        self.replayed = 0
+        self.dropped = 0
+        self.failures = 0
+        # throughput and flush latency since the last metrics
+        self.window_start = time.monotonic()
+        self.window_written = 0
+        self.window_latency = []
+        if len(self.spill) > 0:
+            logger.info(f"[influx writer] {len(self.spill)} bytes left in the spill {spill_file}")
 
-    def push_dataframe(self, df):
-        for index, row in df.iterrows():
-            point = Point(self.point_name)
-            if self.fields:
-                for f in fields:
-                    point.field(f, row[f])
-            else:
-                for f in df.keys():
-                    point.field(f, row[f])
+    def add(self, df):
+        lines = line_protocol(df, self.point_name, self.time_key, self.fields)
+        if len(lines) == 0:
+            return
+        if self.since is None:
+            self.since = time.monotonic()
+        self.batch.extend(lines)
+        if len(self.batch) >= self.batch_lines:
+            self.flush()
 
-            point.time(datetime.fromtimestamp(row[self.time_key]), WritePrecision.NS)
-            #point.time(datetime.utcnow(), WritePrecision.NS)
+    def remaining(self):
+        # seconds until the pending batch or the next retry is due, None if there is none
+        timeouts = []
+        if self.since is not None:
+            timeouts.append(max(0.0, self.since + self.flush_sec - time.monotonic()))
+        if len(self.spill) > 0:
+            timeouts.append(0.0 if self.retry_at is None else max(0.0, self.retry_at - time.monotonic()))
+        return min(timeouts) if timeouts else None
 
-            #point = Point("e2e_delay").field("value", row['e2e_delay']).time(datetime.utcnow(), WritePrecision.NS)
-            self.write_api.write(self.bucket, self.org, point)
+    def poll(self):
+        if self.since is not None and time.monotonic() - self.since >= self.flush_sec:
+            self.flush()
+        if len(self.spill) > 0 and not self.waiting():
+            self.replay()
 
-    def __del__(self):
-        self.client.close()
+    def waiting(self):
+        # backing off after a failure
+        return self.retry_at is not None and time.monotonic() < self.retry_at
 
-class InfluxClientFULL:
-    def __init__(self, influx_db_address, token, bucket, org, point_name, fields, time_key = "send.timestamp"):
-        self.bucket = bucket
-        self.org = org
-        self.time_key = time_key
-        self.fields = fields
-        self.influx_db_address = influx_db_address
-        self.token = token
-        self.client = InfluxDBClient(url=influx_db_address, token=token)
-        self.write_api = self.client.write_api(write_options=SYNCHRONOUS)
+    def flush(self):
+        lines, since = self.batch, self.since
+        self.batch = []
+        self.since = None
+        if len(lines) == 0:
+            return
+        if len(self.spill) > 0 or self.waiting() or not self.write(lines, since):
+            self.to_spill(lines)
+
+    def replay(self):
+        while len(self.spill) > 0:
+            lines, offset = self.spill.read(self.batch_lines)
+            if not self.write(lines):
+                return
+            self.spill.advance(offset)
+            self.replayed = self.replayed + len(lines)
+            if len(self.spill) == 0:
+                logger.info("[influx writer] spill written back")
+
+    def to_spill(self, lines):
+        if self.spill.append(lines):
+            self.spilled = self.spilled + len(lines)
+        else:
+            self.dropped = self.dropped + len(lines)
+
+    def write(self, lines, since=None):
+        # True once the lines are done with, written or rejected
+        try:
+            self.write_api.write(self.bucket, self.org, '\n'.join(lines), write_precision=WritePrecision.NS)
+        except ApiException as ex:
+            if ex.status is not None and 400 <= ex.status < 500 and ex.status != 429:
+                logger.error(f"[influx writer] {len(lines)} points rejected: {ex.status} {ex.reason}")
+                self.rejected = self.rejected + len(lines)
+                return True
+            return self.failed(f"{ex.status} {ex.reason}")
+        except Exception as ex:
+            return self.failed(ex)
+        self.backoff = 0.0
+        self.retry_at = None
+        self.written = self.written + len(lines)
+        self.window_written = self.window_written + len(lines)
+        if since is not None:
+            self.window_latency.append(time.monotonic() - since)
+        return True
+
+    def failed(self, ex):
+        self.failures = self.failures + 1
+        self.backoff = min(INFLUX_RETRY_MAX_SEC, self.backoff * 2 if self.backoff > 0 else INFLUX_RETRY_SEC)
+        self.retry_at = time.monotonic() + self.backoff
+        logger.warning(f"[influx writer] write failed, retrying in {self.backoff:.1f}s: {ex}")
+        return False
 
-    def push_dataframe(self, df):
-        for index, row in df.iterrows():
-            for col in df.columns:
-                if col in self.fields:
-                    point = Point(col).field("value", row[col]).time(int(float(row[self.time_key]) * 1e9), WritePrecision.NS)
-                    self.write_api.write(self.bucket, self.org, point)
+    def metrics(self):
+        # counters, and the throughput and flush latency since the last call
+        now = time.monotonic()
+        latency = self.window_latency
+        metrics = {
+            'written': self.written, 'rejected': self.rejected, 'spilled': self.spilled, 'replayed': self.replayed,
+            'dropped': self.dropped, 'failures': self.failures, 'pending': len(self.batch), 'spill_bytes': len(self.spill),
+            'points_per_sec': round(self.window_written / max(now - self.window_start, 1e-9), 1),
+            'flush_latency_mean_sec': round(sum(latency) / len(latency), 3) if latency else None,
+            'flush_latency_max_sec': round(max(latency), 3) if latency else None,
+        }
+        self.window_start = now
+        self.window_written = 0
+        self.window_latency = []
+        return metrics
 
-    def __del__(self):
+    def close(self):
+        self.flush()
         self.client.close()
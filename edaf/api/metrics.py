@@ -0,0 +1,145 @@
+import sys, math, bisect, itertools, threading, multiprocessing
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from loguru import logger
+
+import os
+if not os.getenv('DEBUG'):
+    logger.remove()
+    logger.add(sys.stdout, level="INFO")
+
+# the metrics are served at http://METRICS_HOST:METRICS_PORT/metrics, not at all if the port is 0
+METRICS_HOST = os.getenv('METRICS_HOST', '0.0.0.0')
+METRICS_PORT = int(os.getenv('METRICS_PORT', 50030))
+
+# histogram buckets, in items and in seconds
+SIZE_BUCKETS = [1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000]
+SECONDS_BUCKETS = [0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5]
+
+class Registry:
+    # Counters, gauges and histograms shared by the server processes, in prometheus
+    # text format from render. All series, every combination of the label values, are
+    # declared up front and get their slots in one shared array, allocate it once all
+    # are declared. Children started by fork share it as it is, others attach the
+    # parent's. A series is only written by one process, so there are no locks.
+    def __init__(self):
+        self.families = []
+        self.size = 0
+        self.values = None
+
+    def counter(self, name, help, **labels):
+        return self.declare(Family(self, 'counter', name, help, labels))
+
+    def gauge(self, name, help, **labels):
+        return self.declare(Family(self, 'gauge', name, help, labels))
+
+    def histogram(self, name, help, buckets, **labels):
+        return self.declare(Family(self, 'histogram', name, help, labels, buckets))
+
+    def declare(self, family):
+        self.families.append(family)
+        self.size = self.size + family.size
+        return family
+
+    def allocate(self):
+        self.values = multiprocessing.RawArray('d', self.size)
+
+    def attach(self, values):
+        self.values = values
+
+    def render(self):
+        lines = []
+        for family in self.families:
+            lines.extend(family.render())
+        return '\n'.join(lines) + '\n'
+
+class Family:
+    # a metric and its series, one per combination of the label values
+    def __init__(self, registry, kind, name, help, labels, buckets=None):
+        self.registry = registry
+        self.kind = kind
+        self.name = name
+        self.help = help
+        self.label_names = list(labels)
+        self.buckets = buckets
+        # a histogram series holds its bucket counts, the last for +Inf, then the sum and count
+        self.width = len(buckets) + 3 if buckets is not None else 1
+        self.offset = registry.size
+        self.index = { values : self.offset + i * self.width for i, values in enumerate(itertools.product(*labels.values())) }
+        self.size = len(self.index) * self.width
+
+    def labels(self, **values):
+        return Series(self, self.index[tuple(values[name] for name in self.label_names)])
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} {self.kind}']
+        values = self.registry.values
+        for label_values, at in self.index.items():
+            labels = [f'{name}="{value}"' for name, value in zip(self.label_names, label_values)]
+            if self.buckets is None:
+                lines.append(f'{self.name}{braces(labels)} {number(values[at])}')
+                continue
+            total = 0.0
+            for i, bound in enumerate([*self.buckets, '+Inf']):
+                total = total + values[at + i]
+                le = 'le="%s"' % bound
+                lines.append(f'{self.name}_bucket{braces(labels + [le])} {number(total)}')
+            lines.append(f'{self.name}_sum{braces(labels)} {number(values[at + len(self.buckets) + 1])}')
+            lines.append(f'{self.name}_count{braces(labels)} {number(values[at + len(self.buckets) + 2])}')
+        return lines
+
+class Series:
+    def __init__(self, family, at):
+        self.family = family
+        self.at = at
+
+    def inc(self, amount=1):
+        self.family.registry.values[self.at] += amount
+
+    def set(self, value):
+        self.family.registry.values[self.at] = value
+
+    def get(self):
+        return self.family.registry.values[self.at]
+
+    def observe(self, value):
+        values = self.family.registry.values
+        buckets = self.family.buckets
+        values[self.at + bisect.bisect_left(buckets, value)] += 1
+        values[self.at + len(buckets) + 1] += value
+        values[self.at + len(buckets) + 2] += 1
+
+class SenderMetrics:
+    # the series a BatchSender counts into
+    def __init__(self, published, dropped, batch_size, stalled_sec):
+        self.published = published
+        self.dropped = dropped
+        self.batch_size = batch_size
+        self.stalled_sec = stalled_sec
+
+def braces(labels):
+    return '{' + ','.join(labels) + '}' if labels else ''
+
+def number(value):
+    return str(int(value)) if math.isfinite(value) and value == int(value) else repr(value)
+
+def serve_metrics(registry, host=METRICS_HOST, port=METRICS_PORT):
+    # serves the registry on /metrics from a thread
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split('?')[0] != '/metrics':
+                self.send_error(404)
+                return
+            body = registry.render().encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    logger.info(f'[metrics] serving on http://{host}:{port}/metrics')
+    return server
@@ -0,0 +1,136 @@
+import sys, time
+from datetime import datetime, timezone
+import pandas as pd
+import pyarrow.parquet as pq
+from loguru import logger
+
+from edaf.core.uplink.schema import UL_SCHEMA
+
+import os
+if not os.getenv('DEBUG'):
+    logger.remove()
+    logger.add(sys.stdout, level="INFO")
+
+# directory of the parquet sink, no sink if unset. PARQUET_COLUMNS, comma separated,
+# picks the columns written, all by default
+PARQUET_DIR = os.getenv('PARQUET_DIR')
+PARQUET_COLUMNS = [name for name in os.getenv('PARQUET_COLUMNS', '').split(',') if name] or None
+# rows per row group, and when a file is closed and the next one started
+PARQUET_ROW_GROUP_ROWS = int(os.getenv('PARQUET_ROW_GROUP_ROWS', 10000))
+PARQUET_FILE_BYTES = int(os.getenv('PARQUET_FILE_BYTES', 256 << 20))
+PARQUET_ROTATE_SEC = float(os.getenv('PARQUET_ROTATE_SEC', 600))
+
+class ParquetSink:
+    # Appends dataframes to parquet files under directory, partitioned by the hour they
+    # were written in (date=YYYY-MM-DD/hour=HH, readable as a dataset with
+    # pd.read_parquet(directory)). Rows are written in row groups of row_group_rows,
+    # the schema columns with their declared types, see JourneySchema.table. A file is
+    # closed once it holds file_bytes, is rotate_sec old, the hour changes or the
+    # columns do. Until closed it is hidden behind a leading dot, it is not readable yet.
+    def __init__(self, directory, columns = None, row_group_rows = PARQUET_ROW_GROUP_ROWS,
+                 file_bytes = PARQUET_FILE_BYTES, rotate_sec = PARQUET_ROTATE_SEC):
+        self.directory = directory
+        self.columns = columns
+        self.row_group_rows = row_group_rows
+        self.file_bytes = file_bytes
+        self.rotate_sec = rotate_sec
+        self.frames = []
+        self.rows = 0
+        # when the first pending rows came
+        self.since = None
+        self.writer = None
+        self.path = None
+        self.partition = None
+        self.opened = None
+        self.written = 0
+        self.files = 0
+        self.row_groups = 0
+
+    def add(self, df):
+        if self.columns is not None:
+            df = df[[name for name in self.columns if name in df.columns]]
+        if len(df) == 0:
+            return
+        if self.since is None:
+            self.since = time.monotonic()
+        self.frames.append(df)
+        self.rows = self.rows + len(df)
+        if self.rows >= self.row_group_rows:
+            self.flush()
+
+    def started(self):
+        # since when the rows of the open or next file came, None if there are none
+        return self.opened if self.opened is not None else self.since
+
+    def remaining(self):
+        # seconds until the file is due to close, None if there are no rows
+        started = self.started()
+        if started is None:
+            return None
+        return max(0.0, started + self.rotate_sec - time.monotonic())
+
+    def poll(self):
+        started = self.started()
+        if started is None:
+            return
+        if time.monotonic() - started >= self.rotate_sec or (self.writer is not None and partition_of(time.time()) != self.partition):
+            self.flush()
+            self.rotate()
+
+    def flush(self):
+        # writes the pending rows as a row group
+        if self.rows == 0:
+            return
+        table = UL_SCHEMA.table(pd.concat(self.frames, ignore_index=True))
+        self.frames = []
+        self.rows = 0
+        self.since = None
+        if self.writer is not None and partition_of(time.time()) != self.partition:
+            self.rotate()
+        if self.writer is not None and not table.schema.equals(self.writer.schema):
+            if table.schema.names == self.writer.schema.names:
+                # e.g. a string column that is all null in this batch
+                table = table.cast(self.writer.schema)
+            else:
+                self.rotate()
+        if self.writer is None:
+            self.open(table.schema)
+        self.writer.write_table(table, row_group_size=len(table))
+        self.written = self.written + len(table)
+        self.row_groups = self.row_groups + 1
+        if os.path.getsize(self.path) >= self.file_bytes:
+            self.rotate()
+
+    def open(self, schema):
+        now = time.time()
+        self.partition = partition_of(now)
+        folder = os.path.join(self.directory, self.partition)
+        os.makedirs(folder, exist_ok=True)
+        name = datetime.fromtimestamp(now, timezone.utc).strftime('packets-%Y%m%d-%H%M%S-%f')
+        self.path = os.path.join(folder, f'.{name}.parquet')
+        self.writer = pq.ParquetWriter(self.path, schema)
+        self.opened = time.monotonic()
+
+    def rotate(self):
+        # closes the open file
+        if self.writer is None:
+            return
+        self.writer.close()
+        folder, name = os.path.split(self.path)
+        os.rename(self.path, os.path.join(folder, name[1:]))
+        logger.info(f"[parquet sink] closed {os.path.join(folder, name[1:])}")
+        self.writer = None
+        self.path = None
+        self.opened = None
+        self.files = self.files + 1
+
+    def metrics(self):
+        return { 'written': self.written, 'pending': self.rows, 'row_groups': self.row_groups, 'files': self.files,
+                 'file_bytes': os.path.getsize(self.path) if self.path else 0 }
+
+    def close(self):
+        self.flush()
+        self.rotate()
+
+def partition_of(timestamp):
+    return datetime.fromtimestamp(timestamp, timezone.utc).strftime('date=%Y-%m-%d/hour=%H')
@@ -1,16 +1,24 @@
-import threading, traceback, time, os, json, asyncio, multiprocessing, queue
+import threading, traceback, time, os, sys, json, asyncio, multiprocessing, queue, signal
 from collections import deque
 from loguru import logger
 from multiprocessing import Process, Queue
 
 from edaf.core.common.timestamp import rdtsctotsOnline
+from edaf.core.common.reorder import ReorderBuffer, DEFAULT_REORDER_SLACK_NS
 from edaf.core.uplink.gnb import ProcessULGNB
-from edaf.core.uplink.ue import ProcessULUE
+from edaf.core.uplink.ue import LookaheadULUE, MAX_DEPTH as UE_MAX_DEPTH
 from edaf.core.uplink.nlmt import process_ul_nlmt
 from edaf.core.uplink.combine import CombineUL
-from edaf.core.uplink.decompose import process_ul_journeys
-from edaf.api.influx import InfluxClient, InfluxClientFULL
-
+from edaf.core.uplink.decompose import process_ul_journeys, new_drops, DROP_REASONS
+from edaf.api.influx import InfluxWriter
+from edaf.api.parquet import ParquetSink, PARQUET_DIR, PARQUET_COLUMNS
+from edaf.api.stream import StreamHub, STREAM_HOST, STREAM_PORT, STREAM_SOCKET
+from edaf.api.metrics import Registry, SenderMetrics, serve_metrics, SIZE_BUCKETS, SECONDS_BUCKETS, METRICS_HOST, METRICS_PORT
+from edaf.api.transport import BatchSender, FlushPolicy, RuntimeConfig, lines_queue, journeys_queue, close_queue, get_batch, get_batches, time_left, earliest, BATCH_LINES, BATCH_JOURNEYS, BATCH_LINGER_SEC, SHM_TRANSPORT, BACKPRESSURE, STALL_WAIT_SEC
+from edaf.core.uplink.schema import GNB_SCHEMA, UE_SCHEMA
+
+# the queues hold lines and journeys in batches, see BatchSender. With SHM_TRANSPORT
+# the raw lines and the gnb and ue journeys go through shared memory rings instead, see ShmRing
 MAX_L1_UPF_DEPTH = 5000 # lines
 MAX_L2_UPF_DEPTH = 500 # journeys
 JOURNEYS_THRESHOLD_UPF = 20
@@ -25,8 +33,27 @@ MAX_L2_UE_DEPTH = 500 # journeys
 RAW_LINES_THRESHOLD_UE = 500
 JOURNEYS_THRESHOLD_UE = 20
 
+# raw lines are processed in chunks of up to the thresholds above, smaller ones at low
+# rates, and at the latest once the oldest line waited this long, see FlushPolicy
+RAW_LINES_LINGER_SEC = float(os.getenv('RAW_LINES_LINGER_SEC', 0.1))
+# ue lines are processed in chunks of at least UE_LOOKAHEAD_MIN_LINES once MAX_DEPTH later
+# lines arrived, their lookahead, so the deadline above does not cut them into chunks that
+# each pay for priming the lookahead. Once the source was quiet for UE_LOOKAHEAD_LINGER_SEC
+# the held lines are processed without it, see LookaheadULUE
+UE_LOOKAHEAD_MIN_LINES = int(os.getenv('UE_LOOKAHEAD_MIN_LINES', UE_MAX_DEPTH))
+UE_LOOKAHEAD_LINGER_SEC = float(os.getenv('UE_LOOKAHEAD_LINGER_SEC', 1.0))
+
+# dataframes waiting for the publish and the stream process
+MAX_PUBLISH_DEPTH = 100
+MAX_STREAM_DEPTH = 100
+# packet time of the influxdb points
+TIME_KEY = "send.timestamp"
+
 LOGGING_PERIOD_SEC = 2
 
+# bytes read from a client socket at once
+READ_SIZE = 1 << 16
+
 org = "expeca"
 bucket = "latency"
 influx_db_address = "http://0.0.0.0:8086"
@@ -34,7 +61,7 @@ auth_info_addr = "/EDAF/influx_auth.json"
 point_name = "packet_records"
 
 desired_fields = [
-    "rlc.reassembled.num_segments"
+    "rlc.reassembled.num_segments",
     "core_delay",
     "core_delay_perc",
     "core_departure_time",
@@ -68,6 +95,45 @@ desired_fields = [
     "transmission_delay_perc"
 ]
 
+# metrics of all stages, shared by the processes and served on /metrics, see Registry
+METRICS = Registry()
+CLIENTS = ["UPF", "GNB", "UE"]
+QUEUES = ["lines", "journeys"]
+LINES_PUBLISHED = METRICS.counter("edaf_lines_published_total", "Lines read from the clients and put on the raw lines queue", client=CLIENTS)
+LINES_DROPPED = METRICS.counter("edaf_lines_dropped_total", "Lines dropped as the raw lines queue was full (server) or processing them failed (queue)", stage=["server", "queue"], client=CLIENTS)
+LINES_PROCESSED = METRICS.counter("edaf_lines_processed_total", "Lines processed by the queue processes", client=CLIENTS)
+LINES_LATE = METRICS.counter("edaf_lines_late_total", "Lines that arrived after later lines were released, beyond the reorder slack", client=CLIENTS)
+JOURNEYS_PUBLISHED = METRICS.counter("edaf_journeys_published_total", "Journeys put on the journeys queue", client=CLIENTS)
+JOURNEYS_DROPPED = METRICS.counter("edaf_journeys_dropped_total", "Journeys dropped as the journeys queue was full or processing failed", client=CLIENTS)
+JOURNEYS_RECEIVED = METRICS.counter("edaf_journeys_received_total", "Journeys taken from the journeys queues by the combine process", client=CLIENTS)
+STALLED = METRICS.counter("edaf_stalled_seconds_total", "Seconds a sender waited for room in a full queue, with backpressure", queue=QUEUES, client=CLIENTS)
+BATCH_SIZE = METRICS.histogram("edaf_batch_size", "Lines or journeys per batch put on a queue", SIZE_BUCKETS, queue=QUEUES, client=CLIENTS)
+QUEUE_DEPTH = METRICS.gauge("edaf_queue_depth", "Batches waiting in a queue", queue=[*QUEUES, "publish", "stream"], client=[*CLIENTS, "all"])
+PROCESSING_SECONDS = METRICS.histogram("edaf_processing_seconds", "Seconds per chunk of lines (UPF, GNB, UE) or batch of packets", SECONDS_BUCKETS, stage=[*CLIENTS, "combine", "decompose", "publish", "stream"])
+PACKETS = METRICS.counter("edaf_packets_total", "Packets combined and decomposed", stage=["combined", "decomposed"])
+PACKETS_DROPPED = METRICS.counter("edaf_packets_dropped_total", "Packets dropped by the decomposition", reason=DROP_REASONS)
+PACKETS_HANDED_OVER = METRICS.counter("edaf_packets_handed_over_total", "Packets handed over to the publish and the stream process", sink=["publish", "stream"])
+PACKETS_HANDOVER_DROPPED = METRICS.counter("edaf_packets_handover_dropped_total", "Packets dropped as the publish or the stream queue was full", sink=["publish", "stream"])
+INFLUX_POINTS = METRICS.counter("edaf_influx_points_total", "Points by what became of them", outcome=["written", "rejected", "spilled", "replayed", "dropped"])
+INFLUX_FAILURES = METRICS.counter("edaf_influx_write_failures_total", "Failed influxdb writes")
+INFLUX_SPILL_BYTES = METRICS.gauge("edaf_influx_spill_bytes", "Bytes in the spill waiting to be written back")
+PARQUET_ROWS = METRICS.counter("edaf_parquet_rows_total", "Rows written to parquet files")
+PARQUET_FILES = METRICS.counter("edaf_parquet_files_total", "Parquet files closed")
+STREAM_PACKETS = METRICS.counter("edaf_stream_packets_total", "Packets pushed to the stream subscribers")
+STREAM_DROPPED = METRICS.counter("edaf_stream_dropped_total", "Packets dropped for stream subscribers that read too slowly")
+STREAM_SUBSCRIBERS = METRICS.gauge("edaf_stream_subscribers", "Connected stream subscribers")
+METRICS.allocate()
+
+def sender_metrics(queue_name, client_name):
+    # the series of a BatchSender putting lines or journeys of a client
+    if queue_name == "lines":
+        published = LINES_PUBLISHED.labels(client=client_name)
+        dropped = LINES_DROPPED.labels(stage="server", client=client_name)
+    else:
+        published = JOURNEYS_PUBLISHED.labels(client=client_name)
+        dropped = JOURNEYS_DROPPED.labels(client=client_name)
+    return SenderMetrics(published, dropped, BATCH_SIZE.labels(queue=queue_name, client=client_name), STALLED.labels(queue=queue_name, client=client_name))
+
 class RingBuffer:
     def __init__(self, size):
         self.size = size
@@ -99,13 +165,19 @@ class RingBuffer:
         with self.lock:
             return len(self.buffer)
 
-def pop_q_items(items_queue : multiprocessing.Queue):                
-    items = []
-    while not items_queue.empty():
-        items.append(items_queue.get())
-    return items
+def publish_columns(*sink_columns):
+    # the columns the sinks write together, None for all of them
+    if any(columns is None for columns in sink_columns):
+        return None
+    return list(dict.fromkeys(name for columns in sink_columns for name in columns))
 
-def combine_journeys(upf_journeys_queue, gnb_journeys_queue, ue_journeys_queue, config):
+def select_columns(df, columns):
+    # to hand over only what the sinks write
+    if columns is None:
+        return df
+    return df[[name for name in columns if name in df.columns]]
+
+def combine_journeys(upf_journeys_queue, gnb_journeys_queue, ue_journeys_queue, config, journeys_ready, publish_queue, stream_queue):
 
     # set standalone var
     if (gnb_journeys_queue is None) and (ue_journeys_queue is None):
@@ -119,139 +191,345 @@ def combine_journeys(upf_journeys_queue, gnb_journeys_queue, ue_journeys_queue,
     stats_combined_journeys = 0
     stats_decomposed_journeys = 0
     stats_published_journeys = 0
+    # packets dropped by the decomposition, per reason
+    stats_dropped_journeys = new_drops()
+    # packets dropped as the publish or the stream queue was full
+    stats_dropped_published = 0
+    stats_dropped_streamed = 0
     start_time = time.time()
 
     combineul = CombineUL(standalone=standalone)
 
-    if config["influx_token"]:
-        if standalone:
-            influx_cli = InfluxClient(influx_db_address, config["influx_token"], bucket, org, point_name)
-        else:
-            influx_cli = InfluxClientFULL(influx_db_address, config["influx_token"], bucket, org, point_name, desired_fields)
-        logger.info("[combine journeys] influxDB client initialized")
-    else:
-        influx_cli = None
-        logger.warning("[combine journeys] influxDB client NONE")
+    METRICS.attach(config["METRICS"])
+    received = { client_name : JOURNEYS_RECEIVED.labels(client=client_name) for client_name in CLIENTS }
+    depths = { client_name : QUEUE_DEPTH.labels(queue="journeys", client=client_name) for client_name in CLIENTS }
+    combine_seconds = PROCESSING_SECONDS.labels(stage="combine")
+    decompose_seconds = PROCESSING_SECONDS.labels(stage="decompose")
+
+    if publish_queue is None:
+        logger.warning("[combine journeys] influxDB client NONE, no parquet sink")
 
     logger.info(f"[combine journeys] process starts.")
     
     while True:
-        time.sleep(0.1)
+        # the queue processes set journeys_ready after every batch they put, see BatchSender.
+        # It is cleared before the queues are drained, so a batch put meanwhile wakes the next wait
+        journeys_ready.wait(LOGGING_PERIOD_SEC)
+        journeys_ready.clear()
         try:
             if not standalone:
-                upf_items = pop_q_items(upf_journeys_queue)
-                gnb_items = pop_q_items(gnb_journeys_queue)
-                ue_items = pop_q_items(ue_journeys_queue)
+                depths["UPF"].set(upf_journeys_queue.qsize())
+                depths["GNB"].set(gnb_journeys_queue.qsize())
+                depths["UE"].set(ue_journeys_queue.qsize())
+                upf_items = get_batches(upf_journeys_queue)
+                gnb_items = get_batches(gnb_journeys_queue)
+                ue_items = get_batches(ue_journeys_queue)
                 stats_rcv_journeys_upf = stats_rcv_journeys_upf + len(upf_items)
-                stats_rcv_journeys_gnb = stats_rcv_journeys_gnb + len(gnb_items)
-                stats_rcv_journeys_ue = stats_rcv_journeys_ue + len(ue_items)
+                # gnb and ue journeys arrive in batches
+                rcv_gnb = sum(len(batch) for batch in gnb_items)
+                rcv_ue = sum(len(batch) for batch in ue_items)
+                stats_rcv_journeys_gnb = stats_rcv_journeys_gnb + rcv_gnb
+                stats_rcv_journeys_ue = stats_rcv_journeys_ue + rcv_ue
+                received["UPF"].inc(len(upf_items))
+                received["GNB"].inc(rcv_gnb)
+                received["UE"].inc(rcv_ue)
+                started = time.monotonic()
                 df = combineul.run(
                     upf_items,
                     gnb_items,
                     ue_items
                 )
+                combined = time.monotonic()
                 stats_combined_journeys = stats_combined_journeys + len(df)
-                df = process_ul_journeys(df)
-                stats_decomposed_journeys = stats_decomposed_journeys + len(df)
+                PACKETS.labels(stage="combined").inc(len(df))
+                df, drops = process_ul_journeys(df)
             else:
-                upf_items = pop_q_items(upf_journeys_queue, JOURNEYS_THRESHOLD_UPF)
+                depths["UPF"].set(upf_journeys_queue.qsize())
+                upf_items = get_batches(upf_journeys_queue, JOURNEYS_THRESHOLD_UPF)
+                if len(upf_items) > 0:
+                    # more may be waiting
+                    journeys_ready.set()
                 stats_rcv_journeys_upf = stats_rcv_journeys_upf + len(upf_items)
+                received["UPF"].inc(len(upf_items))
+                started = time.monotonic()
                 df = combineul.run(
                     upf_items,
                     None,
                     None,
                 )
+                combined = time.monotonic()
                 stats_combined_journeys = stats_combined_journeys + len(df)
-                df = process_ul_journeys(df,standalone=True)
-                stats_decomposed_journeys = stats_decomposed_journeys + len(df)
+                PACKETS.labels(stage="combined").inc(len(df))
+                df, drops = process_ul_journeys(df,standalone=True)
+
+            if len(upf_items) > 0:
+                combine_seconds.observe(combined - started)
+                decompose_seconds.observe(time.monotonic() - combined)
+            stats_decomposed_journeys = stats_decomposed_journeys + len(df)
+            PACKETS.labels(stage="decomposed").inc(len(df))
+            for reason, count in drops.items():
+                stats_dropped_journeys[reason] = stats_dropped_journeys[reason] + count
+                PACKETS_DROPPED.labels(reason=reason).inc(count)
 
             # print stats
             current_time = time.time()
             elapsed_time = current_time - start_time
             if int(elapsed_time) >= LOGGING_PERIOD_SEC:
                 logger.info(f"[combine journeys] received journeys: UPF {stats_rcv_journeys_upf}, GNB {stats_rcv_journeys_gnb}, UE {stats_rcv_journeys_ue}, combined journeys: {stats_combined_journeys}, decomposed journeys: {stats_decomposed_journeys}, published journeys: {stats_published_journeys}")
+                logger.info(f"[combine journeys] dropped journeys: {stats_dropped_journeys}, dropped for publishing: {stats_dropped_published}, dropped for streaming: {stats_dropped_streamed}")
                 start_time = current_time
 
             if df is not None:
                 if len(df)>0:
                     # print(df)
                     logger.debug(f"[combine journeys] Pushing {len(df)} packet records to the database")
-                    # push df to influxdb
-                    if influx_cli:
-                        influx_cli.push_dataframe(df)
-                        stats_published_journeys = stats_published_journeys + len(df)
+                    # hand df over to the publish process, writing to the sinks does not hold up combining
+                    if publish_queue is not None:
+                        try:
+                            publish_queue.put([select_columns(df, config["PUBLISH_COLUMNS"])], block=config["BACKPRESSURE"])
+                            stats_published_journeys = stats_published_journeys + len(df)
+                            PACKETS_HANDED_OVER.labels(sink="publish").inc(len(df))
+                        except queue.Full:
+                            stats_dropped_published = stats_dropped_published + len(df)
+                            PACKETS_HANDOVER_DROPPED.labels(sink="publish").inc(len(df))
                     else:
-                        logger.warning(f"[combine journeys] Failed to push {len(df)} packet records to the database as influx cli is not setup.")
+                        logger.warning(f"[combine journeys] Failed to push {len(df)} packet records as neither influx cli nor a parquet sink is set up.")
+                    # the stream is live, it never holds up combining
+                    if stream_queue is not None:
+                        try:
+                            stream_queue.put_nowait([df])
+                            PACKETS_HANDED_OVER.labels(sink="stream").inc(len(df))
+                        except queue.Full:
+                            stats_dropped_streamed = stats_dropped_streamed + len(df)
+                            PACKETS_HANDOVER_DROPPED.labels(sink="stream").inc(len(df))
         except Exception as ex:
             logger.error(f"[combine journeys] {ex}")
             logger.warning(traceback.format_exc())
 
 
-def queue_process(client_name, config, rawdata_queue, journeys_queue):
+def publish_journeys(config, publish_queue):
+    METRICS.attach(config["METRICS"])
+
+    # the sinks take dataframes with add, and write them out as their batches get due, see remaining and poll
+    sinks = {}
+    if config["influx_token"]:
+        sinks["influx"] = InfluxWriter(influx_db_address, config["influx_token"], bucket, org, point_name, config["PUBLISH_FIELDS"], TIME_KEY)
+        logger.info("[publish journeys] influxDB client initialized")
+    if config["PARQUET_DIR"]:
+        sinks["parquet"] = ParquetSink(config["PARQUET_DIR"], config["PARQUET_COLUMNS"])
+        logger.info(f"[publish journeys] parquet sink in {config['PARQUET_DIR']}")
+    start_time = time.time()
+
+    # the sinks are closed on terminate, to write out what they hold
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        publish_loop(publish_queue, sinks, start_time)
+    finally:
+        for name, sink in sinks.items():
+            sink.close()
+            logger.info(f"[publish journeys] {name} closed: {sink.metrics()}")
+
+def publish_loop(publish_queue, sinks, start_time):
+    depth = QUEUE_DEPTH.labels(queue="publish", client="all")
+    publish_seconds = PROCESSING_SECONDS.labels(stage="publish")
+    while True:
+        try:
+            # wait for packets, but not beyond the time a pending batch or a retry is due
+            frames = get_batch(publish_queue, earliest(*[sink.remaining() for sink in sinks.values()], LOGGING_PERIOD_SEC))
+            depth.set(publish_queue.qsize())
+            started = time.monotonic()
+            for df in frames:
+                for sink in sinks.values():
+                    sink.add(df)
+            for sink in sinks.values():
+                sink.poll()
+            if len(frames) > 0:
+                publish_seconds.observe(time.monotonic() - started)
+            report_sinks(sinks)
+
+            # print stats
+            current_time = time.time()
+            elapsed_time = current_time - start_time
+            if int(elapsed_time) >= LOGGING_PERIOD_SEC:
+                logger.info(f"[publish journeys] queue depth: {publish_queue.qsize()}")
+                for name, sink in sinks.items():
+                    logger.info(f"[publish journeys] {name}: {sink.metrics()}")
+                start_time = current_time
+
+        except Exception as ex:
+            logger.error(f"[publish journeys] {ex}")
+            logger.warning(traceback.format_exc())
+
+
+def report_sinks(sinks):
+    # the sinks keep their own counts, the metrics follow them
+    if "influx" in sinks:
+        writer = sinks["influx"]
+        for outcome in ["written", "rejected", "spilled", "replayed", "dropped"]:
+            INFLUX_POINTS.labels(outcome=outcome).set(getattr(writer, outcome))
+        INFLUX_FAILURES.labels().set(writer.failures)
+        INFLUX_SPILL_BYTES.labels().set(len(writer.spill))
+    if "parquet" in sinks:
+        PARQUET_ROWS.labels().set(sinks["parquet"].written)
+        PARQUET_FILES.labels().set(sinks["parquet"].files)
+
+
+async def async_stream_server(config, stream_queue):
+    METRICS.attach(config["METRICS"])
+    depth = QUEUE_DEPTH.labels(queue="stream", client="all")
+    stream_seconds = PROCESSING_SECONDS.labels(stage="stream")
+    hub = StreamHub()
+    servers = []
+    if config["STREAM_PORT"]:
+        servers.append(await asyncio.start_server(hub.handle, host=config["STREAM_HOST"], port=config["STREAM_PORT"]))
+    if config["STREAM_SOCKET"]:
+        if os.path.exists(config["STREAM_SOCKET"]):
+            os.unlink(config["STREAM_SOCKET"])
+        servers.append(await asyncio.start_unix_server(hub.handle, path=config["STREAM_SOCKET"]))
+    for server in servers:
+        logger.info(f'[stream] serving on {server.sockets[0].getsockname()}')
+
+    loop = asyncio.get_running_loop()
+    start_time = time.time()
+    while True:
+        try:
+            # the queue is read in a thread, the subscribers are served meanwhile. What
+            # piled up during a publish goes out with the next one
+            frames = await loop.run_in_executor(None, get_batch, stream_queue, LOGGING_PERIOD_SEC)
+            depth.set(stream_queue.qsize())
+            started = time.monotonic()
+            hub.publish(frames + get_batches(stream_queue))
+            if len(frames) > 0:
+                stream_seconds.observe(time.monotonic() - started)
+            STREAM_PACKETS.labels().set(hub.published)
+            STREAM_DROPPED.labels().set(hub.dropped)
+            STREAM_SUBSCRIBERS.labels().set(len(hub.subscribers))
+
+            # print stats
+            current_time = time.time()
+            elapsed_time = current_time - start_time
+            if int(elapsed_time) >= LOGGING_PERIOD_SEC:
+                logger.info(f"[stream] {hub.metrics()}")
+                start_time = current_time
+
+        except Exception as ex:
+            logger.error(f"[stream] {ex}")
+            logger.warning(traceback.format_exc())
+
+def stream_journeys(config, stream_queue):
+    asyncio.run(async_stream_server(config, stream_queue))
+
+
+def queue_process(client_name, config, rawdata_queue, journeys_queue, journeys_ready):
 
     stats_dropped_lines = 0
     stats_rcv_lines = 0
-    stats_published_journeys = 0
     stats_dropped_journeys = 0
     start_time = time.time()
 
     if (rawdata_queue is None) or (journeys_queue is None):
         return
 
+    METRICS.attach(config["METRICS"])
+    processed = LINES_PROCESSED.labels(client=client_name)
+    failed = LINES_DROPPED.labels(stage="queue", client=client_name)
+    late = LINES_LATE.labels(client=client_name)
+    depth = QUEUE_DEPTH.labels(queue="lines", client=client_name)
+    chunk_seconds = PROCESSING_SECONDS.labels(stage=client_name)
+
+    # batch sizes and deadlines can change at runtime
+    runtime = RuntimeConfig(config[client_name], client_name)
+    # journeys go to the combine process in batches
+    sender = BatchSender(journeys_queue, FlushPolicy(runtime, "BATCH_JOURNEYS", "BATCH_LINGER_SEC"), journeys_ready, config["BACKPRESSURE"], sender_metrics("journeys", client_name))
+    # when the raw lines are processed
+    raw_policy = FlushPolicy(runtime, "PROCESS_LINES", "PROCESS_LINGER_SEC")
+
     if client_name == 'UE':
-        ITEMS_PROCESS_LIMIT = RAW_LINES_THRESHOLD_UE
         rdts = rdtsctotsOnline("UE")
-        proc = ProcessULUE()
+        reorder = ReorderBuffer(config[client_name]["REORDER_SLACK_NS"])
+        proc = LookaheadULUE(min_chunk=config[client_name]["LOOKAHEAD_MIN_LINES"])
     elif client_name == 'GNB':
-        ITEMS_PROCESS_LIMIT = RAW_LINES_THRESHOLD_GNB
         rdts = rdtsctotsOnline("GNB")
+        reorder = ReorderBuffer(config[client_name]["REORDER_SLACK_NS"])
         proc = ProcessULGNB()
     elif client_name == 'UPF':
-        ITEMS_PROCESS_LIMIT = 1
         rdts = None
+        reorder = None
         proc = None
 
     logger.info(f"[{client_name} queue process] starts.")
 
     raw_inputs = []
     journeys = []
+    # the reorder buffer holds back the newest lines until later ones arrive. Once the
+    # source was quiet for the slack, no late lines are expected and they are released.
+    # The ue lookahead is released the same way, after UE_LOOKAHEAD_LINGER_SEC
+    last_arrival = None
+    quiet = config[client_name].get("REORDER_SLACK_NS", 0) / 1.0e9
     while True:
         try:
-            try:
-                raw_inputs.append(rawdata_queue.get_nowait())
-            except queue.Empty:
-                pass
-
-            if len(raw_inputs) >= ITEMS_PROCESS_LIMIT:
+            # wait for lines, but not beyond the time the pending lines or journeys are due
+            held = None
+            if reorder is not None and len(raw_inputs) == 0:
+                if len(reorder) > 0:
+                    held = time_left(last_arrival, quiet)
+                elif client_name == 'UE' and len(proc) > 0:
+                    held = time_left(last_arrival, UE_LOOKAHEAD_LINGER_SEC)
+            lines = get_batch(rawdata_queue, earliest(raw_policy.remaining(), sender.remaining(), held, LOGGING_PERIOD_SEC))
+            depth.set(rawdata_queue.qsize())
+            if len(lines) > 0:
+                raw_inputs.extend(lines)
+                raw_policy.arrived(len(lines))
+                last_arrival = time.monotonic()
+
+            l1lines = []
+            started = None
+            if raw_policy.due():
+                started = time.monotonic()
                 # update stats
                 stats_rcv_lines = stats_rcv_lines + len(raw_inputs)
+                processed.inc(len(raw_inputs))
                 if client_name == 'UE' or client_name == 'GNB':
-                    l1lines = rdts.return_rdtsctots(raw_inputs)
-                    if client_name == 'UE':
-                        l1lines.reverse()
-                    if len(l1lines) > 0:
-                        journeys = proc.run(l1lines)
+                    # lines are released in time order, also across batches, once the watermark passes them
+                    reorder.push(rdts.return_records(raw_inputs, sort=False))
+                    l1lines = reorder.pop_ready()
                 elif client_name == 'UPF':
                     journeys = process_ul_nlmt(raw_inputs)
                 
                 raw_inputs = []
-                
-                #update stats
-                for journey in journeys:
-                    try:
-                        journeys_queue.put_nowait(journey)
-                        stats_published_journeys = stats_published_journeys + 1
-                    except queue.Full:
-                        # update stats
-                        stats_dropped_journeys = stats_dropped_journeys + 1
-
-                journeys = []
+                raw_policy.flushed()
+            elif held is not None and len(reorder) > 0 and time_left(last_arrival, quiet) == 0.0:
+                started = time.monotonic()
+                l1lines = reorder.flush()
+            elif held is not None and len(reorder) == 0 and time_left(last_arrival, UE_LOOKAHEAD_LINGER_SEC) == 0.0:
+                # once per quiet period, and without a lookahead to prime
+                started = time.monotonic()
+                journeys = proc.flush()
+
+            if len(l1lines) > 0:
+                journeys = proc.run(l1lines)
+            if started is not None:
+                chunk_seconds.observe(time.monotonic() - started)
+                if reorder is not None:
+                    late.set(reorder.late)
+
+            if client_name == 'UPF':
+                sender.add(journeys)
+            elif len(journeys) > 0:
+                # the journey batch of the chunk goes as one item
+                sender.add([journeys], len(journeys))
+            journeys = []
+            sender.poll()
+            # with backpressure, no more lines are taken from the queue until the journeys are through
+            sender.wait()
 
             # print stats
             current_time = time.time()
             elapsed_time = current_time - start_time
             if int(elapsed_time) >= LOGGING_PERIOD_SEC:
-                logger.info(f"[{client_name} queue process] received lines: {stats_rcv_lines}, dropped lines: {stats_dropped_lines}, published journeys: {stats_published_journeys}, dropped journeys: {stats_dropped_journeys}")
+                logger.info(f"[{client_name} queue process] received lines: {stats_rcv_lines}, dropped lines: {stats_dropped_lines}, published journeys: {sender.published}, dropped journeys: {stats_dropped_journeys + sender.dropped}, stalls: {sender.stalls} ({sender.stalled_sec:.3f}s)")
+                if rdts is not None:
+                    logger.info(f"[{client_name} queue process] clock: {rdts.metrics()}, pending lines: {len(reorder)}, late lines: {reorder.late}")
                 start_time = current_time
 
         except Exception as ex:
@@ -260,20 +538,37 @@ def queue_process(client_name, config, rawdata_queue, journeys_queue):
             # update stats, clean the queues
             stats_dropped_lines = stats_dropped_lines + len(raw_inputs)
             stats_dropped_journeys = stats_dropped_journeys + len(journeys)
+            failed.inc(len(raw_inputs))
+            JOURNEYS_DROPPED.labels(client=client_name).inc(len(journeys))
             raw_inputs = []
+            raw_policy.flushed()
             journeys = []
 
 
+async def drain_stalled(sender):
+    # with backpressure, the socket is not read while the lines wait for room in the queue,
+    # so the kernel buffers fill up and TCP flow control slows down the sender
+    while sender.stalled:
+        await asyncio.sleep(STALL_WAIT_SEC)
+        sender.flush()
+
 async def handle_client(reader, writer, client_name, config, rawdata_queue):
     init = True
     rem_str = ''
-    stats_dropped_lines = 0
-    stats_published_lines = 0
     start_time = time.time()
+    # the lines of each read go to the queue process in batches
+    runtime = RuntimeConfig(config[client_name], client_name)
+    sender = BatchSender(rawdata_queue, FlushPolicy(runtime, "BATCH_LINES", "BATCH_LINGER_SEC"), backpressure=config["BACKPRESSURE"], metrics=sender_metrics("lines", client_name))
 
     try:
         while True:
-            data = await reader.read(512)
+            try:
+                data = await asyncio.wait_for(reader.read(config[client_name]["BUFFER_SIZE"]), timeout=sender.remaining())
+            except asyncio.TimeoutError:
+                # nothing arrived while the pending lines lingered
+                sender.flush()
+                await drain_stalled(sender)
+                continue
             if not data:
                 break
             if init:
@@ -286,39 +581,31 @@ async def handle_client(reader, writer, client_name, config, rawdata_queue):
                 if rem_str != '':
                     received_lines[0] = rem_str + received_lines[0]
                     rem_str = ''
-                for line in received_lines:
-                    if line != 'test':
-                        try:
-                            rawdata_queue.put_nowait(line)
-                            stats_published_lines = stats_published_lines + 1
-                        except queue.Full:
-                            stats_dropped_lines = stats_dropped_lines + 1
+                sender.add([line for line in received_lines if line != 'test'])
             else:
                 if '\n' in message:
                     received_lines = message.splitlines()
                     received_lines[0] = rem_str + received_lines[0]
                     rem_str = ''
-                    for line in received_lines[:-1]:
-                        if line != 'test':
-                            try:
-                                rawdata_queue.put_nowait(line)
-                                stats_published_lines = stats_published_lines + 1
-                            except queue.Full:
-                                stats_dropped_lines = stats_dropped_lines + 1
+                    sender.add([line for line in received_lines[:-1] if line != 'test'])
                     rem_str = received_lines[-1]
                 else:
                     rem_str = rem_str + message
+            sender.poll()
+            await drain_stalled(sender)
 
             # print stats
             current_time = time.time()
             elapsed_time = current_time - start_time
             if int(elapsed_time) >= LOGGING_PERIOD_SEC:
-                logger.info(f"[{client_name} server] published lines: {stats_published_lines}, dropped lines: {stats_dropped_lines}")
+                logger.info(f"[{client_name} server] published lines: {sender.published}, dropped lines: {sender.dropped}, stalls: {sender.stalls} ({sender.stalled_sec:.3f}s)")
                 start_time = current_time
             
     except asyncio.CancelledError:
         pass
     finally:
+        sender.flush()
+        await drain_stalled(sender)
         logger.warning(f"[{client_name} server] Closing the connection")
         writer.close()
 
@@ -338,6 +625,7 @@ async def async_net_server(client_name, config, rawdata_queue):
         await server.serve_forever()
 
 def net_server(client_name, config, rawdata_queue):
+    METRICS.attach(config["METRICS"])
     asyncio.run(async_net_server(client_name, config, rawdata_queue))
 
 def serve():
@@ -369,13 +657,30 @@ def serve():
 
     config = {
         "influx_token" : token,
+        # the shared metrics, for processes that are not forked
+        "METRICS": METRICS.values,
+        "BACKPRESSURE": BACKPRESSURE,
+        # packet fields written to influxdb, all of them in standalone mode
+        "PUBLISH_FIELDS": None if standalone else desired_fields,
+        "PARQUET_DIR": PARQUET_DIR,
+        "PARQUET_COLUMNS": PARQUET_COLUMNS,
+        "STREAM_HOST": STREAM_HOST,
+        "STREAM_PORT": STREAM_PORT,
+        "STREAM_SOCKET": STREAM_SOCKET,
         "UPF": {
             "PORT": 50009,
-            "BUFFER_SIZE": 1000
+            "BUFFER_SIZE": READ_SIZE,
+            "BATCH_LINES": BATCH_LINES,
+            "BATCH_JOURNEYS": BATCH_JOURNEYS,
+            "BATCH_LINGER_SEC": BATCH_LINGER_SEC,
+            "PROCESS_LINES": 1,
+            "PROCESS_LINGER_SEC": RAW_LINES_LINGER_SEC
         }
     }
-    upf_rawdata_queue = Queue(MAX_L1_UPF_DEPTH)
-    upf_journeys_queue = Queue(MAX_L2_UPF_DEPTH)
+    logger.info(f"[main] Shared memory transport:{SHM_TRANSPORT}")
+    logger.info(f"[main] Backpressure:{BACKPRESSURE}")
+    upf_rawdata_queue = lines_queue(MAX_L1_UPF_DEPTH)
+    upf_journeys_queue = journeys_queue(MAX_L2_UPF_DEPTH)
     gnb_rawdata_queue = None
     gnb_journeys_queue = None
     ue_rawdata_queue = None
@@ -386,34 +691,73 @@ def serve():
             **config,
             "GNB": {
                 "PORT": 50015,
-                "BUFFER_SIZE": 1000
+                "BUFFER_SIZE": READ_SIZE,
+                "REORDER_SLACK_NS": DEFAULT_REORDER_SLACK_NS,
+                "BATCH_LINES": BATCH_LINES,
+                "BATCH_JOURNEYS": BATCH_JOURNEYS,
+                "BATCH_LINGER_SEC": BATCH_LINGER_SEC,
+                "PROCESS_LINES": RAW_LINES_THRESHOLD_GNB,
+                "PROCESS_LINGER_SEC": RAW_LINES_LINGER_SEC
             },
             "UE": {
                 "PORT": 50011,
-                "BUFFER_SIZE": 1000
+                "BUFFER_SIZE": READ_SIZE,
+                "REORDER_SLACK_NS": DEFAULT_REORDER_SLACK_NS,
+                "BATCH_LINES": BATCH_LINES,
+                "BATCH_JOURNEYS": BATCH_JOURNEYS,
+                "BATCH_LINGER_SEC": BATCH_LINGER_SEC,
+                "PROCESS_LINES": RAW_LINES_THRESHOLD_UE,
+                "PROCESS_LINGER_SEC": RAW_LINES_LINGER_SEC,
+                "LOOKAHEAD_MIN_LINES": UE_LOOKAHEAD_MIN_LINES
             }
         }
 
-        gnb_rawdata_queue = Queue(MAX_L1_GNB_DEPTH)
-        gnb_journeys_queue = Queue(MAX_L2_GNB_DEPTH)
-        ue_rawdata_queue = Queue(MAX_L1_UE_DEPTH)
-        ue_journeys_queue = Queue(MAX_L2_UE_DEPTH)
+        gnb_rawdata_queue = lines_queue(MAX_L1_GNB_DEPTH)
+        gnb_journeys_queue = journeys_queue(MAX_L2_GNB_DEPTH, GNB_SCHEMA)
+        ue_rawdata_queue = lines_queue(MAX_L1_UE_DEPTH)
+        ue_journeys_queue = journeys_queue(MAX_L2_UE_DEPTH, UE_SCHEMA)
+
+    # set by the queue processes when they put journeys, the combine process waits on it
+    journeys_ready = multiprocessing.Event()
+
+    # combined packets go to the publish process, if there is a database or a parquet sink
+    sink_columns = []
+    if token:
+        sink_columns.append(None if config["PUBLISH_FIELDS"] is None else [*config["PUBLISH_FIELDS"], TIME_KEY])
+    if PARQUET_DIR:
+        sink_columns.append(PARQUET_COLUMNS)
+    config["PUBLISH_COLUMNS"] = publish_columns(*sink_columns)
+    publish_queue = Queue(MAX_PUBLISH_DEPTH) if sink_columns else None
+    logger.info(f"[main] Parquet sink:{PARQUET_DIR}")
+
+    # combined packets are also streamed to local subscribers, if there is a port or socket for it
+    stream_queue = Queue(MAX_STREAM_DEPTH) if (STREAM_PORT or STREAM_SOCKET) else None
+    logger.info(f"[main] Stream:{STREAM_HOST}:{STREAM_PORT} {STREAM_SOCKET}")
+
+    if METRICS_PORT:
+        serve_metrics(METRICS, METRICS_HOST, METRICS_PORT)
 
     try:
         # UPF
         upf_server = Process(target=net_server, args=("UPF", config, upf_rawdata_queue),daemon=True)
-        upf_qprocess = Process(target=queue_process, args=("UPF", config, upf_rawdata_queue, upf_journeys_queue),daemon=True)
+        upf_qprocess = Process(target=queue_process, args=("UPF", config, upf_rawdata_queue, upf_journeys_queue, journeys_ready),daemon=True)
 
         # GNB
         gnb_server = Process(target=net_server, args=("GNB", config, gnb_rawdata_queue),daemon=True)
-        gnb_qprocess = Process(target=queue_process, args=("GNB", config, gnb_rawdata_queue, gnb_journeys_queue),daemon=True)
+        gnb_qprocess = Process(target=queue_process, args=("GNB", config, gnb_rawdata_queue, gnb_journeys_queue, journeys_ready),daemon=True)
 
         # UE
         ue_server = Process(target=net_server, args=("UE", config, ue_rawdata_queue),daemon=True)
-        ue_qprocess = Process(target=queue_process, args=("UE", config, ue_rawdata_queue, ue_journeys_queue),daemon=True)
+        ue_qprocess = Process(target=queue_process, args=("UE", config, ue_rawdata_queue, ue_journeys_queue, journeys_ready),daemon=True)
 
         # COMBINE
-        combine_process = Process(target=combine_journeys, args=(upf_journeys_queue, gnb_journeys_queue, ue_journeys_queue, config), daemon=True)
+        combine_process = Process(target=combine_journeys, args=(upf_journeys_queue, gnb_journeys_queue, ue_journeys_queue, config, journeys_ready, publish_queue, stream_queue), daemon=True)
+
+        # PUBLISH
+        publish_process = Process(target=publish_journeys, args=(config, publish_queue), daemon=True)
+
+        # STREAM
+        stream_process = Process(target=stream_journeys, args=(config, stream_queue), daemon=True)
         
         # start
         upf_server.start()
@@ -427,6 +771,12 @@ def serve():
 
         combine_process.start()
 
+        if publish_queue is not None:
+            publish_process.start()
+
+        if stream_queue is not None:
+            stream_process.start()
+
         # join
         upf_server.join()
         upf_qprocess.join()
@@ -439,6 +789,12 @@ def serve():
 
         combine_process.join()
 
+        if publish_queue is not None:
+            publish_process.join()
+
+        if stream_queue is not None:
+            stream_process.join()
+
     except KeyboardInterrupt:
         logger.warning("Caught KeyboardInterrupt, terminating workers")
 
@@ -453,6 +809,12 @@ def serve():
         ue_qprocess.terminate()
         
         combine_process.terminate()
+
+        if publish_queue is not None:
+            publish_process.terminate()
+
+        if stream_queue is not None:
+            stream_process.terminate()
     else:
         logger.warning("Termination")
 
@@ -468,4 +830,11 @@ def serve():
 
         combine_process.terminate()
 
+        if publish_queue is not None:
+            publish_process.terminate()
+
+        if stream_queue is not None:
+            stream_process.terminate()
 
+    for items_queue in (upf_rawdata_queue, upf_journeys_queue, gnb_rawdata_queue, gnb_journeys_queue, ue_rawdata_queue, ue_journeys_queue, publish_queue, stream_queue):
+        close_queue(items_queue)
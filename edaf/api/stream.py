@@ -0,0 +1,121 @@
+import sys, asyncio
+import pandas as pd
+import pyarrow as pa
+from loguru import logger
+
+from edaf.core.uplink.schema import UL_SCHEMA
+
+import os
+if not os.getenv('DEBUG'):
+    logger.remove()
+    logger.add(sys.stdout, level="INFO")
+
+# the decomposed packets are streamed to subscribers on STREAM_HOST:STREAM_PORT and/or
+# the unix socket STREAM_SOCKET, no stream if neither is set, see StreamHub
+STREAM_HOST = os.getenv('STREAM_HOST', '127.0.0.1')
+STREAM_PORT = int(os.getenv('STREAM_PORT')) if os.getenv('STREAM_PORT') else None
+STREAM_SOCKET = os.getenv('STREAM_SOCKET')
+# batches buffered per subscriber, newer ones are dropped while it is full
+STREAM_BUFFER_BATCHES = int(os.getenv('STREAM_BUFFER_BATCHES', 64))
+
+FORMATS = ['ndjson', 'arrow']
+# end of an arrow ipc stream
+ARROW_EOS = b'\xff\xff\xff\xff\x00\x00\x00\x00'
+
+def encode(df, format, columns):
+    # a batch as it is sent to subscribers of this format and columns
+    if columns is not None:
+        df = df[[name for name in columns if name in df.columns]]
+    if format == 'ndjson':
+        return df.to_json(orient='records', lines=True).encode()
+    # the schema message, to start a stream with, and the record batch message
+    table = UL_SCHEMA.table(df).combine_chunks()
+    batches = table.to_batches()
+    if len(batches) == 0:
+        batches = [pa.RecordBatch.from_pylist([], schema=table.schema)]
+    return table.schema.serialize().to_pybytes(), batches[0].serialize().to_pybytes()
+
+class Subscriber:
+    def __init__(self, writer, format, columns, depth):
+        self.writer = writer
+        self.format = format
+        self.columns = columns
+        self.queue = asyncio.Queue(depth)
+        # the schema message of the arrow stream being sent
+        self.schema = None
+        self.sent = 0
+        self.dropped = 0
+
+    def name(self):
+        return f"{self.writer.get_extra_info('peername') or self.writer.get_extra_info('sockname')} {self.format}"
+
+    async def send(self, data, rows):
+        if self.format == 'arrow':
+            schema, batch = data
+            if schema != self.schema:
+                # the columns changed, a new stream follows the one sent so far
+                if self.schema is not None:
+                    self.writer.write(ARROW_EOS)
+                self.writer.write(schema)
+                self.schema = schema
+            data = batch
+        self.writer.write(data)
+        await self.writer.drain()
+        self.sent = self.sent + rows
+
+class StreamHub:
+    # Pushes every batch of decomposed packets to all subscribers. A subscriber connects
+    # and sends one line: the format, ndjson (a json object per packet and line) or
+    # arrow (an arrow ipc stream, a record batch per batch, restarted when the columns
+    # change), optionally followed by a space and the comma separated columns it wants.
+    # The frames waiting are sent as one batch, encoded once per format and columns, as
+    # encoding costs mostly per column, not per packet. Every subscriber has its own
+    # bounded buffer, a slow one loses batches instead of holding up the others.
+    def __init__(self, depth = STREAM_BUFFER_BATCHES):
+        self.depth = depth
+        self.subscribers = set()
+        self.published = 0
+        # packets lost to full subscriber buffers, all subscribers so far
+        self.dropped = 0
+
+    def publish(self, frames):
+        frames = [df for df in frames if len(df) > 0]
+        if len(frames) == 0:
+            return
+        df = frames[0] if len(frames) == 1 else pd.concat(frames, ignore_index=True)
+        encoded = {}
+        for subscriber in self.subscribers:
+            key = (subscriber.format, subscriber.columns)
+            if key not in encoded:
+                encoded[key] = encode(df, *key)
+            try:
+                subscriber.queue.put_nowait((encoded[key], len(df)))
+            except asyncio.QueueFull:
+                subscriber.dropped = subscriber.dropped + len(df)
+                self.dropped = self.dropped + len(df)
+        self.published = self.published + len(df)
+
+    async def handle(self, reader, writer):
+        try:
+            request = (await reader.readline()).decode(errors='ignore').split()
+            if len(request) == 0 or request[0] not in FORMATS:
+                logger.warning(f"[stream] unknown subscription {request}, formats are {FORMATS}")
+                return
+            columns = tuple(request[1].split(',')) if len(request) > 1 else None
+            subscriber = Subscriber(writer, request[0], columns, self.depth)
+            self.subscribers.add(subscriber)
+            logger.info(f"[stream] {subscriber.name()} subscribed")
+            try:
+                while True:
+                    data, rows = await subscriber.queue.get()
+                    await subscriber.send(data, rows)
+            except (ConnectionError, OSError) as ex:
+                logger.info(f"[stream] {subscriber.name()} left: {ex}")
+            finally:
+                self.subscribers.discard(subscriber)
+        finally:
+            writer.close()
+
+    def metrics(self):
+        return { 'published': self.published, 'subscribers': { subscriber.name(): { 'sent': subscriber.sent, 'dropped': subscriber.dropped,
+                 'buffered': subscriber.queue.qsize() } for subscriber in self.subscribers } }
@@ -0,0 +1,461 @@
+import sys, time, queue, struct, multiprocessing, json, math
+import numpy as np
+from multiprocessing import Queue, shared_memory
+from loguru import logger
+
+import os
+if not os.getenv('DEBUG'):
+    logger.remove()
+    logger.add(sys.stdout, level="INFO")
+
+# lines and journeys cross the process queues in batches, flushed once they hold
+# BATCH_LINES lines (BATCH_JOURNEYS journeys) or the oldest waited BATCH_LINGER_SEC
+BATCH_LINES = int(os.getenv('BATCH_LINES', 500))
+BATCH_JOURNEYS = int(os.getenv('BATCH_JOURNEYS', 20))
+BATCH_LINGER_SEC = float(os.getenv('BATCH_LINGER_SEC', 0.01))
+
+# shared memory rings instead of multiprocessing queues, for the raw lines and the
+# gnb and ue journeys, see ShmRing. Ring sizes in bytes
+SHM_TRANSPORT = os.getenv('SHM_TRANSPORT', '').lower() in ['true', '1', 'yes']
+SHM_LINES_BYTES = int(os.getenv('SHM_LINES_BYTES', 16 << 20))
+SHM_JOURNEYS_BYTES = int(os.getenv('SHM_JOURNEYS_BYTES', 64 << 20))
+
+# when a queue is full, hold the batch and stop taking in more instead of dropping it,
+# so overload backs up to the socket and the senders, see BatchSender
+BACKPRESSURE = os.getenv('BACKPRESSURE', '').lower() in ['true', '1', 'yes']
+# how long a held batch waits for room in the queue between attempts
+STALL_WAIT_SEC = 0.01
+
+# sizes and deadlines of the batches can be changed at runtime in this file, see RuntimeConfig
+RUNTIME_CONFIG_FILE = os.getenv('RUNTIME_CONFIG_FILE', '/EDAF/runtime.json')
+RUNTIME_CONFIG_CHECK_SEC = 1.0
+
+# arrival rates are measured over windows of this length, see FlushPolicy
+RATE_WINDOW_SEC = 1.0
+# share of the maximum age a batch should fill in, at the measured rate
+FILL = 0.5
+
+def batch_depth(depth, batch_size):
+    # queue size in batches, for a queue of about depth items
+    return max(1, depth // batch_size)
+
+def lines_queue(depth):
+    # queue for batches of raw lines, about depth lines
+    if SHM_TRANSPORT:
+        return ShmRing(SHM_LINES_BYTES, LineCodec())
+    return Queue(batch_depth(depth, BATCH_LINES))
+
+def journeys_queue(depth, schema=None):
+    # queue for batches of about depth journeys. Journeys without a schema (nlmt) are dicts
+    if SHM_TRANSPORT and schema is not None:
+        return ShmRing(SHM_JOURNEYS_BYTES, BatchCodec(schema))
+    return Queue(batch_depth(depth, BATCH_JOURNEYS))
+
+def close_queue(items_queue):
+    if isinstance(items_queue, ShmRing):
+        items_queue.unlink()
+
+def get_batch(items_queue, timeout=None):
+    # blocks until a batch arrives, or returns [] once timeout expires (None waits forever)
+    try:
+        return items_queue.get(timeout=timeout)
+    except queue.Empty:
+        return []
+
+def get_batches(items_queue, max_items=None):
+    # the items of the batches that are in the queue now, without waiting.
+    # Drained with get_nowait, the queue's empty() is not reliable across processes
+    items = []
+    while max_items is None or len(items) < max_items:
+        try:
+            items.extend(items_queue.get_nowait())
+        except queue.Empty:
+            break
+    return items
+
+def time_left(since, linger):
+    # seconds until what is pending since `since` is due, None if nothing is pending
+    if since is None:
+        return None
+    return max(0.0, since + linger - time.monotonic())
+
+def earliest(*timeouts):
+    # the shortest of the timeouts, the None ones wait forever
+    timeouts = [timeout for timeout in timeouts if timeout is not None]
+    return min(timeouts) if timeouts else None
+
+class RuntimeConfig:
+    # A client's config, with the values of its section of RUNTIME_CONFIG_FILE over it,
+    # e.g. {"GNB": {"PROCESS_LINES": 200, "PROCESS_LINGER_SEC": 0.05}}. Only keys of the
+    # config can be set. The file is checked for changes every RUNTIME_CONFIG_CHECK_SEC.
+    def __init__(self, config, client_name, path=RUNTIME_CONFIG_FILE):
+        self.defaults = dict(config)
+        self.values = dict(config)
+        self.client_name = client_name
+        self.path = path
+        self.mtime = None
+        self.checked = -math.inf
+
+    def __getitem__(self, key):
+        self.reload()
+        return self.values[key]
+
+    def reload(self):
+        now = time.monotonic()
+        if now - self.checked < RUNTIME_CONFIG_CHECK_SEC:
+            return
+        self.checked = now
+        try:
+            mtime = os.stat(self.path).st_mtime
+        except OSError:
+            mtime = None
+        if mtime == self.mtime:
+            return
+        self.mtime = mtime
+        values = dict(self.defaults)
+        if mtime is not None:
+            try:
+                with open(self.path) as f:
+                    overrides = json.load(f).get(self.client_name, {})
+                values.update({ key : value for key, value in overrides.items() if key in self.defaults })
+            except (OSError, ValueError, AttributeError) as ex:
+                logger.warning(f"[{self.client_name}] could not read the runtime config {self.path}: {ex}")
+                return
+        changed = { key : value for key, value in values.items() if self.values[key] != value }
+        if changed:
+            logger.info(f"[{self.client_name}] runtime config: {changed}")
+        self.values = values
+
+class FlushPolicy:
+    # When a pending batch is due: once it holds size() items, or its oldest item waited
+    # max_age seconds. size() follows the measured arrival rate, what arrives in FILL of
+    # max_age, between min_size and max_size. So batches grow under load, and at low rates
+    # they go before the deadline. max_size and max_age are read from the runtime config
+    # under size_key and age_key on every check, they can change while running.
+    def __init__(self, runtime, size_key, age_key, min_size=1):
+        self.runtime = runtime
+        self.size_key = size_key
+        self.age_key = age_key
+        self.min_size = min_size
+        self.pending = 0
+        self.since = None
+        # items per second, None until the first window is measured
+        self.rate = None
+        self.window_start = time.monotonic()
+        self.window_count = 0
+
+    def arrived(self, n):
+        now = time.monotonic()
+        if self.since is None:
+            self.since = now
+        self.pending = self.pending + n
+        self.window_count = self.window_count + n
+        elapsed = now - self.window_start
+        if elapsed >= RATE_WINDOW_SEC:
+            rate = self.window_count / elapsed
+            self.rate = rate if self.rate is None else (self.rate + rate) / 2
+            self.window_start = now
+            self.window_count = 0
+
+    def size(self):
+        max_size = self.runtime[self.size_key]
+        if self.rate is None:
+            return max_size
+        return min(max_size, max(self.min_size, int(self.rate * self.runtime[self.age_key] * FILL)))
+
+    def remaining(self):
+        # seconds until the pending batch is due, None if there is none
+        return time_left(self.since, self.runtime[self.age_key])
+
+    def due(self):
+        return self.pending > 0 and (self.pending >= self.size() or self.remaining() == 0.0)
+
+    def flushed(self):
+        self.pending = 0
+        self.since = None
+
+class BatchSender:
+    # Collects items and puts them on a multiprocessing queue (or ShmRing) as one
+    # list, so a batch pays one pickle and pipe write. The batch goes when the flush
+    # policy says it is due, see FlushPolicy. A full queue drops the whole batch, or
+    # with backpressure the batch is held and the sender is stalled: the caller stops
+    # taking in items until wait (or flush, from asyncio) got it through.
+    # notify, an optional event, is set after every batch put, for a consumer that
+    # waits on several queues. metrics, optional series to count into, see SenderMetrics.
+    def __init__(self, out_queue, policy, notify=None, backpressure=False, metrics=None):
+        self.out_queue = out_queue
+        self.policy = policy
+        self.notify = notify
+        self.backpressure = backpressure
+        self.metrics = metrics
+        self.items = []
+        # items in the batch, a journey batch counts as its journeys
+        self.count = 0
+        self.stalled = False
+        self.published = 0
+        self.dropped = 0
+        # batches held for a full queue, and the seconds the sender was stalled
+        self.stalls = 0
+        self.stalled_sec = 0.0
+        self.stalled_since = None
+
+    def __len__(self):
+        return self.count
+
+    def add(self, items, count=None):
+        if len(items) == 0:
+            return
+        count = len(items) if count is None else count
+        self.items.extend(items)
+        self.count = self.count + count
+        self.policy.arrived(count)
+        if self.policy.due():
+            self.flush()
+
+    def remaining(self):
+        # seconds until the pending batch is due, None if there is none
+        return self.policy.remaining()
+
+    def poll(self):
+        # flushes the pending batch if it is due
+        if self.policy.due():
+            self.flush()
+
+    def flush(self):
+        self.policy.flushed()
+        if self.count == 0:
+            return
+        try:
+            self.out_queue.put_nowait(self.items)
+        except queue.Full:
+            if self.backpressure:
+                self.stall()
+                return
+            self.drop()
+        except ValueError as ex:
+            # a batch the queue can never take, e.g. larger than a ShmRing allows
+            logger.error(f"[batch sender] dropped {self.count} items: {ex}")
+            self.drop()
+        else:
+            self.sent()
+        self.items = []
+        self.count = 0
+
+    def wait(self):
+        # blocks until the held batch is put, with backpressure
+        while self.stalled:
+            try:
+                self.out_queue.put(self.items, timeout=STALL_WAIT_SEC)
+            except queue.Full:
+                continue
+            self.sent()
+            self.items = []
+            self.count = 0
+
+    def drop(self):
+        self.dropped = self.dropped + self.count
+        if self.metrics is not None:
+            self.metrics.dropped.inc(self.count)
+
+    def stall(self):
+        if not self.stalled:
+            self.stalled = True
+            self.stalls = self.stalls + 1
+            self.stalled_since = time.monotonic()
+
+    def sent(self):
+        self.published = self.published + self.count
+        if self.metrics is not None:
+            self.metrics.published.inc(self.count)
+            self.metrics.batch_size.observe(self.count)
+        if self.stalled:
+            self.stalled = False
+            stalled_sec = time.monotonic() - self.stalled_since
+            self.stalled_sec = self.stalled_sec + stalled_sec
+            if self.metrics is not None:
+                self.metrics.stalled_sec.inc(stalled_sec)
+        if self.notify is not None:
+            self.notify.set()
+
+class LineCodec:
+    # a batch of lines as one utf-8 buffer, decoded straight from the ring
+    def encode(self, lines):
+        return [np.frombuffer('\n'.join(lines).encode(), dtype=np.uint8)]
+
+    def decode(self, parts):
+        return str(parts[0], 'utf-8').split('\n')
+
+class BatchCodec:
+    # journey batches of a schema in their fixed layout, see JourneyBatch.buffers
+    def __init__(self, schema):
+        self.schema = schema
+
+    def encode(self, batches):
+        batch = batches[0] if len(batches) == 1 else self.schema.concat(batches)
+        return batch.buffers()
+
+    def decode(self, parts):
+        return [self.schema.from_buffers(parts)]
+
+# ring header, head and tail on their own cache lines next to the number of batches
+# put and got, and the flags of a waiting consumer and producer
+HEAD, TAIL, WAITING, PRODUCER_WAITING = 0, 8, 16, 24
+PUTS, GETS = HEAD + 1, TAIL + 1
+HEADER_BYTES = 256
+SKIP = (1 << 64) - 1
+ALIGN = 8
+WAIT_SLICE_SEC = 0.05
+
+def aligned(n):
+    return (n + ALIGN - 1) // ALIGN * ALIGN
+
+class ShmRing:
+    # Single producer, single consumer ring of batches in shared memory, with the
+    # put_nowait, get_nowait, get and empty of the multiprocessing queue it replaces.
+    # A batch is encoded by the codec into a few flat buffers that are copied into
+    # the ring, no pickling, and decoded from views of the ring on the consumer side,
+    # which copies the values out once: the batches outlive their slot, e.g. rows
+    # waiting in CombineUL, so the slot is released as soon as they are decoded.
+    # head and tail count the bytes ever written and read, a record is
+    # [length][number of parts][part lengths][parts, each 8 byte aligned]
+    # and a record that does not fit before the end of the ring starts over at 0.
+    # A consumer about to wait sets the waiting flag, and the producer only signals
+    # the event then, and the same the other way for a producer waiting for room.
+    # Waits are cut in WAIT_SLICE_SEC, so a wakeup missed between the two costs at most that.
+    # A record may take half the ring at most, a larger one might never fit before its
+    # own skip marker, and is rejected with a ValueError.
+    def __init__(self, size, codec):
+        self.size = aligned(size)
+        self.max_record = self.size // 2
+        self.codec = codec
+        self.shm = shared_memory.SharedMemory(create=True, size=HEADER_BYTES + self.size)
+        self.ready = multiprocessing.Event()
+        self.space = multiprocessing.Event()
+        self.attach()
+        self.header[:] = 0
+
+    def attach(self):
+        self.header = np.ndarray(HEADER_BYTES // 8, dtype=np.uint64, buffer=self.shm.buf)
+        self.data = np.ndarray(self.size, dtype=np.uint8, buffer=self.shm.buf, offset=HEADER_BYTES)
+        self.view = self.shm.buf[HEADER_BYTES:]
+
+    def __getstate__(self):
+        return { 'size' : self.size, 'codec' : self.codec, 'name' : self.shm.name, 'ready' : self.ready, 'space' : self.space }
+
+    def __setstate__(self, state):
+        self.size, self.codec, self.ready, self.space = state['size'], state['codec'], state['ready'], state['space']
+        self.shm = shared_memory.SharedMemory(name=state['name'])
+        self.attach()
+
+    def empty(self):
+        return int(self.header[HEAD]) == int(self.header[TAIL])
+
+    def qsize(self):
+        # batches in the ring
+        return int(self.header[PUTS]) - int(self.header[GETS])
+
+    def put_nowait(self, items):
+        parts = [
+            part.reshape(-1).view(np.uint8) if isinstance(part, np.ndarray) else np.frombuffer(part, dtype=np.uint8)
+            for part in self.codec.encode(items)
+        ]
+        table = np.array([len(parts)] + [len(part) for part in parts], dtype=np.uint64)
+        length = 8 + 8*len(table) + sum(aligned(len(part)) for part in parts)
+        if length > self.max_record:
+            raise ValueError(f"a batch of {length} bytes does not fit a ring of {self.size} bytes")
+        head, tail = int(self.header[HEAD]), int(self.header[TAIL])
+        pos = head % self.size
+        skip = self.size - pos if self.size - pos < length else 0
+        if skip + length > self.size - (head - tail):
+            raise queue.Full
+        if skip:
+            self.data[pos:pos+8].view(np.uint64)[0] = SKIP
+            head, pos = head + skip, 0
+        self.data[pos:pos+8].view(np.uint64)[0] = length
+        at = pos + 8
+        self.data[at:at+8*len(table)] = table.view(np.uint8)
+        at = at + 8*len(table)
+        for part in parts:
+            self.data[at:at+len(part)] = part
+            at = at + aligned(len(part))
+        self.header[HEAD] = head + length
+        self.header[PUTS] = self.header[PUTS] + 1
+        if self.header[WAITING]:
+            self.ready.set()
+
+    def get_nowait(self):
+        head, tail = int(self.header[HEAD]), int(self.header[TAIL])
+        if head == tail:
+            raise queue.Empty
+        pos = tail % self.size
+        length, = struct.unpack_from('<Q', self.view, pos)
+        if length == SKIP:
+            tail, pos = tail + self.size - pos, 0
+            length, = struct.unpack_from('<Q', self.view, pos)
+        nparts, = struct.unpack_from('<Q', self.view, pos + 8)
+        lengths = struct.unpack_from(f'<{nparts}Q', self.view, pos + 16)
+        at = pos + 16 + 8*nparts
+        parts = []
+        for part_length in lengths:
+            parts.append(self.view[at:at+part_length])
+            at = at + aligned(part_length)
+        try:
+            items = self.codec.decode(parts)
+        finally:
+            for part in parts:
+                part.release()
+        self.header[TAIL] = tail + length
+        self.header[GETS] = self.header[GETS] + 1
+        if self.header[PRODUCER_WAITING]:
+            self.space.set()
+        return items
+
+    def put(self, items, block=True, timeout=None):
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            try:
+                return self.put_nowait(items)
+            except queue.Full:
+                if not block:
+                    raise
+            self.space.clear()
+            self.header[PRODUCER_WAITING] = 1
+            try:
+                return self.put_nowait(items)
+            except queue.Full:
+                remaining = WAIT_SLICE_SEC if deadline is None else min(WAIT_SLICE_SEC, max(0.0, deadline - time.monotonic()))
+                self.space.wait(remaining)
+            finally:
+                self.header[PRODUCER_WAITING] = 0
+            if deadline is not None and time.monotonic() >= deadline:
+                raise queue.Full
+
+    def get(self, block=True, timeout=None):
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            if not self.empty():
+                return self.get_nowait()
+            if not block:
+                raise queue.Empty
+            self.ready.clear()
+            self.header[WAITING] = 1
+            if self.empty():
+                remaining = WAIT_SLICE_SEC if deadline is None else min(WAIT_SLICE_SEC, max(0.0, deadline - time.monotonic()))
+                self.ready.wait(remaining)
+            self.header[WAITING] = 0
+            if deadline is not None and time.monotonic() >= deadline and self.empty():
+                raise queue.Empty
+
+    def __del__(self):
+        # the views of the segment must go before it is closed
+        if getattr(self, 'header', None) is not None:
+            self.close()
+
+    def close(self):
+        self.view.release()
+        self.header, self.data, self.view = None, None, None
+        self.shm.close()
+
+    def unlink(self):
+        self.close()
+        self.shm.unlink()
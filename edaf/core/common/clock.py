@@ -0,0 +1,86 @@
+import math
+from collections import deque
+import numpy as np
+
+DEFAULT_CLOCK_WINDOW = 100 # sync samples
+
+class ClockModel:
+    # Least-squares fit of wall clock time (ns) against rdtsc cycles, over the
+    # last `window` sync samples, or over all of them if window is None.
+    # Samples are shifted by the first one and the sums are kept as python
+    # ints, so adding or evicting a sample is O(1) and exact, whatever the
+    # length of the run.
+    def __init__(self, window=DEFAULT_CLOCK_WINDOW):
+        self.window = window
+        self.samples = deque()
+        self.origin = None
+        self.last_cycles = None
+        self.n = 0
+        self.sx = 0
+        self.sy = 0
+        self.sxx = 0
+        self.sxy = 0
+        self.syy = 0
+        # fitted model: time_ns = origin ns + intercept + slope * (cycles - origin cycles)
+        self.slope = None
+        self.intercept = None
+        self.residual = None
+
+    def __len__(self):
+        return self.n
+
+    def ready(self):
+        return self.slope is not None
+
+    def add(self, cycles, time_ns):
+        # sync samples have to move forward, repeated or older ones are dropped
+        if self.last_cycles is not None and cycles <= self.last_cycles:
+            return False
+        self.last_cycles = cycles
+        if self.origin is None:
+            self.origin = (cycles, time_ns)
+        x = cycles - self.origin[0]
+        y = time_ns - self.origin[1]
+        self._update(x, y, 1)
+        if self.window is not None:
+            self.samples.append((x, y))
+            if len(self.samples) > self.window:
+                self._update(*self.samples.popleft(), -1)
+        return True
+
+    def _update(self, x, y, sign):
+        self.n = self.n + sign
+        self.sx = self.sx + sign*x
+        self.sy = self.sy + sign*y
+        self.sxx = self.sxx + sign*x*x
+        self.sxy = self.sxy + sign*x*y
+        self.syy = self.syy + sign*y*y
+
+    def fit(self):
+        n = self.n
+        dxx = n*self.sxx - self.sx*self.sx
+        if n < 2 or dxx == 0:
+            return False
+        dxy = n*self.sxy - self.sx*self.sy
+        dyy = n*self.syy - self.sy*self.sy
+        self.slope = dxy/dxx
+        self.intercept = (self.sy*dxx - self.sx*dxy)/(n*dxx)
+        # root mean square distance of the samples to the fitted line, in ns
+        self.residual = math.sqrt(max(dyy*dxx - dxy*dxy, 0)/(dxx*n*n))
+        return True
+
+    def to_ns(self, cycles):
+        # cycles: int64 numpy array, returns int64 ns
+        elapsed = (cycles - self.origin[0]).astype(np.float64)
+        return self.origin[1] + np.rint(elapsed*self.slope + self.intercept).astype(np.int64)
+
+    def metrics(self):
+        if not self.ready():
+            return { 'samples' : self.n }
+        return {
+            'samples' : self.n,
+            'offset_cycles' : self.origin[0],
+            'offset_ns' : self.origin[1] + int(round(self.intercept)),
+            'frequency_hz' : 1.0e9/self.slope,
+            'residual_ns' : self.residual,
+        }
@@ -0,0 +1,102 @@
+from bisect import bisect_left, bisect_right, insort
+from collections import deque
+
+class IntervalBucket:
+    # Buffer ranges [start, end] kept sorted by start, so a containment query
+    # only visits the ranges that begin at or before the queried range.
+    def __init__(self):
+        self.arrivals = deque()
+        self.starts = []
+        self.entries = {}
+
+    def __len__(self):
+        return len(self.arrivals)
+
+    def append(self, seq, start, end, item):
+        insort(self.starts, (start, seq))
+        self.entries[seq] = (end, item)
+        self.arrivals.append((seq, start))
+
+    def popleft(self):
+        seq, start = self.arrivals.popleft()
+        del self.starts[bisect_left(self.starts, (start, seq))]
+        del self.entries[seq]
+
+    def containing(self, lo, hi):
+        # newest (seq, item) whose range contains [lo, hi]
+        best = None
+        for _, seq in self.starts[:bisect_right(self.starts, (lo, float('inf')))]:
+            end, item = self.entries[seq]
+            if end >= hi and (best is None or seq > best[0]):
+                best = (seq, item)
+        return best
+
+class WindowIndex:
+    # Hash index over the last `depth` lines of a stream.
+    # Every line advances the window by one sequence number. Events found on
+    # that line are stored once per table under their join key, and dropped
+    # again when the line falls out of the lookback window.
+    def __init__(self, depth):
+        self.depth = depth
+        self.seq = -1
+        self.tables = {}
+        self.order = deque()
+
+    def __len__(self):
+        # number of lines currently covered by the window
+        return min(self.seq + 1, self.depth)
+
+    def advance(self):
+        self.seq = self.seq + 1
+        limit = self.seq - self.depth
+        while self.order and self.order[0][0] <= limit:
+            _, name, key = self.order.popleft()
+            table = self.tables[name]
+            entries = table[key]
+            entries.popleft()
+            if not entries:
+                del table[key]
+        return self.seq
+
+    def add(self, name, key, item):
+        table = self.tables.setdefault(name, {})
+        entries = table.get(key)
+        if entries is None:
+            entries = deque()
+            table[key] = entries
+        entries.append((self.seq, item))
+        self.order.append((self.seq, name, key))
+
+    def add_interval(self, name, key, start, end, item):
+        table = self.tables.setdefault(name, {})
+        bucket = table.get(key)
+        if bucket is None:
+            bucket = IntervalBucket()
+            table[key] = bucket
+        bucket.append(self.seq, start, end, item)
+        self.order.append((self.seq, name, key))
+
+    def containing(self, name, key, lo, hi):
+        # newest (seq, item) stored under key whose range contains [lo, hi]
+        bucket = self.tables.get(name, {}).get(key)
+        if not bucket:
+            return None
+        return bucket.containing(lo, hi)
+
+    def latest(self, name, key, before=None):
+        # newest (seq, item) stored under key, optionally older than `before`
+        entries = self.tables.get(name, {}).get(key)
+        if not entries:
+            return None
+        if before is None:
+            return entries[-1]
+        for entry in reversed(entries):
+            if entry[0] < before:
+                return entry
+        return None
+
+    def newest_first(self, name, key):
+        entries = self.tables.get(name, {}).get(key)
+        if not entries:
+            return []
+        return list(reversed(entries))
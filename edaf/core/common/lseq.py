@@ -0,0 +1,87 @@
+import re
+
+# numeric properties that appear in the lseq lines, e.g. 'len100', 'sn5' or 'M1buf2948457229'.
+# 'leno' has to come before 'len', otherwise 'leno6' would be read as 'len'.
+FIELDS = (
+    'leno', 'len', 'srn', 'sn', 'tbs', 'queue',
+    'SBuf', 'PBuf', 'PIBuf', 'Pbuf', 'PCbuf', 'R1buf', 'R2buf', 'MRbuf',
+    'M1buf', 'M2buf', 'M3buf', 'Hbuf', 'ENTno',
+    'fm', 'sl', 'lcid', 'hqpid', 'hqround', 'ldpciter', 'mcs',
+    'mod_or', 'nb_sym', 'nb_rb',
+)
+FIELD_RE = re.compile(r'(' + '|'.join(FIELDS) + r')(\d+)')
+RNTI_RE = re.compile(r'rnti([0-9a-fA-F]+)')
+
+def seconds_to_ns(text):
+    # '1723214207.122027' -> 1723214207122027000, without going through a float
+    whole, _, frac = text.partition('.')
+    return int(whole) * 1_000_000_000 + int((frac + '000000000')[:9])
+
+class LseqRecord:
+    # One lseq line, parsed once.
+    # cycles: rdtsc cycles as read from the file, None if the line already had wall clock time
+    # time_ns, timestamp: wall clock time in integer nanoseconds and float seconds,
+    #   None until the cycles are converted, see rdtsctotsOnline
+    # direction: 'U', 'D' or 'S' for the clock sync lines
+    # src, event: the measurement points of 'src--event'
+    # fields: the first value of every numeric property in the line
+    # payload: the line without its timestamp
+    __slots__ = ('cycles', 'time_ns', 'timestamp', 'direction', 'src', 'event', 'fields', 'rnti', 'payload')
+
+    def __init__(self, cycles, time_ns, direction, src, event, fields, rnti, payload):
+        self.cycles = cycles
+        self.time_ns = time_ns
+        self.timestamp = time_ns/1.0e9 if time_ns is not None else None
+        self.direction = direction
+        self.src = src
+        self.event = event
+        self.fields = fields
+        self.rnti = rnti
+        self.payload = payload
+
+    def touches(self, point):
+        return point == self.event or point == self.src
+
+    def sync_time_ns(self):
+        # wall clock nanoseconds reported by an 'S' line
+        return seconds_to_ns(self.payload.split()[2])
+
+    def __repr__(self):
+        return f"LseqRecord({self.cycles}, {self.time_ns}, {self.payload!r})"
+
+def tokenize(line):
+    # returns None for comments and lines that do not start with a numeric timestamp
+    line = line.rstrip('\n')
+    if line.startswith('#'):
+        return None
+    parts = line.split(' ', 1)
+    if len(parts) < 2:
+        return None
+    first, payload = parts
+    if first.isnumeric():
+        cycles, time_ns = int(first), None
+    else:
+        try:
+            cycles, time_ns = None, seconds_to_ns(first)
+        except ValueError:
+            return None
+
+    tokens = payload.split(None, 2)
+    direction = tokens[0] if tokens else ''
+    src, event = '', ''
+    if '--' in payload:
+        points = tokens[1] if len(tokens) > 1 else ''
+        if '--' not in points:
+            points = next(token for token in payload.split() if '--' in token)
+        src, _, event = points.partition('--')
+
+    # walk the matches backwards, so the first occurrence of a property wins
+    fields = {name: int(value) for name, value in reversed(FIELD_RE.findall(payload))}
+
+    rnti = None
+    if 'rnti' in payload:
+        rnti_match = RNTI_RE.search(payload)
+        if rnti_match:
+            rnti = rnti_match.group(1)
+
+    return LseqRecord(cycles, time_ns, direction, src, event, fields, rnti, payload)
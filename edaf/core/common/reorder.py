@@ -0,0 +1,53 @@
+import heapq, itertools
+
+DEFAULT_REORDER_SLACK_NS = 20_000_000 # 20 ms
+
+class ReorderBuffer:
+    # Min-heap of records keyed by event time (record.time_ns).
+    # A record is released once the watermark, the newest time seen minus
+    # slack_ns, has passed it. Lines that arrive up to slack_ns late, also
+    # across batches, still come out in order.
+    def __init__(self, slack_ns=DEFAULT_REORDER_SLACK_NS):
+        self.slack_ns = slack_ns
+        self.heap = []
+        # arrival order, breaks ties between records with the same time
+        self.counter = itertools.count()
+        self.max_seen = None
+        self.last_released = None
+        # records that arrived after the watermark had passed them
+        self.late = 0
+
+    def __len__(self):
+        return len(self.heap)
+
+    def watermark(self):
+        if self.max_seen is None:
+            return None
+        return self.max_seen - self.slack_ns
+
+    def push(self, records):
+        for record in records:
+            time_ns = record.time_ns
+            if self.last_released is not None and time_ns < self.last_released:
+                self.late = self.late + 1
+            heapq.heappush(self.heap, (time_ns, next(self.counter), record))
+            if self.max_seen is None or time_ns > self.max_seen:
+                self.max_seen = time_ns
+
+    def pop_ready(self):
+        # records behind the watermark, in time order
+        watermark = self.watermark()
+        released = []
+        while self.heap and self.heap[0][0] <= watermark:
+            time_ns, _, record = heapq.heappop(self.heap)
+            released.append(record)
+        if released:
+            self.last_released = max(time_ns, self.last_released or time_ns)
+        return released
+
+    def flush(self):
+        # everything that is left, in time order
+        released = [heapq.heappop(self.heap)[2] for _ in range(len(self.heap))]
+        if released:
+            self.last_released = max(released[-1].time_ns, self.last_released or released[-1].time_ns)
+        return released
@@ -1,52 +1,82 @@
+import numpy as np
 from loguru import logger
-
-def get_lines_containing_s(inp_lines):
-        return [line for line in inp_lines if ' S ' in line]
+from edaf.core.common.lseq import tokenize
+from edaf.core.common.clock import ClockModel, DEFAULT_CLOCK_WINDOW
 
 class rdtsctotsOnline():
 
-    def __init__(self,name) -> None:
+    def __init__(self, name, window=DEFAULT_CLOCK_WINDOW) -> None:
         self.name = name
-        self.s_lines = list()
-        self.offset_cpufreq = None
-
-    def _update_offset_cpufreq(self):
-        first_S = self.s_lines[0].split()
-        last_S = self.s_lines[-1].split()
-        cycle_offset = int(first_S[0])
-        time_offset = float(first_S[3])
-        cpufreq = int((int(last_S[0]) - int(first_S[0]))/(float(last_S[3]) - float(first_S[3])))
-        self.offset_cpufreq = (cycle_offset, time_offset, cpufreq)
-    
-    def return_rdtsctots(self, lines : str):
-        # split and filter input lines
-        #lines = unsplitted_lines.splitlines()
-        lines = [line for line in lines if not line.startswith('#')]
-
-        # get S lines
-        new_slines = get_lines_containing_s(lines)
-        if len(new_slines) > 0:
-            self.s_lines = [ *self.s_lines, *new_slines ]
-            # remove duplicates
-            self.s_lines = list(dict.fromkeys(self.s_lines))
+        # fitted from the clock sync 'S' lines
+        self.clock = ClockModel(window)
+
+    def metrics(self):
+        return self.clock.metrics()
+
+    def _add_sync_samples(self, samples):
+        # add the new sync samples in cycle order, repeated ones are dropped
+        for cycles, time_ns in sorted(samples):
+            self.clock.add(cycles, time_ns)
+        if len(samples) > 0:
+            self.clock.fit()
+            logger.debug(f"{self.name} clock: {self.clock.metrics()}")
+
+    def calibrate(self, lines):
+        # fit the clock from the sync 'S' lines only, e.g. in a pass over a whole file before converting it
+        samples = []
+        for l in lines:
+            if ' S ' in l:
+                record = tokenize(l)
+                if record is not None and record.cycles is not None and record.direction == 'S':
+                    samples.append((record.cycles, record.sync_time_ns()))
+        self._add_sync_samples(samples)
+
+    def return_arrays(self, lines, sort=True):
+        # parse the lines once and convert the whole batch at once
+        # returns (cycles int64, time in ns int64, LseqRecords), sorted by time
+        # unless sort is False, e.g. when a ReorderBuffer orders them later.
+        # Lines that already have their wall clock time keep it, with cycles -1
+        records = []
+        new_slines = []
+        for l in lines:
+            if l.startswith('#'):
+                continue
+            record = tokenize(l)
+            if record is None:
+                if len(l.split(" ", 1)) > 1:
+                    logger.warning(f"non-numeric first element in {self.name} lseq: {l}")
+                else:
+                    logger.warning(f"unusual line in {self.name} lseq: {l}")
+                continue
+            if record.direction == 'S' and record.cycles is not None:
+                new_slines.append((record.cycles, record.sync_time_ns()))
+            records.append(record)
+
+        self._add_sync_samples(new_slines)
 
         # check we have minimum 2 s lines
-        if len(self.s_lines) < 2:
+        if not self.clock.ready() and any(record.cycles is not None for record in records):
             logger.warning("Waiting for CPU frequency info...")
-            return []
-        
-        self._update_offset_cpufreq()
-
-        # process the lines
-        offset, time0, cpufreq = self.offset_cpufreq
-        newlines = []
-        for l in lines:  # Compute and replace rdtsc value by gettimeofday
-            tmp = l.split(" ", 1)
-            if len(tmp) > 1:
-                if tmp[0].isnumeric():
-                    newlines.append(f"%.6f {tmp[1]}" % ((int(tmp[0]) - offset)/cpufreq + time0))
-                else:
-                    logger.warning(f"non-numeric first element in {self.name} lseq: {l}")
-            else:
-                logger.warning(f"unusual line in {self.name} lseq: {l}")
-        return sorted(newlines)
+            records = [record for record in records if record.cycles is None]
+
+        # Compute rdtsc values to gettimeofday in ns
+        cycles = np.fromiter((-1 if record.cycles is None else record.cycles for record in records), dtype=np.int64, count=len(records))
+        time_ns = np.fromiter((0 if record.cycles is not None else record.time_ns for record in records), dtype=np.int64, count=len(records))
+        rdtsc = cycles >= 0
+        if rdtsc.any():
+            time_ns[rdtsc] = self.clock.to_ns(cycles[rdtsc])
+        record_array = np.empty(len(records), dtype=object)
+        record_array[:] = records
+        if not sort:
+            return cycles, time_ns, record_array
+        order = np.argsort(time_ns, kind='stable')
+        return cycles[order], time_ns[order], record_array[order]
+
+    def return_records(self, lines, sort=True):
+        # same as return_arrays, as a list of LseqRecords with time_ns and timestamp (seconds) set
+        _, time_ns, records = self.return_arrays(lines, sort)
+        records = records.tolist()
+        for record, ns in zip(records, time_ns.tolist()):
+            record.time_ns = ns
+            record.timestamp = ns/1.0e9
+        return records
@@ -1,9 +1,13 @@
 import pandas as pd
 import numpy as np
 from loguru import logger
-from collections import OrderedDict
+from collections import OrderedDict, deque
+from bisect import bisect_left, bisect_right
+import math
 import sys
 
+from edaf.core.uplink.schema import UL_SCHEMA, NLMT_SCHEMA, UE_SCHEMA, GNB_SCHEMA
+
 import os
 if not os.getenv('DEBUG'):
     logger.remove()
@@ -11,6 +15,22 @@ if not os.getenv('DEBUG'):
 
 TS_TIME_MARGIN = 0.0010 # 1ms
 DEFAULT_MAX_DEPTH = 500
+JOIN_WINDOW = 0.5 # seconds between the ue and gnb events of a journey
+
+# rlc sn the ue and gnb journeys are combined on
+UE_KEY = 'rlc.queue.segments.0.rlc.txpdu.srn'
+GNB_KEY = 'gtp.out.sn'
+
+def batch_keys(batch, name):
+    # (row, key) of the journeys in the batch that have the key
+    keys = batch.column(name)
+    rows = np.flatnonzero(~np.isnan(keys))
+    return list(zip(rows.tolist(), keys[rows].astype(np.int64).tolist()))
+
+def combine_batches(entries):
+    # combined journeys of (nlmt entry, ue row, gnb row) triples, see JourneyBatch.row
+    nlmt, ue, gnb = zip(*entries) if entries else ((), (), ())
+    return UL_SCHEMA.join([NLMT_SCHEMA.batch(nlmt), UE_SCHEMA.stack(ue), GNB_SCHEMA.stack(gnb)])
 
 class FixSizeOrderedDict(OrderedDict):
     def __init__(self, *args, max=0, **kwargs):
@@ -25,29 +45,95 @@ class FixSizeOrderedDict(OrderedDict):
                 self.popitem(False)
 
 
-def flatten_dict(d, parent_key='', sep='.'):
-    items = {}
-    for key, value in d.items():
-        new_key = f"{parent_key}{sep}{key}" if parent_key else key
-        if isinstance(value, dict):
-            items.update(flatten_dict(value, new_key, sep=sep))
-        elif isinstance(value, list):
-            for i, item in enumerate(value):
-                if isinstance(item, dict):
-                    items.update(flatten_dict(item, f"{new_key}{sep}{i}", sep=sep))
-                else:
-                    items[f"{new_key}{sep}{i}"] = item
+class NlmtTimeIndex:
+    # nlmt entries by seqno, with their send timestamps kept sorted for nearest lookups.
+    # Behaves like FixSizeOrderedDict(max): iterates in insertion order and drops the
+    # oldest inserted entries once it holds more than max. Deleted and evicted entries
+    # are left in the sorted lists as tombstones, and compacted away in bulk.
+    def __init__(self, max=0):
+        self._max = max
+        # seqno -> (entry, token of its timestamp in the lists below, token of its insertion)
+        self.entries = {}
+        self.times = []
+        self.keys = []
+        self.insertions = deque()
+        self.tokens = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __iter__(self):
+        return iter(list(self.entries))
+
+    def __contains__(self, seqno):
+        return seqno in self.entries
+
+    def __getitem__(self, seqno):
+        return self.entries[seqno][0]
+
+    def keys(self):
+        return list(self.entries)
+
+    def __setitem__(self, seqno, entry):
+        self.tokens = self.tokens + 1
+        token = self.tokens
+        if seqno in self.entries:
+            # keep its place in the insertion order, like an OrderedDict
+            self.entries[seqno] = (entry, token, self.entries[seqno][2])
+        else:
+            self.entries[seqno] = (entry, token, token)
+            self.insertions.append((token, seqno))
+        timestamp = entry['send.timestamp']
+        if not self.times or timestamp >= self.times[-1]:
+            self.times.append(timestamp)
+            self.keys.append((token, seqno))
         else:
-            items[new_key] = value
-    return items
+            i = bisect_right(self.times, timestamp)
+            self.times.insert(i, timestamp)
+            self.keys.insert(i, (token, seqno))
+        if self._max > 0:
+            while len(self.entries) > self._max:
+                logger.debug("ul combine buffer is full, poping items")
+                inserted, oldest = self.insertions.popleft()
+                if self.entries.get(oldest, (None, None, None))[2] == inserted:
+                    del self.entries[oldest]
+        self._compact()
 
-def closest_nlmt_entry_uplink(ue_timestamp, nlmt_dict):
-    for seqno in nlmt_dict:
-        entry = nlmt_dict[seqno]
-        send_timestamp = entry['send.timestamp']
-        if abs(ue_timestamp-send_timestamp) < TS_TIME_MARGIN:
-            return seqno,entry
-    return None,None
+    def __delitem__(self, seqno):
+        del self.entries[seqno]
+        self._compact()
+
+    def _alive(self, i):
+        token, seqno = self.keys[i]
+        return self.entries.get(seqno, (None, None, None))[1] == token
+
+    def _compact(self):
+        # drop the tombstones once they are the majority, O(1) amortized
+        if len(self.times) > 2*len(self.entries) + 16:
+            alive = [i for i in range(len(self.times)) if self._alive(i)]
+            self.times = [self.times[i] for i in alive]
+            self.keys = [self.keys[i] for i in alive]
+            self.insertions = deque(
+                (inserted, seqno) for inserted, seqno in self.insertions
+                if self.entries.get(seqno, (None, None, None))[2] == inserted
+            )
+
+    def closest(self, timestamp, margin=TS_TIME_MARGIN):
+        # (seqno, entry) sent closest to timestamp within margin, (None, None) if there is none
+        best, best_distance = None, margin
+        i = bisect_left(self.times, timestamp)
+        # walk outwards from the insertion point in both directions
+        for step, stop in ((-1, -1), (1, len(self.times))):
+            j = i - 1 if step < 0 else i
+            while j != stop and abs(self.times[j] - timestamp) < best_distance:
+                if self._alive(j):
+                    best, best_distance = j, abs(self.times[j] - timestamp)
+                    break
+                j = j + step
+        if best is None:
+            return None, None
+        seqno = self.keys[best][1]
+        return seqno, self.entries[seqno][0]
 
 class CombineUL:
     def __init__(self, max_depth=DEFAULT_MAX_DEPTH, standalone=False):
@@ -55,45 +141,31 @@ class CombineUL:
         if not standalone:
             self.gnbjourneys_dict = FixSizeOrderedDict(max=max_depth)
             self.uejourneys_dict = FixSizeOrderedDict(max=max_depth)
-            self.nlmtjourneys_dict = FixSizeOrderedDict(max=max_depth)
+            self.nlmtjourneys_dict = NlmtTimeIndex(max=max_depth)
         else:
             self.gnbjourneys_dict, self.uejourneys_dict = None, None
-            self.nlmtjourneys_dict = FixSizeOrderedDict(max=max_depth)
+            self.nlmtjourneys_dict = NlmtTimeIndex(max=max_depth)
 
     def run(self,upfjourneys_data, gnbjourneys_data = None, uejourneys_data = None):
 
         if not self.standalone:
-            for entry in gnbjourneys_data:
-                try:
-                    self.gnbjourneys_dict[entry['gtp.out']['sn']] = entry
-                except:
-                    pass
-
-            for entry in uejourneys_data:
-                try:
-                    self.uejourneys_dict[entry['rlc.queue']['segments'][0]['rlc.txpdu']['srn']] = entry
-                except:
-                    pass
+            # journey batches, rows are keyed by rlc sn, the ones without it are skipped
+            for batch in gnbjourneys_data:
+                for i, sn in batch_keys(batch, GNB_KEY):
+                    self.gnbjourneys_dict[sn] = batch.row(i)
+
+            for batch in uejourneys_data:
+                timestamps = batch.column('ip.in.timestamp')
+                for i, sn in batch_keys(batch, UE_KEY):
+                    self.uejourneys_dict[sn] = (timestamps[i], batch.row(i))
 
         for entry in upfjourneys_data:
-            # online data
-            if 'st' in list(entry.keys()):
-                self.nlmtjourneys_dict[entry['seq']] = {
-                    'seqno': entry['seq'],
-                    'send.timestamp': np.float64(entry['st'])/1.0e9, 
-                    'receive.timestamp': np.float64(entry['rt'])/1.0e9,
-                }
-            elif 'seqno' in list(entry.keys()):
-                # data read from json file
-                if 'wall' in list(entry['timestamps']['client']['send'].keys()):
-                    if 'wall' in list(entry['timestamps']['server']['receive'].keys()):
-                        self.nlmtjourneys_dict[entry['seqno']] = {
-                            'seqno': entry['seqno'],
-                            'send.timestamp': np.float64(entry['timestamps']['client']['send']['wall'])/1.0e9, 
-                            'receive.timestamp': np.float64(entry['timestamps']['server']['receive']['wall'])/1.0e9,
-                        }
-            else:
+            # online data or data read from json file, see nlmt_entry_uplink
+            if 'st' not in entry and 'seqno' not in entry:
                 return None
+            nlmt_entry = nlmt_entry_uplink(entry)
+            if nlmt_entry is not None:
+                self.nlmtjourneys_dict[nlmt_entry['seqno']] = nlmt_entry
 
         #logger.debug('---------------------')
         #logger.debug('gnb:')
@@ -111,23 +183,23 @@ class CombineUL:
         if self.standalone:
             for seqno in self.nlmtjourneys_dict:
                 nlmt_entry = self.nlmtjourneys_dict[seqno]
-                combined_dict[seqno] = flatten_dict(nlmt_entry, parent_key='', sep='.')
+                combined_dict[seqno] = nlmt_entry
                 del_arr_nlmt.append(seqno)
 
             for delkey in del_arr_nlmt:
                 del self.nlmtjourneys_dict[delkey]
 
-            return pd.DataFrame(combined_dict).T  # Transpose to have keys as columns
+            return NLMT_SCHEMA.frame(list(combined_dict.values()), index=list(combined_dict))
 
         # Combine non-standalone
         for uekey in self.uejourneys_dict:
-            ue_entry = self.uejourneys_dict[uekey]
+            ue_timestamp, ue_entry = self.uejourneys_dict[uekey]
             if uekey in self.gnbjourneys_dict:
                 gnb_entry = self.gnbjourneys_dict[uekey]
                 # find the closest nlmt send and receive timestamps
-                nlmt_key,nlmt_entry = closest_nlmt_entry_uplink(ue_entry['ip.in']['timestamp'], self.nlmtjourneys_dict)
+                nlmt_key,nlmt_entry = self.nlmtjourneys_dict.closest(ue_timestamp)
                 if nlmt_entry:
-                    combined_dict[uekey] = flatten_dict(nlmt_entry, parent_key='', sep='.') | flatten_dict(ue_entry, parent_key='', sep='.') | flatten_dict(gnb_entry, parent_key='', sep='.')
+                    combined_dict[uekey] = (nlmt_entry, ue_entry, gnb_entry)
                     del_arr.append(uekey)
                     del_arr_nlmt.append(nlmt_key)
                 else:
@@ -140,7 +212,201 @@ class CombineUL:
             del self.gnbjourneys_dict[delkey]
 
         for delkey in del_arr_nlmt:
-            if delkey in list(self.nlmtjourneys_dict.keys()):
+            if delkey in self.nlmtjourneys_dict:
                 del self.nlmtjourneys_dict[delkey]
 
-        return pd.DataFrame(combined_dict).T  # Transpose to have keys as columns
+        # one row per ue key, in the declared journey schema
+        return combine_batches(list(combined_dict.values())).frame(index=list(combined_dict))
+
+
+def nlmt_entry_uplink(entry):
+    # nlmt trip in the form the journeys are combined with, None if it has no wall clock timestamps
+    if 'st' in entry:
+        # online data
+        return {
+            'seqno': entry['seq'],
+            'send.timestamp': np.float64(entry['st'])/1.0e9,
+            'receive.timestamp': np.float64(entry['rt'])/1.0e9,
+        }
+    elif 'seqno' in entry:
+        # data read from json file
+        if 'wall' in entry['timestamps']['client']['send'] and 'wall' in entry['timestamps']['server']['receive']:
+            return {
+                'seqno': entry['seqno'],
+                'send.timestamp': np.float64(entry['timestamps']['client']['send']['wall'])/1.0e9,
+                'receive.timestamp': np.float64(entry['timestamps']['server']['receive']['wall'])/1.0e9,
+            }
+    return None
+
+class TimeJoinUL:
+    # Streaming join of time ordered nlmt, gnb and ue journeys, for offline data.
+    # A ue journey is matched to the gnb journey with the same rlc sn that is closest
+    # in time within join_window, and to the nlmt trip sent closest to it within
+    # TS_TIME_MARGIN. It is resolved once the gnb and nlmt watermarks, the newest
+    # times pushed, have passed it by those windows. The resolved ue journeys are
+    # matched at once with sorted as-of joins, and every gnb journey and nlmt trip
+    # is used by one ue journey at most, the closest one.
+    # gnb journeys and nlmt trips are evicted once no pending or later ue journey can
+    # match them anymore, so memory is bounded by the windows and not by the batch sizes.
+    def __init__(self, join_window=JOIN_WINDOW):
+        self.join_window = join_window
+        self.watermarks = { 'NLMT' : -math.inf, 'GNB' : -math.inf, 'UE' : -math.inf }
+        # (timestamp, sn, batch row) of the ue journeys waiting for their matches
+        self.ue_pending = deque()
+        # gnb journeys and nlmt trips in time order, the ones before the start index are evicted
+        self.gnb = TimeColumns()
+        self.nlmt = TimeColumns()
+        self.stats = { 'combined' : 0, 'no_gnb' : 0, 'no_nlmt' : 0, 'unmatched_gnb' : 0, 'unmatched_nlmt' : 0, 'invalid' : 0 }
+
+    def watermark(self, name):
+        return self.watermarks[name]
+
+    def finish(self, name):
+        # no more journeys will come from this source
+        self.watermarks[name] = math.inf
+
+    def push(self, name, journeys):
+        # ue and gnb journeys come in batches, nlmt trips one by one
+        if name == 'UE' or name == 'GNB':
+            self._push_batch(name, journeys)
+            return
+        for journey in journeys:
+            try:
+                entry = nlmt_entry_uplink(journey)
+                if entry is None:
+                    continue
+                timestamp = entry['send.timestamp']
+                self.nlmt.append(timestamp, 0, entry)
+            except (KeyError, IndexError, TypeError):
+                self.stats['invalid'] = self.stats['invalid'] + 1
+                continue
+            self.watermarks[name] = max(self.watermarks[name], timestamp)
+
+    def _push_batch(self, name, batch):
+        # journeys without the rlc sn can not be joined
+        keys = batch_keys(batch, UE_KEY if name == 'UE' else GNB_KEY)
+        self.stats['invalid'] = self.stats['invalid'] + len(batch) - len(keys)
+        if not keys:
+            return
+        timestamps = batch.column('ip.in.timestamp' if name == 'UE' else 'gtp.out.timestamp').tolist()
+        for i, sn in keys:
+            if name == 'UE':
+                self.ue_pending.append((timestamps[i], sn, batch.row(i)))
+            else:
+                self.gnb.append(timestamps[i], sn, batch.row(i))
+        self.watermarks[name] = max(self.watermarks[name], max(timestamps[i] for i, _ in keys))
+
+    def pop_ready(self):
+        # combined journeys of the ue journeys the watermarks have passed, as a dataframe in time order
+        horizon = min(self.watermarks['GNB'] - self.join_window, self.watermarks['NLMT'] - TS_TIME_MARGIN)
+        ready = []
+        while self.ue_pending and self.ue_pending[0][0] <= horizon:
+            ready.append(self.ue_pending.popleft())
+        combined = self._combine(ready) if ready else UL_SCHEMA.frame([])
+        self._evict()
+        return combined
+
+    def _combine(self, ready):
+        ue = pd.DataFrame({
+            'timestamp' : np.array([item[0] for item in ready], dtype=np.float64),
+            'sn' : np.array([item[1] for item in ready], dtype=np.int64),
+            'ue' : np.arange(len(ready)),
+        })
+
+        # gnb journey with the same sn, closest in time
+        with_gnb = self.gnb.match(ue, self.join_window, by='sn')
+        self.stats['no_gnb'] = self.stats['no_gnb'] + len(ue) - len(with_gnb)
+        # nlmt trip sent closest in time
+        matched = self.nlmt.match(with_gnb, TS_TIME_MARGIN)
+        self.stats['no_nlmt'] = self.stats['no_nlmt'] + len(with_gnb) - len(matched)
+        self.stats['combined'] = self.stats['combined'] + len(matched)
+        if len(matched) == 0:
+            return UL_SCHEMA.frame([])
+
+        matched = matched.sort_values('ue', kind='stable')
+        entries = [
+            (self.nlmt.rows[nlmt], ready[ue][2], self.gnb.rows[gnb])
+            for ue, gnb, nlmt in zip(matched['ue'].tolist(), matched['GNB'].tolist(), matched['NLMT'].tolist())
+        ]
+        return combine_batches(entries).frame()
+
+    def _evict(self):
+        # the oldest ue journey that can still be resolved
+        horizon = self.ue_pending[0][0] if self.ue_pending else self.watermarks['UE']
+        self.stats['unmatched_gnb'] = self.stats['unmatched_gnb'] + self.gnb.evict(horizon - self.join_window)
+        self.stats['unmatched_nlmt'] = self.stats['unmatched_nlmt'] + self.nlmt.evict(horizon - TS_TIME_MARGIN)
+
+class TimeColumns:
+    # time ordered rows with their timestamps, sn and matched flags, for TimeJoinUL
+    # rows before `start` are evicted, the lists are compacted once half of them are.
+    def __init__(self):
+        self.times = []
+        self.sns = []
+        self.rows = []
+        self.matched = []
+        self.start = 0
+
+    def append(self, timestamp, sn, row):
+        self.times.append(timestamp)
+        self.sns.append(sn)
+        self.rows.append(row)
+        self.matched.append(False)
+
+    def match(self, left, tolerance, by=None):
+        # nearest row within tolerance for every row of left (sorted by timestamp), one to one.
+        # returns left's matched rows with a column named after the rows' source holding their index in rows
+        name = 'GNB' if by else 'NLMT'
+        candidates = pd.DataFrame({
+            'timestamp' : np.array(self.times[self.start:], dtype=np.float64),
+            'sn' : np.array(self.sns[self.start:], dtype=np.int64),
+            name : np.arange(self.start, len(self.times)),
+        })
+        candidates = candidates[~np.array(self.matched[self.start:], dtype=bool)]
+        if len(left) == 0 or len(candidates) == 0:
+            return left.iloc[0:0].assign(**{ name : np.empty(0, dtype=np.int64) })
+        left = left.sort_values('timestamp', kind='stable')
+        candidates = candidates.sort_values('timestamp', kind='stable')
+        candidates['matched_timestamp'] = candidates['timestamp']
+        if not by:
+            candidates = candidates.drop(columns='sn')
+        matches = []
+        while len(left) > 0 and len(candidates) > 0:
+            joined = pd.merge_asof(
+                left, candidates,
+                on='timestamp', by=by,
+                direction='nearest', tolerance=tolerance,
+            )
+            joined = joined[joined[name].notna()]
+            joined = joined.assign(distance=(joined['matched_timestamp'] - joined['timestamp']).abs())
+            # the margins are exclusive, like NlmtTimeIndex.closest
+            joined = joined[joined['distance'] < tolerance]
+            # a row can only be used once, by the closest one. The ones that lost it try
+            # the rows left, rows without a candidate within tolerance can not get one
+            won = joined.sort_values(['distance', 'ue'], kind='stable').drop_duplicates(name, keep='first')
+            if len(won) == 0:
+                break
+            matches.append(won)
+            candidates = candidates[~candidates[name].isin(won[name])]
+            left = left[left['ue'].isin(joined['ue']) & ~left['ue'].isin(won['ue'])]
+        if len(matches) == 0:
+            return left.iloc[0:0].assign(**{ name : np.empty(0, dtype=np.int64) })
+        joined = pd.concat(matches)
+        joined = joined.astype({ name : np.int64 }).drop(columns=['matched_timestamp', 'distance'])
+        for i in joined[name].tolist():
+            self.matched[i] = True
+        return joined.sort_values('timestamp', kind='stable')
+
+    def evict(self, before):
+        # evicts the rows older than before, returns how many of them were never matched
+        unmatched = 0
+        while self.start < len(self.times) and self.times[self.start] < before:
+            if not self.matched[self.start]:
+                unmatched = unmatched + 1
+            self.start = self.start + 1
+        if self.start > len(self.times)//2:
+            del self.times[:self.start]
+            del self.sns[:self.start]
+            del self.rows[:self.start]
+            del self.matched[:self.start]
+            self.start = 0
+        return unmatched
@@ -1,129 +1,111 @@
 import numpy as np
-import math
 import pandas as pd
 from loguru import logger
 
+from edaf.core.uplink.schema import MAX_SEGMENTS, MAX_HQROUND
+
 import os, sys
 if not os.getenv('DEBUG'):
     logger.remove()
     logger.add(sys.stdout, level="INFO")
 
-MAX_SEGMENTS = 20
-MAX_HQROUND = 5
 RU_LATENCY_MS = 0.5 #ms
 SLOT_DUR = 0.5 # ms
 
-# Add a new column: rlc.reassembled.num_segments
-def get_num_segments_gnb(row):
-    last_seg = 0
-    for i in range(MAX_SEGMENTS):
-        if f'rlc.reassembled.{i}.mac.demuxed.timestamp' in row:
-            if row[f'rlc.reassembled.{i}.mac.demuxed.timestamp'] > 0:
-                last_seg = i
-    return last_seg
-
-# Add a new column: rlc.queue.segments.num_segments
-def get_num_segments_ue(row):
-    last_seg = 0
-    for i in range(MAX_SEGMENTS):
-        if f'rlc.queue.segments.{i}.rlc.txpdu.timestamp' in row:
-            if row[f'rlc.queue.segments.{i}.rlc.txpdu.timestamp'] > 0:
-                last_seg = i
-    return last_seg
-
-# Add a new row: last_segment_txpdu_ts
-def get_last_segment_txpdu_ts(row):
-    last_seg = 0
-    for i in range(MAX_SEGMENTS):
-        if f'rlc.queue.segments.{i}.rlc.txpdu.timestamp' in row:
-            if row[f'rlc.queue.segments.{i}.rlc.txpdu.timestamp'] > 0:
-                last_seg = i
-    last_seg_column = f'rlc.queue.segments.{last_seg}.rlc.txpdu.timestamp'
-    return row[last_seg_column]
-
-# Add a new column: rlc.reassembled.first
-def get_first_segment_reassembly_ts(row):
-    first_seg_column = f"rlc.reassembled.{row['rlc.reassembled.num_segments']}.mac.demuxed.mac.decoded.0.timestamp"
-    return row[first_seg_column]
-
-# Add a new column: first_hqround_rx_ts
-def get_first_hqround_rx_ts(row,seg):
-    if seg != -1:
-        hqround_value = row[f'rlc.reassembled.{seg}.mac.demuxed.hqround']
-        if hqround_value >= 0:
-            decoded_slot_column = f'rlc.reassembled.{seg}.mac.demuxed.mac.decoded.{int(hqround_value)}.timestamp'
-            return row[decoded_slot_column]
-        else:
-            return np.nan
-    else:
-        hqround_value = row[f"rlc.reassembled.{row['rlc.reassembled.num_segments']}.mac.demuxed.hqround"]
-        if hqround_value >= 0:
-            decoded_slot_column = f"rlc.reassembled.{row['rlc.reassembled.num_segments']}.mac.demuxed.mac.decoded.{int(hqround_value)}.timestamp"
-            return row[decoded_slot_column]
-        else:
-            return np.nan
-
-# Add a new column: last_segment_txpdu_ts
-def get_last_segment_txpdu_ts(row):
-    last_seg = 0
-    for i in range(MAX_SEGMENTS):
-        if f'rlc.queue.segments.{i}.rlc.txpdu.timestamp' in row:
-            if row[f'rlc.queue.segments.{i}.rlc.txpdu.timestamp'] > 0:
-                last_seg = i
-    last_seg_column = f'rlc.queue.segments.{last_seg}.rlc.txpdu.timestamp'
-    return row[last_seg_column]
-
-# Add a new column: tdd_ts_offset_ms
-def get_tdd_ts_offset_ms(row):
-    slot_num = row['rlc.reassembled.0.mac.demuxed.slot']
-    # 0.2 ms delay for demodulation and decoding
-    slot_ref_offset = slot_num*SLOT_DUR+RU_LATENCY_MS
-
-    tdd_offset_ms = slot_ref_offset - row['rx_ts_ms']
-    return tdd_offset_ms
-
-# Add a new column: find the longest segment service delay (tx + retx), save its gnb index
-def get_max_service_delay_segment_gnb_idx(row):
-    segments_service_delays = []
-    for i in range(row['rlc.reassembled.num_segments']+1):
-        ue_ind = row['rlc.reassembled.num_segments']-i
-        gnb_ind = i
-        timestamp1 = row[f"rlc.queue.segments.{ue_ind}.rlc.txpdu.timestamp"]
-        timestamp2 = row[f"rlc.reassembled.{gnb_ind}.mac.demuxed.mac.decoded.0.timestamp"]
-        segments_service_delays.append((timestamp2-timestamp1)*1000)
-
-    max_index = segments_service_delays.index(max(segments_service_delays))
-    return max_index
-
-# Add a new column: get longest_segment_tx_delay
-def get_max_service_delay_segment_tx_delay(row):
-    ue_ind = row['rlc.reassembled.num_segments']-row['max_service_delay_segment_gnb_idx']
-    gnb_ind = row['max_service_delay_segment_gnb_idx']
-    timestamp1 = row[f"rlc.queue.segments.{ue_ind}.rlc.txpdu.timestamp"]
-    timestamp2 = row[f"rlc.reassembled.{gnb_ind}.mac.demuxed.mac.decoded.first.timestamp"]
-    return (timestamp2-timestamp1)*1000
-
-def get_max_service_delay_segment_retx_delay(row):
-    idx = row['max_service_delay_segment_gnb_idx']
-    timestamp1 = row[f"rlc.reassembled.{idx}.mac.demuxed.mac.decoded.first.timestamp"]
-    timestamp2 = row[f"rlc.reassembled.{idx}.mac.demuxed.mac.decoded.0.timestamp"]
-    return (timestamp2-timestamp1)*1000
-
-def myfloor(inp_arr):
-    out_arr = []
-    for item in inp_arr:
-        if not np.isnan(item):
-            out_arr.append(math.floor(item))
-        else:
-            out_arr.append(math.nan)
-    return np.array(out_arr,dtype=np.float64)
+# reasons a packet is dropped from the decomposition, in the order they are checked
+DROP_MESSAGES = {
+    'e2e' : 'negative e2e delay',
+    'core' : 'negative core delay',
+    'ran' : 'negative ran delay',
+    'queuing' : 'negative queuing delay',
+    'link' : 'negative link delay',
+    'segments' : 'the number of segments on UE was not matched with gnb',
+    'transmission' : 'negative transmission delay',
+    'retransmission' : 'negative retransmission delay',
+    'segmentation' : 'negative segmentation delay',
+    # a delay component could not be computed, checked along with the ones above
+    'missing' : 'a missing delay component',
+}
+DROP_REASONS = tuple(DROP_MESSAGES)
+
+def get_columns(df, names):
+    # packets x len(names) float array of the columns, NaN where a column is missing
+    out = np.full((len(df), len(names)), np.nan)
+    for i, name in enumerate(names):
+        if name in df:
+            out[:, i] = pd.to_numeric(df[name], errors='coerce').to_numpy(dtype=np.float64, na_value=np.nan)
+    return out
+
+def get_last_positive(arr):
+    # index of the last positive value of each row, 0 if there is none
+    positive = arr > 0
+    last = arr.shape[1] - 1 - np.argmax(positive[:, ::-1], axis=1)
+    return np.where(positive.any(axis=1), last, 0)
+
+def get_segment_arrays(df):
+    # packets x segments arrays of the values the decomposition needs, NaN where missing
+    segments = range(MAX_SEGMENTS)
+    ue_txpdu_ts = get_columns(df, [f'rlc.queue.segments.{i}.rlc.txpdu.timestamp' for i in segments])
+    gnb_demuxed_ts = get_columns(df, [f'rlc.reassembled.{i}.mac.demuxed.timestamp' for i in segments])
+    gnb_hqround = get_columns(df, [f'rlc.reassembled.{i}.mac.demuxed.hqround' for i in segments])
+    # packets x segments x harq rounds
+    hqrounds = max(MAX_HQROUND, int(np.nanmax(gnb_hqround, initial=-1)) + 1)
+    gnb_decoded_ts = np.stack([
+        get_columns(df, [f'rlc.reassembled.{i}.mac.demuxed.mac.decoded.{r}.timestamp' for i in segments])
+        for r in range(hqrounds)
+    ], axis=2)
+    return ue_txpdu_ts, gnb_demuxed_ts, gnb_hqround, gnb_decoded_ts
+
+def get_first_hqround_rx_ts(gnb_hqround, gnb_decoded_ts):
+    # decode time of the first harq attempt of every segment, the one of round 'hqround'
+    valid = gnb_hqround >= 0
+    rounds = np.where(valid, gnb_hqround, 0).astype(np.int64)
+    first = np.take_along_axis(gnb_decoded_ts, rounds[:, :, None], axis=2)[:, :, 0]
+    return np.where(valid, first, np.nan)
+
+def get_max_service_delay_segment_gnb_idx(num_segments, ue_txpdu_ts, gnb_decoded_0_ts):
+    # gnb index of the segment with the longest service delay (tx + retx).
+    # gnb segment i is ue segment num_segments-i. Like max() on a list, a NaN delay
+    # is never the maximum unless it is the first one.
+    rows = np.arange(len(num_segments))[:, None]
+    gnb_ind = np.arange(ue_txpdu_ts.shape[1])[None, :]
+    ue_ind = np.clip(num_segments[:, None] - gnb_ind, 0, None)
+    delays = (gnb_decoded_0_ts - ue_txpdu_ts[rows, ue_ind])*1000
+    delays = np.where((gnb_ind <= num_segments[:, None]) & ~np.isnan(delays), delays, -np.inf)
+    return np.where(np.isnan(gnb_decoded_0_ts[:, 0] - ue_txpdu_ts[rows[:, 0], num_segments]), 0, np.argmax(delays, axis=1))
+
+def get_perc(delay, e2e_delay):
+    # share of the e2e delay, inf or NaN where the e2e delay is 0 like pandas would give
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return delay / e2e_delay
+
+def new_drops():
+    # number of packets dropped for each reason, in the order they are checked
+    return dict.fromkeys(DROP_REASONS, 0)
+
+def nonnegative(reason, values):
+    # check of a delay component: negative values fail it, missing (NaN) ones count as 'missing'
+    return reason, values >= 0, np.isnan(values)
+
+def apply_checks(df, checks, drops):
+    # keep the packets that pass every check, a dropped packet is counted for the first one it
+    # fails, under 'missing' if the values of that check were missing
+    keep = np.ones(len(df), dtype=bool)
+    for reason, passed, missing in checks:
+        failed = keep & ~passed
+        drops[reason] = drops[reason] + int(np.count_nonzero(failed & ~missing))
+        drops['missing'] = drops['missing'] + int(np.count_nonzero(failed & missing))
+        keep &= passed
+    for reason, count in drops.items():
+        if count > 0:
+            logger.warning(f"{count} out of {len(df)} got filtered due to {DROP_MESSAGES[reason]}")
+    return keep
 
 def process_ul_journeys(df, ignore_core=False, standalone=False):
-    if df is None:
-        return None
-
-    if len(df) == 0:
-        return df
+    # returns the decomposed packets and the number of dropped packets per reason
+    drops = new_drops()
+    if df is None or len(df) == 0:
+        return df, drops
 
     if standalone:
         ########### STANDALONE End to End Delay #########
@@ -132,204 +114,163 @@ def process_ul_journeys(df, ignore_core=False, standalone=False):
         # Convert timestamps to milliseconds and calculate the difference
         timestamp_difference = ((timestamp1 - timestamp2) * 1000) #-32.0
         df['e2e_delay'] = timestamp_difference
-        filtered_df = df[df['e2e_delay'] < 0]
-        if filtered_df.shape[0] > 0:
-            logger.warning(f"{filtered_df.shape[0]} out of {df.shape[0]} got filtered due to negative e2e delay")
-        df = df[df['e2e_delay'] >= 0]
-        return df
+        keep = apply_checks(df, [nonnegative('e2e', df['e2e_delay'].to_numpy(dtype=np.float64, na_value=np.nan))], drops)
+        return df[keep], drops
 
     ################### POST PROCESS ###################
+    # the derived columns are collected here and added to df at once at the end,
+    # inserting them one by one into a wide frame is slow
+    columns = {}
+    ue_txpdu_ts, gnb_demuxed_ts, gnb_hqround, gnb_decoded_ts = get_segment_arrays(df)
+    rows = np.arange(len(df))
+
     # find the number of segments for each packet
-    df['rlc.reassembled.num_segments'] = df.apply(get_num_segments_gnb, axis=1)
-    df['rlc.queue.segments.num_segments'] = df.apply(get_num_segments_ue, axis=1)
+    gnb_num_segments = get_last_positive(gnb_demuxed_ts)
+    ue_num_segments = get_last_positive(ue_txpdu_ts)
+    columns['rlc.reassembled.num_segments'] = gnb_num_segments
+    columns['rlc.queue.segments.num_segments'] = ue_num_segments
 
     # find the last segment's service time
-    df['rlc.queue.segments.last.rlc.txpdu.timestamp'] = df.apply(get_last_segment_txpdu_ts, axis=1)
+    columns['rlc.queue.segments.last.rlc.txpdu.timestamp'] = ue_txpdu_ts[rows, ue_num_segments]
 
     # find first harq attempt decode time of all segments
-    for seg in range(MAX_SEGMENTS):
-        if f'rlc.reassembled.{seg}.mac.demuxed.mac.decoded.0.timestamp' in df:
-            df[f'rlc.reassembled.{seg}.mac.demuxed.mac.decoded.first.timestamp'] = df.apply(get_first_hqround_rx_ts, args=(seg,), axis=1)
+    first_hqround_rx_ts = get_first_hqround_rx_ts(gnb_hqround, gnb_decoded_ts)
+    has_decoded = np.array([f'rlc.reassembled.{seg}.mac.demuxed.mac.decoded.0.timestamp' in df for seg in range(MAX_SEGMENTS)])
+    for seg in np.flatnonzero(has_decoded):
+        columns[f'rlc.reassembled.{seg}.mac.demuxed.mac.decoded.first.timestamp'] = first_hqround_rx_ts[:, seg]
 
     # find first harq attempt decode time of the first segment
-    df['rlc.reassembled.first.mac.demuxed.mac.decoded.first.timestamp'] = df.apply(get_first_hqround_rx_ts, args=(-1,), axis=1)
+    columns['rlc.reassembled.first.mac.demuxed.mac.decoded.first.timestamp'] = first_hqround_rx_ts[rows, gnb_num_segments]
 
     # find first segment's complete reassembly time
-    df["rlc.reassembled.first.mac.demuxed.mac.decoded.0.timestamp"] = df.apply(get_first_segment_reassembly_ts, axis=1)
+    columns["rlc.reassembled.first.mac.demuxed.mac.decoded.0.timestamp"] = gnb_decoded_ts[rows, gnb_num_segments, 0]
+
+    # all the delay components are computed for every packet, the packets with a
+    # negative component are dropped at once at the end, see apply_checks
+    def get_column(name):
+        return get_columns(df, [name])[:, 0]
 
     ################### End to End Delay ###################
     # "rlc.queue.segments.0.rlc.txpdu.timestamp" - "rlc.queue.timestamp"
     # Extract timestamp columns as series
     if ignore_core:
-        timestamp1 = df["gtp.out.timestamp"]
-        timestamp2 = df["send.timestamp"]
+        timestamp1 = get_column("gtp.out.timestamp")
+        timestamp2 = get_column("send.timestamp")
     else:
-        timestamp1 = df["receive.timestamp"]
-        timestamp2 = df["send.timestamp"]
+        timestamp1 = get_column("receive.timestamp")
+        timestamp2 = get_column("send.timestamp")
 
     # Convert timestamps to milliseconds and calculate the difference
-    timestamp_difference = ((timestamp1 - timestamp2) * 1000) #-32.0
-    df['e2e_delay'] = timestamp_difference
-    filtered_df = df[df['e2e_delay'] < 0]
-    if filtered_df.shape[0] > 0:
-        logger.warning(f"{filtered_df.shape[0]} out of {df.shape[0]} got filtered due to negative e2e delay")
-    df = df[df['e2e_delay'] >= 0]
-    if df.shape[0] == 0:
-        return df;
-    #print(len(df))
+    e2e_delay = ((timestamp1 - timestamp2) * 1000) #-32.0
+    checks = [nonnegative('e2e', e2e_delay)]
+    columns['e2e_delay'] = e2e_delay
 
     ################### Core Delay ###################
     if not ignore_core:
         # "rlc.queue.segments.0.rlc.txpdu.timestamp" - "rlc.queue.timestamp"
         # Extract timestamp columns as series
-        timestamp1 = df["receive.timestamp"]
-        timestamp2 = df["gtp.out.timestamp"]
+        timestamp1 = get_column("receive.timestamp")
+        timestamp2 = get_column("gtp.out.timestamp")
 
         # Convert timestamps to milliseconds and calculate the difference
-        timestamp_difference = ((timestamp1 - timestamp2) * 1000)#-32.0
-        df['core_delay'] = timestamp_difference
-        #df = df[df['core_delay'] >= 0]
-        df['core_delay_perc'] = timestamp_difference / df['e2e_delay']
-
-    filtered_df = df[df['core_delay'] < 0]
-    if filtered_df.shape[0] > 0:
-        logger.warning(f"{filtered_df.shape[0]} out of {df.shape[0]} got filtered due to negative core delay")
-    df = df[df['core_delay'] >= 0]
-    if df.shape[0] == 0:
-        return df;
-    #print(len(df))
+        core_delay = ((timestamp1 - timestamp2) * 1000)#-32.0
+        checks.append(nonnegative('core', core_delay))
+        columns['core_delay'] = core_delay
+        columns['core_delay_perc'] = get_perc(core_delay, e2e_delay)
 
     ################### RAN Delay ###################
     if not ignore_core:
-        df['ran_delay'] = df['e2e_delay'] - df['core_delay']
+        ran_delay = e2e_delay - core_delay
     else:
-        df['ran_delay'] = df['e2e_delay']
-
-    filtered_df = df[df['ran_delay'] < 0]
-    if filtered_df.shape[0] > 0:
-        logger.warning(f"{filtered_df.shape[0]} out of {df.shape[0]} got filtered due to negative ran delay")
-    df = df[df['ran_delay'] >= 0]
-    if df.shape[0] == 0:
-        return df;
-    #print(len(df))
+        ran_delay = e2e_delay
+    checks.append(nonnegative('ran', ran_delay))
+    columns['ran_delay'] = ran_delay
 
     ################### Queuing Delay ###################
     # "rlc.queue.segments.0.rlc.txpdu.timestamp" - "rlc.queue.timestamp"
-    # Extract timestamp columns as series
-    timestamp1 = df["rlc.queue.segments.0.rlc.txpdu.timestamp"]
-    timestamp2 = df["rlc.queue.timestamp"]
+    timestamp1 = get_column("rlc.queue.segments.0.rlc.txpdu.timestamp")
+    timestamp2 = get_column("rlc.queue.timestamp")
 
     # Convert timestamps to milliseconds and calculate the difference
-    timestamp_difference = (timestamp1 - timestamp2) * 1000
-    df['queuing_delay'] = timestamp_difference
-    filtered_df = df[df['queuing_delay'] < 0]
-    if filtered_df.shape[0] > 0:
-        logger.warning(f"{filtered_df.shape[0]} out of {df.shape[0]} got filtered due to negative queuing delay")
-    df = df[df['queuing_delay'] >= 0]
-    if df.shape[0] == 0:
-        return df;
-
-    df['queuing_delay_perc'] = timestamp_difference / df['e2e_delay']
-    #print(len(df))
+    queuing_delay = (timestamp1 - timestamp2) * 1000
+    checks.append(nonnegative('queuing', queuing_delay))
+    columns['queuing_delay'] = queuing_delay
+    columns['queuing_delay_perc'] = get_perc(queuing_delay, e2e_delay)
 
     ################### Link Delay ###################
     # "rlc.reassembled.0.mac.demuxed.mac.decoded.timestamp" - "rlc.queue.segments.0.rlc.txpdu.timestamp"
-    # Extract timestamp columns as series
-    timestamp1 = df["rlc.queue.segments.0.rlc.txpdu.timestamp"]
-    timestamp2 = df["rlc.reassembled.0.mac.demuxed.mac.decoded.0.timestamp"]
+    timestamp1 = get_column("rlc.queue.segments.0.rlc.txpdu.timestamp")
+    timestamp2 = get_column("rlc.reassembled.0.mac.demuxed.mac.decoded.0.timestamp")
 
     # Convert timestamps to milliseconds and calculate the difference
-    timestamp_difference = (timestamp2 - timestamp1) * 1000
-    df['link_delay'] = timestamp_difference
-    filtered_df = df[df['link_delay'] < 0]
-    if filtered_df.shape[0] > 0:
-        logger.warning(f"{filtered_df.shape[0]} out of {df.shape[0]} got filtered due to negative link delay")
-    df = df[df['link_delay'] >= 0]
-    if df.shape[0] == 0:
-        return df;
-
-    df['link_delay_perc'] = timestamp_difference / df['e2e_delay']
-    #print(len(df))
+    link_delay = (timestamp2 - timestamp1) * 1000
+    checks.append(nonnegative('link', link_delay))
+    columns['link_delay'] = link_delay
+    columns['link_delay_perc'] = get_perc(link_delay, e2e_delay)
 
     ################### Transmission delay ###################
     # filter the rows where their number of segments on UE is not matched with gnb:
     # 'rlc.reassembled.num_segments' != 'rlc.queue.segments.num_segments'
-    filtered_df = df[df['rlc.reassembled.num_segments'] != df['rlc.queue.segments.num_segments']]
-    if filtered_df.shape[0] > 0:
-        logger.warning(f"{filtered_df.shape[0]} out of {df.shape[0]} got filtered due to the number of segments on UE was not matched with gnb")
-    
-    df = df[df['rlc.reassembled.num_segments'] == df['rlc.queue.segments.num_segments']]
-    if df.shape[0] == 0:
-        return df;
+    # both counts are integers, 0 when no segment was seen, so they are never missing
+    checks.append(('segments', gnb_num_segments == ue_num_segments, np.zeros(len(df), dtype=bool)))
+
+    # decode time of the first harq attempt, only for the segments that have a decoded.0 column
+    gnb_decoded_0_ts = gnb_decoded_ts[:, :, 0]
+    gnb_decoded_first_ts = np.where(has_decoded, first_hqround_rx_ts, np.nan)
 
     # find the segment with longest tx+retx (service) delay, then store its gnb index
-    df['max_service_delay_segment_gnb_idx'] = df.apply(get_max_service_delay_segment_gnb_idx, axis=1)
+    max_idx = get_max_service_delay_segment_gnb_idx(gnb_num_segments, ue_txpdu_ts, gnb_decoded_0_ts)
+    columns['max_service_delay_segment_gnb_idx'] = max_idx
 
     # save the tx delay of the previously discovered segment as the transmission delay
-    df['transmission_delay'] = df.apply(get_max_service_delay_segment_tx_delay, axis=1)
-
-    # Remove rows where 'transmission_delay' is less than 0
-    filtered_df = df[df['transmission_delay'] < 0]
-    if filtered_df.shape[0] > 0:
-        logger.warning(f"{filtered_df.shape[0]} out of {df.shape[0]} got filtered due to negative transmission delay")
-    df = df[df['transmission_delay'] >= 0]
-    if df.shape[0] == 0:
-        return df;
-
-    df['transmission_delay_perc'] = timestamp_difference / df['e2e_delay']
-    #print(len(df))
+    transmission_delay = (gnb_decoded_first_ts[rows, max_idx] - ue_txpdu_ts[rows, gnb_num_segments - max_idx])*1000
+    checks.append(nonnegative('transmission', transmission_delay))
+    columns['transmission_delay'] = transmission_delay
+    columns['transmission_delay_perc'] = get_perc(link_delay, e2e_delay)
 
     ################### Retransmissions delay ###################
     # save the retx delay of the previously discovered segment as the retransmission delay
-    df['retransmission_delay'] = df.apply(get_max_service_delay_segment_retx_delay, axis=1)
-    filtered_df = df[df['retransmission_delay'] < 0]
-    if filtered_df.shape[0] > 0:
-        logger.warning(f"{filtered_df.shape[0]} out of {df.shape[0]} got filtered due to negative retransmission delay")
-    df = df[df['retransmission_delay'] >= 0]
-    if df.shape[0] == 0:
-        return df;
-
-    df['retransmission_delay_perc'] = df['retransmission_delay'] / df['e2e_delay']
-    #print(len(df))
+    retransmission_delay = (gnb_decoded_0_ts[rows, max_idx] - gnb_decoded_first_ts[rows, max_idx])*1000
+    checks.append(nonnegative('retransmission', retransmission_delay))
+    columns['retransmission_delay'] = retransmission_delay
+    columns['retransmission_delay_perc'] = get_perc(retransmission_delay, e2e_delay)
 
     ################### Segmentation delay ###################
-    df['segmentation_delay'] = df['link_delay']-(df['transmission_delay']+df['retransmission_delay'])
-    filtered_df = df[df['segmentation_delay'] < 0]
-    if filtered_df.shape[0] > 0:
-        logger.warning(f"{filtered_df.shape[0]} out of {df.shape[0]} got filtered due to negative segmentation delay")
-    df = df[df['segmentation_delay'] >= 0]
-    if df.shape[0] == 0:
-        return df;
+    segmentation_delay = link_delay-(transmission_delay+retransmission_delay)
+    checks.append(nonnegative('segmentation', segmentation_delay))
+    columns['segmentation_delay'] = segmentation_delay
+    columns['segmentation_delay_perc'] = get_perc(segmentation_delay, e2e_delay)
 
-    df['segmentation_delay_perc'] = df['segmentation_delay'] / df['e2e_delay']
-    #print(len(df))
+    # drop the packets with a negative delay component
+    keep = apply_checks(df, checks, drops)
+    df = df[keep]
+    columns = { name : values[keep] for name, values in columns.items() }
 
     ################### ABSOLUTE TIMING CALCULATIONS ###################
     ################### FRAME OFFSET ###################################
 
     # Calculate 5G TDD Frames Time Offset
-    timestamp_str = "rlc.reassembled.0.mac.demuxed.timestamp"
-    rx_tss_fn = np.floor(df[timestamp_str] * 100)
-    tx_tss_ms = list( (df[timestamp_str] * 1000) - (rx_tss_fn*10) )
-    df['rx_ts_ms'] = tx_tss_ms
-    # Apply the function to filter rows
-    df['tdd_ts_offset_ms'] = df.apply(get_tdd_ts_offset_ms, axis=1)
+    timestamp = get_column("rlc.reassembled.0.mac.demuxed.timestamp")
+    rx_tss_fn = np.floor(timestamp * 100)
+    columns['rx_ts_ms'] = (timestamp * 1000) - (rx_tss_fn*10)
+    # 0.2 ms delay for demodulation and decoding
+    slot_ref_offset = get_column('rlc.reassembled.0.mac.demuxed.slot')*SLOT_DUR+RU_LATENCY_MS
+    tdd_ts_offset_ms = slot_ref_offset - columns['rx_ts_ms']
+    columns['tdd_ts_offset_ms'] = tdd_ts_offset_ms
 
     ################### Radio Arrival Time ###################
 
-    timestamp_str = 'ip.in.timestamp'
-    new_timestamp_str = 'ip.in.timestamp_no_offset'
-
     # Add the tdd sync offset to all timestamps
-    df[new_timestamp_str] = df[timestamp_str] + (df['tdd_ts_offset_ms']/1000.0)
+    timestamp_no_offset = get_column('ip.in.timestamp') + (tdd_ts_offset_ms/1000.0)
+    columns['ip.in.timestamp_no_offset'] = timestamp_no_offset
 
     # Calculate frame number
-    tx_tss_fn = np.floor(df[new_timestamp_str] * 100)
-    df['arrival_ref_time'] = tx_tss_fn*10
+    tx_tss_fn = np.floor(timestamp_no_offset * 100)
+    arrival_ref_time = tx_tss_fn*10
+    columns['arrival_ref_time'] = arrival_ref_time
 
     # Calculate ms offset within the frame
-    tx_tss_ms = list((df[new_timestamp_str] * 1000) - (tx_tss_fn*10))
-    df['radio_arrival_time_os'] = tx_tss_ms
+    columns['radio_arrival_time_os'] = (timestamp_no_offset * 1000) - (tx_tss_fn*10)
 
     # filter arrival times
     #mask = ((df['radio_arrival_time_os'] >= 5) & (df['radio_arrival_time_os'] <= 6.5))
@@ -339,43 +280,39 @@ def process_ul_journeys(df, ignore_core=False, standalone=False):
 
     for seg in range(MAX_SEGMENTS):
         timestamp_str = f'rlc.queue.segments.{seg}.rlc.txpdu.timestamp'
-        new_timestamp_str = f'rlc.queue.segments.{seg}.rlc.txpdu.timestamp_no_offset'
         if timestamp_str in df:
-            # Add the tdd sync offset to all timestamps        
-            df[new_timestamp_str] = df[timestamp_str] + (df['tdd_ts_offset_ms']/1000.0)
+            timestamp = get_column(timestamp_str)
+            # Add the tdd sync offset to all timestamps
+            timestamp_no_offset = timestamp + (tdd_ts_offset_ms/1000.0)
+            columns[f'rlc.queue.segments.{seg}.rlc.txpdu.timestamp_no_offset'] = timestamp_no_offset
             # Calculate frame number
-            tx_tss_fn = myfloor(df[new_timestamp_str] * 100)
+            tx_tss_fn = np.floor(timestamp_no_offset * 100)
             # Calculate ms offset within the frame
-            tx_tss_ms = list( (df[new_timestamp_str] * 1000) - (tx_tss_fn*10) )
+            tx_tss_ms = (timestamp_no_offset * 1000) - (tx_tss_fn*10)
             if seg == 0:
-                df['service_time_os'] = tx_tss_ms
-                df['service_time'] = (df[new_timestamp_str] * 1000) - df['arrival_ref_time']
+                columns['service_time_os'] = tx_tss_ms
+                columns['service_time'] = (timestamp_no_offset * 1000) - arrival_ref_time
             else:
-                df[f'service_time_seg{seg}_os'] = tx_tss_ms
-                df[f'service_time_seg{seg}'] = (df[timestamp_str] * 1000.0) - df['arrival_ref_time']
+                columns[f'service_time_seg{seg}_os'] = tx_tss_ms
+                columns[f'service_time_seg{seg}'] = (timestamp * 1000.0) - arrival_ref_time
 
 
     ################### Radio Departure Time ###################
-    timestamp_str = 'rlc.reassembled.0.mac.demuxed.timestamp'
-    new_timestamp_str = 'rlc.reassembled.0.mac.demuxed.timestamp_no_offset'
     # Add the tdd sync offset to all timestamps
-    df[new_timestamp_str] = df[timestamp_str] + (df['tdd_ts_offset_ms']/1000.0)
+    timestamp_no_offset = get_column('rlc.reassembled.0.mac.demuxed.timestamp') + (tdd_ts_offset_ms/1000.0)
+    columns['rlc.reassembled.0.mac.demuxed.timestamp_no_offset'] = timestamp_no_offset
     # Calculate frame number
-    tx_tss_fn = np.floor(df[new_timestamp_str] * 100)
+    tx_tss_fn = np.floor(timestamp_no_offset * 100)
     # Calculate ms offset within the frame
-    tx_tss_ms = list( (df[new_timestamp_str] * 1000) - (tx_tss_fn*10) )
-    df['radio_departure_time_os'] = tx_tss_ms
-    df['radio_departure_time'] = (df[new_timestamp_str] * 1000) - df['arrival_ref_time']
+    columns['radio_departure_time_os'] = (timestamp_no_offset * 1000) - (tx_tss_fn*10)
+    columns['radio_departure_time'] = (timestamp_no_offset * 1000) - arrival_ref_time
 
     ################### Core Departure Time ###################
-    timestamp_str = 'receive.timestamp'
-    timestamp_str_str = 'receive.timestamp_no_offset'
     # Add the tdd sync offset to all timestamps
-    df[timestamp_str_str] = df[timestamp_str] + (df['tdd_ts_offset_ms']/1000.0)
-    # Calculate frame number
-    tx_tss_fn = np.floor(df[timestamp_str_str] * 100)
-    # Calculate ms offset within the frame
-    tx_tss_ms = list( (df[timestamp_str_str] * 1000) - (tx_tss_fn*10) )
-    df['core_departure_time'] = (df[timestamp_str_str] * 1000) - df['arrival_ref_time']
+    timestamp_no_offset = get_column('receive.timestamp') + (tdd_ts_offset_ms/1000.0)
+    columns['receive.timestamp_no_offset'] = timestamp_no_offset
+    columns['core_departure_time'] = (timestamp_no_offset * 1000) - arrival_ref_time
 
-    return df
+    # derived columns replace the ones df already had
+    df = df.drop(columns=df.columns.intersection(list(columns)))
+    return pd.concat([df, pd.DataFrame(columns, index=df.index)], axis=1), drops
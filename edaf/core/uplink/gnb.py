@@ -1,28 +1,14 @@
 import sys
-import re
 from loguru import logger
-from collections import deque
+
+from edaf.core.common.index import WindowIndex
+from edaf.core.uplink.schema import GNB_SCHEMA, put
 
 import os
 if not os.getenv('DEBUG'):
     logger.remove()
     logger.add(sys.stdout, level="INFO")
 
-class RingBuffer:
-    def __init__(self, size):
-        self.size = size
-        self.buffer = deque(maxlen=size)
-
-    def append(self, item):
-        self.buffer.append(item)
-
-    def get_items(self):
-        return list(self.buffer)
-    
-    def reverse_items(self):
-        return list(reversed(self.buffer))
-
-
 KW_R = 'gtp.out'    # first, find the lines including this
 
 # go back a few lines, find the first line that includes
@@ -49,42 +35,123 @@ KW_MAC_DEC = 'mac.decoded' # this is the key to recognize the retransmissions
 MAX_DEPTH = 500
 
 
-def find_MAC_DEC(hqpid_value,hqround,prev_lines,line_number):
-    # return an array
 
-    hqround_counter = hqround
+def index_line(index, record):
+    # store the parsed line under the keys the journeys are joined on
+    f = record.fields
+    event = record.event
+
+    if event == KW_SDAP:
+        if 'SBuf' in f and 'sn' in f:
+            entry = None
+            if 'len' in f and 'PBuf' in f:
+                entry = {
+                    'timestamp' : record.timestamp,
+                    'length' : f['len'],
+                    'PBuf' : str(f['PBuf']),
+                }
+            index.add(KW_SDAP, (str(f['SBuf']), f['sn']), entry)
+
+    elif event == KW_PDCP:
+        if 'PBuf' in f and 'sn' in f:
+            entry = None
+            if 'len' in f and 'PIBuf' in f:
+                entry = {
+                    'timestamp' : record.timestamp,
+                    'length' : f['len'],
+                    'PIBuf' : str(f['PIBuf']),
+                }
+            index.add(KW_PDCP, (str(f['PBuf']), f['sn']), entry)
+
+    elif event == KW_PDCPIND:
+        if 'PIBuf' in f and 'sn' in f:
+            entry = None
+            if 'len' in f:
+                entry = {
+                    'timestamp' : record.timestamp,
+                    'length' : f['len'],
+                }
+            index.add(KW_PDCPIND, (str(f['PIBuf']), f['sn']), entry)
+
+    elif event == KW_RLC:
+        if 'sn' in f:
+            entry = None
+            if 'len' in f and 'MRbuf' in f:
+                entry = {
+                    'MRbuf': str(f['MRbuf']),
+                    'timestamp' : record.timestamp,
+                    'length' : f['len'],
+                }
+            index.add(KW_RLC, f['sn'], entry)
+
+    elif event == KW_RLC_DC:
+        if 'MRbuf' in f:
+            entry = None
+            if 'len' in f and 'fm' in f and 'sl' in f and 'lcid' in f and 'hqpid' in f:
+                entry = {
+                    'lcid': f['lcid'],
+                    'hqpid': f['hqpid'],
+                    'frame': f['fm'],
+                    'slot': f['sl'],
+                    'timestamp' : record.timestamp,
+                    'length' : f['len'],
+                }
+            index.add(KW_RLC_DC, str(f['MRbuf']), entry)
+
+    elif event == KW_MAC_DEM:
+        if 'fm' in f and 'sl' in f and 'hqpid' in f:
+            entry = None
+            if 'len' in f and 'ldpciter' in f and 'mcs' in f and 'hqround' in f:
+                entry = {
+                    'ldpciter': f['ldpciter'],
+                    'mcs': f['mcs'],
+                    'hqround': f['hqround'],
+                    'timestamp' : record.timestamp,
+                    'length' : f['len'],
+                }
+            index.add(KW_MAC_DEM, (f['fm'], f['sl'], f['hqpid']), entry)
+
+    elif event == KW_MAC_DEC:
+        if 'hqpid' in f and 'hqround' in f:
+            entry = None
+            if 'fm' in f and 'sl' in f:
+                entry = {
+                    'timestamp' : record.timestamp,
+                    'frame' : f['fm'],
+                    'slot' : f['sl'],
+                }
+            index.add(KW_MAC_DEC, (f['hqpid'], f['hqround']), entry)
+
+
+def find_MAC_DEC(hqpid_value,hqround,index,line_number):
+    # return an array, walking the harq rounds back in time
+
     mac_dec_arr = []
-    for jd,prev_ljne in enumerate(prev_lines):
+    before = None
+    for hqround_counter in range(hqround, -1, -1):
         hqstr = f'hqpid{hqpid_value}.hqround{hqround_counter}'
-        if ('--'+KW_MAC_DEC in prev_ljne) and (hqstr in prev_ljne):
-            timestamp_match = re.search(r'^(\d+\.\d+)', prev_ljne)
-            fm_match = re.search(r'fm(\d+)', prev_ljne)
-            sl_match = re.search(r'sl(\d+)', prev_ljne)
-            if timestamp_match and fm_match and sl_match:
-                timestamp = float(timestamp_match.group(1))
-                fm_value = int(fm_match.group(1))
-                sl_value = int(sl_match.group(1))
-            else:
-                logger.warning(f"For {KW_MAC_DEC} and {hqstr}, could not find timestamp or frame or slot in line {line_number-jd-1}.")
-                break
-
-            logger.debug(f"Found '{KW_MAC_DEC}' and '{hqstr}' in line {line_number-jd-1}, timestamp: {timestamp}, frame: {fm_value}, slot: {sl_value}")
-            mac_dec_arr.append({
-                'timestamp':timestamp,
-                'frame':fm_value,
-                'slot':sl_value,
-                'hqpid':hqpid_value,
-                'hqround':hqround_counter
-            })
-
-            hqround_counter = hqround_counter-1
-            if hqround_counter<0:
-                break
-        
+        found = index.latest(KW_MAC_DEC, (hqpid_value, hqround_counter), before)
+        if found is None:
+            break
+        seq, mac_dec = found
+        if mac_dec is None:
+            logger.warning(f"For {KW_MAC_DEC} and {hqstr}, could not find timestamp or frame or slot in line {line_number-(index.seq-seq)}.")
+            break
+
+        logger.debug(f"Found '{KW_MAC_DEC}' and '{hqstr}' in line {line_number-(index.seq-seq)}, timestamp: {mac_dec['timestamp']}, frame: {mac_dec['frame']}, slot: {mac_dec['slot']}")
+        mac_dec_arr.append({
+            'timestamp':mac_dec['timestamp'],
+            'frame':mac_dec['frame'],
+            'slot':mac_dec['slot'],
+            'hqpid':hqpid_value,
+            'hqround':hqround_counter
+        })
+        before = seq
+
     if len(mac_dec_arr) != hqround+1:
-        logger.warning(f"Could not find all '{KW_MAC_DEC}' in {len(prev_lines)} lines before {line_number}. Skipping this '{KW_R}' journey")
+        logger.warning(f"Could not find all '{KW_MAC_DEC}' in {len(index)} lines before {line_number}. Skipping this '{KW_R}' journey")
         return []
-    
+
     return mac_dec_arr
 
 #def sort_key(line):
@@ -92,246 +159,150 @@ def find_MAC_DEC(hqpid_value,hqround,prev_lines,line_number):
 
 class ProcessULGNB:
     def __init__(self):
-        self.previous_lines = RingBuffer(MAX_DEPTH)
+        # lookback window over the previous lines, indexed by join keys
+        self.index = WindowIndex(MAX_DEPTH)
 
-    def run(self, lines):
+    def run(self, records):
+        # records are parsed lseq lines with their timestamps converted, see rdtsctotsOnline.return_records
 
-        #lines = sorted(unsortedlines, key=sort_key, reverse=False)
         journeys = []
         ip_packets_counter = 0
-        for line_number, line in enumerate(lines):
-            self.previous_lines.append(line)
-
-            if KW_R in line:
-                line = line.replace('\n', '')
-            
-                # Use regular expressions to extract the numbers
-                timestamp_match = re.search(r'^(\d+\.\d+)', line)
-                len_match = re.search(r'len(\d+)', line)
-                sbuf_match = re.search(r'SBuf(\d+)', line)
-                sn_match = re.search(r'sn(\d+)', line)
-                if len_match and sbuf_match and timestamp_match and sn_match:
-                    timestamp = float(timestamp_match.group(1))
-                    len_value = int(len_match.group(1))
-                    sbuf_value = sbuf_match.group(1)
-                    sn_value = int(sn_match.group(1))
+        for line_number, record in enumerate(records):
+            self.index.advance()
+            index_line(self.index, record)
+
+            if record.touches(KW_R):
+                f = record.fields
+                if 'len' in f and 'SBuf' in f and 'sn' in f:
+                    timestamp = record.timestamp
+                    len_value = f['len']
+                    sbuf_value = str(f['SBuf'])
+                    sn_value = f['sn']
                     logger.debug(f"[GNB] Found '{KW_R}' in line {line_number}, len:{len_value}, SBuf: {sbuf_value}, ts: {timestamp}, sn: {sn_value}")
+                    # flat journey row, see schema.GNB_FIELDS
                     journey = {
-                        KW_R : {
-                            'timestamp' : timestamp,
-                            'length' : len_value,
-                            'SBuf' : sbuf_value,
-                            'sn' : sn_value
-                        }
+                        f'{KW_R}.timestamp' : timestamp,
+                        f'{KW_R}.length' : len_value,
+                        f'{KW_R}.SBuf' : sbuf_value,
+                        f'{KW_R}.sn' : sn_value,
                     }
                     snp = f"sn{sn_value}"
                     sbufp = f"SBuf{sbuf_value}"
-
-                    # lets go back in lines
-                    prev_lines = self.previous_lines.reverse_items()
+                    depth = len(self.index)
 
                     # check for KW_SDAP
-                    found_KW_SDAP = False
-                    for id,prev_line in enumerate(prev_lines):    
-                        if ('--'+KW_SDAP in prev_line) and (sbufp in prev_line) and (snp in prev_line):
-                            timestamp_match = re.search(r'^(\d+\.\d+)', prev_line)
-                            len_match = re.search(r'len(\d+)', prev_line)
-                            pbuf_match = re.search(r'PBuf(\d+)', prev_line)
-                            if len_match and timestamp_match and pbuf_match:
-                                timestamp = float(timestamp_match.group(1))
-                                len_value = int(len_match.group(1))
-                                pbuf_value = pbuf_match.group(1)
-                            else:
-                                logger.warning(f"[GNB] For {KW_SDAP}, could not find timestamp, length, or PBuf in line {line_number-id-1}. Skipping this '{KW_R}' journey")
-                                break
-
-                            logger.debug(f"[GNB] Found '{KW_SDAP}','{sbufp}', and '{snp}' in line {line_number-id-1}, len:{len_value}, timestamp: {timestamp}")
-                            journey[KW_SDAP] = {
-                                'timestamp' : timestamp,
-                                'length' : len_value,
-                                'PBuf' : pbuf_value,
-                            }
-                            pbufp = f"PBuf{pbuf_value}"
-                            found_KW_SDAP = True
-                            break
-
-                    if not found_KW_SDAP:
-                        logger.warning(f"[GNB] Could not find '{KW_SDAP}' and '{sbufp}' in {len(prev_lines)} lines before {line_number}. Skipping this '{KW_R}' journey")
+                    found = self.index.latest(KW_SDAP, (sbuf_value, sn_value))
+                    if found is None:
+                        logger.warning(f"[GNB] Could not find '{KW_SDAP}' and '{sbufp}' in {depth} lines before {line_number}. Skipping this '{KW_R}' journey")
+                        continue
+                    seq, sdap = found
+                    if sdap is None:
+                        logger.warning(f"[GNB] For {KW_SDAP}, could not find timestamp, length, or PBuf in line {line_number-(self.index.seq-seq)}. Skipping this '{KW_R}' journey")
                         continue
 
+                    logger.debug(f"[GNB] Found '{KW_SDAP}','{sbufp}', and '{snp}' in line {line_number-(self.index.seq-seq)}, len:{sdap['length']}, timestamp: {sdap['timestamp']}")
+                    put(journey, KW_SDAP, sdap)
+                    pbuf_value = sdap['PBuf']
+                    pbufp = f"PBuf{pbuf_value}"
+
                     # check for KW_PDCP
-                    found_KW_PDCP = False
-                    for id,prev_line in enumerate(prev_lines):
-                        if ('--'+KW_PDCP in prev_line) and (pbufp in prev_line) and (snp in prev_line):
-                            timestamp_match = re.search(r'^(\d+\.\d+)', prev_line)
-                            len_match = re.search(r'len(\d+)', prev_line)
-                            pibuf_match = re.search(r'PIBuf(\d+)', prev_line)
-                            if len_match and timestamp_match and pibuf_match:
-                                timestamp = float(timestamp_match.group(1))
-                                len_value = int(len_match.group(1))
-                                pibuf_value = pibuf_match.group(1)
-                            else:
-                                logger.warning(f"[GNB] For {KW_PDCP}, could not find timestamp, length, PIBuf, or sn in line {line_number-id-1}. Skipping this '{KW_R}' journey")
-                                break
-
-                            logger.debug(f"[GNB] Found '{KW_PDCP}', '{pbufp}', and '{snp}' in line {line_number-id-1}, len:{len_value}, timestamp: {timestamp}, sn: {sn_value}")
-                            journey[KW_PDCP] = {
-                                'timestamp' : timestamp,
-                                'length' : len_value,
-                                'PIBuf' : pibuf_value,
-                            }
-                            pibufp = f"PIBuf{pibuf_value}"
-                            found_KW_PDCP = True
-                            break
-                    
-                    if not found_KW_PDCP:
-                        logger.warning(f"[GNB] Could not find '{KW_PDCP}' and '{pbufp}' in {len(prev_lines)} lines before {line_number}. Skipping this '{KW_R}' journey")
+                    found = self.index.latest(KW_PDCP, (pbuf_value, sn_value))
+                    if found is None:
+                        logger.warning(f"[GNB] Could not find '{KW_PDCP}' and '{pbufp}' in {depth} lines before {line_number}. Skipping this '{KW_R}' journey")
+                        continue
+                    seq, pdcp = found
+                    if pdcp is None:
+                        logger.warning(f"[GNB] For {KW_PDCP}, could not find timestamp, length, PIBuf, or sn in line {line_number-(self.index.seq-seq)}. Skipping this '{KW_R}' journey")
                         continue
 
+                    logger.debug(f"[GNB] Found '{KW_PDCP}', '{pbufp}', and '{snp}' in line {line_number-(self.index.seq-seq)}, len:{pdcp['length']}, timestamp: {pdcp['timestamp']}, sn: {sn_value}")
+                    put(journey, KW_PDCP, pdcp)
+                    pibuf_value = pdcp['PIBuf']
+                    pibufp = f"PIBuf{pibuf_value}"
+
                     # check for KW_PDCPIND
                     # This is tricky. We may find multiple lines we have to keep the one with smaller snp
-                    found_KW_PDCPIND = False
-                    for id,prev_line in enumerate(prev_lines):
-                        if ('--'+KW_PDCPIND in prev_line) and (pibufp in prev_line) and (snp in prev_line):
-                            timestamp_match = re.search(r'^(\d+\.\d+)', prev_line)
-                            len_match = re.search(r'len(\d+)', prev_line)
-                            if len_match and timestamp_match and sn_match:
-                                timestamp = float(timestamp_match.group(1))
-                                len_value = int(len_match.group(1))
-                            else:
-                                logger.warning(f"[GNB] For {KW_PDCPIND}, could not find timestamp, or length in in line {line_number-id-1}. Skipping this '{KW_R}' journey")
-                                break
-
-                            logger.debug(f"[GNB] Found '{KW_PDCPIND}', '{pibufp}', and '{snp}' in line {line_number-id-1}, len:{len_value}, timestamp: {timestamp}")
-                            journey[KW_PDCPIND] = {
-                                'timestamp' : timestamp,
-                                'length' : len_value,
-                            }
-                            found_KW_PDCP = True
-                            break
+                    found = self.index.latest(KW_PDCPIND, (pibuf_value, sn_value))
+                    if found is None:
+                        logger.warning(f"[GNB] Could not find '{KW_PDCPIND}', '{pibufp}', or '{snp}' in {depth} lines before {line_number}.")
+                    else:
+                        seq, pdcpind = found
+                        if pdcpind is None:
+                            logger.warning(f"[GNB] For {KW_PDCPIND}, could not find timestamp, or length in in line {line_number-(self.index.seq-seq)}.")
+                        else:
+                            logger.debug(f"[GNB] Found '{KW_PDCPIND}', '{pibufp}', and '{snp}' in line {line_number-(self.index.seq-seq)}, len:{pdcpind['length']}, timestamp: {pdcpind['timestamp']}")
+                            put(journey, KW_PDCPIND, pdcpind)
 
-                    if not found_KW_PDCP:
-                        logger.warning(f"[GNB] Could not find '{KW_PDCPIND}', '{pibufp}', or '{entnop}' in {len(prev_lines)} lines before {line_number}. Skipping this '{KW_R}' journey")
-                        continue
-                    
                     # check for KW_RLC
-                    RLC_ARR = []
+                    segments = 0
                     lengths = []
-                    for id,prev_line in enumerate(prev_lines):
-                        if ('--'+KW_RLC in prev_line) and (snp in prev_line):
-                            timestamp_match = re.search(r'^(\d+\.\d+)', prev_line)
-                            len_match = re.search(r'len(\d+)', prev_line)
-                            mrbuf_match = re.search(r'MRbuf(\d+)\.', prev_line)
-                            if len_match and timestamp_match and mrbuf_match:
-                                timestamp = float(timestamp_match.group(1))
-                                len_value = int(len_match.group(1))
-                                mrbuf_value = mrbuf_match.group(1)
-                            else:
-                                logger.warning(f"[GNB] For {KW_RLC}, could not find timestamp, length, or MRBuf in in line {line_number-id-1}. Skipping this '{KW_R}' journey")
-                                break
-
-                            logger.debug(f"[GNB] Found '{KW_RLC}' and '{snp}' in line {line_number-id-1}, len:{len_value}, timestamp: {timestamp}, MRBuf:{mrbuf_value}")
-                            lengths.append(len_value)
-                            rlc_reass_dict = {
-                                'MRbuf': mrbuf_value,
-                                'timestamp' : timestamp,
-                                'length' : len_value,
-                            }
-
-                            # Check RLC_decoded for each RLC_reassembeled
-                            mrbufstr = 'MRbuf'+mrbuf_value
-                            found_RLC_DC = False
-                            for jd,prev_ljne in enumerate(prev_lines):
-                                if ('--'+KW_RLC_DC in prev_ljne) and (mrbufstr in prev_ljne):
-                                    timestamp_match = re.search(r'^(\d+\.\d+)', prev_ljne)
-                                    len_match = re.search(r'len(\d+)', prev_ljne)
-                                    fm_match = re.search(r'fm(\d+)', prev_ljne)
-                                    sl_match = re.search(r'sl(\d+)', prev_ljne)
-                                    lcid_match = re.search(r'lcid(\d+)', prev_ljne)
-                                    hqpid_match = re.search(r'hqpid(\d+)', prev_ljne)
-                                    if len_match and timestamp_match and fm_match and sl_match and lcid_match and hqpid_match:
-                                        timestamp = float(timestamp_match.group(1))
-                                        len_value = int(len_match.group(1))
-                                        fm_value = int(fm_match.group(1))
-                                        sl_value = int(sl_match.group(1))
-                                        lcid_value = int(lcid_match.group(1))
-                                        hqpid_value = int(hqpid_match.group(1))
-                                    else:
-                                        logger.warning(f"[GNB] For {KW_RLC_DC}, could not find properties in line {line_number-jd-1}. Skipping this '{KW_R}' journey")
-                                        break
-
-                                    logger.debug(f"[GNB] Found '{KW_RLC_DC}' and '{mrbufstr}' in line {line_number-jd-1}, len:{len_value}, timestamp: {timestamp}, harq pid: {hqpid_value}")
-
-                                    rlc_decode_dict = {
-                                        'lcid': lcid_value,
-                                        'hqpid': hqpid_value,
-                                        'frame': fm_value,
-                                        'slot': sl_value,
-                                        'timestamp' : timestamp,
-                                        'length' : len_value,
-                                    }
-                                    found_RLC_DC = True
-                                    break
-
-                            if not found_RLC_DC:
-                                logger.warning(f"[GNB] Could not find '{KW_RLC_DC}' and '{mrbufstr}' in {len(prev_lines)} lines before {line_number}. Skipping this '{KW_R}' journey")
-                                continue
-
-                            # Check MAC_demuxed for each RLC_decoded
-                            frstr = 'fm' + str(fm_value)
-                            slstr = 'sl' + str(sl_value)
-                            hqstr = 'hqpid' + str(hqpid_value)
-                            found_MAC_DEM = False
-                            for jd,prev_ljne in enumerate(prev_lines):
-                                if ('--'+KW_MAC_DEM in prev_ljne) and (frstr in prev_ljne) and (slstr in prev_ljne) and (hqstr in prev_ljne):
-                                    timestamp_match = re.search(r'^(\d+\.\d+)', prev_ljne)
-                                    len_match = re.search(r'len(\d+)', prev_ljne)
-                                    ldpc_match = re.search(r'ldpciter(\d+)', prev_ljne)
-                                    mcs_match = re.search(r'mcs(\d+)', prev_ljne)
-                                    hq_match = re.search(r'hqround(\d+)', prev_ljne)
-                                    if len_match and timestamp_match and ldpc_match and mcs_match and hq_match:
-                                        timestamp = float(timestamp_match.group(1))
-                                        len_value = int(len_match.group(1))
-                                        ldpc_value = int(ldpc_match.group(1))
-                                        mcs_value = int(mcs_match.group(1))
-                                        hq_value = int(hq_match.group(1))
-                                    else:
-                                        logger.warning(f"[GNB] For {KW_MAC_DEM}, could not find properties in line {line_number-jd-1}. Skipping this '{KW_R}' journey")
-                                        break
-
-                                    logger.debug(f"[GNB] Found '{KW_MAC_DEM}', '{frstr}', '{slstr}', and '{hqstr}' in line {line_number-jd-1}, len:{len_value}, timestamp: {timestamp}, harq attempts: {hq_value+1}")
-
-                                    found_MAC_DEM = True
-                                    break
-
-                            if not found_MAC_DEM:
-                                logger.warning(f"[GNB] Could not find '{KW_MAC_DEM}', '{frstr}', '{slstr}', and '{hqstr}' in {len(prev_lines)} lines before {line_number}. Skipping this '{KW_R}' journey")
-                                continue
-
-                            mac_demuxed_dict = {
-                                'frame':fm_value,
-                                'slot':sl_value,
-                                'ldpciter': ldpc_value,
-                                'mcs': mcs_value,
-                                'hqpid': hqpid_value,
-                                'hqround': hq_value,
-                                'timestamp' : timestamp,
-                                'length' : len_value,
-                                KW_MAC_DEC : find_MAC_DEC(hqpid_value,hq_value,prev_lines,line_number),
-                            }
-
-                            RLC_ARR.append(
-                                {
-                                    KW_RLC : rlc_reass_dict,
-                                    KW_RLC_DC : rlc_decode_dict,
-                                    KW_MAC_DEM : mac_demuxed_dict
-                                }
-                            )
-                            if sum(lengths) >= journey[KW_PDCP]['length']:
-                                break
-                    
-                    journey[KW_RLC] = RLC_ARR
-                    
+                    for seq, rlc_reass in self.index.newest_first(KW_RLC, sn_value):
+                        if rlc_reass is None:
+                            logger.warning(f"[GNB] For {KW_RLC}, could not find timestamp, length, or MRBuf in in line {line_number-(self.index.seq-seq)}. Skipping this '{KW_R}' journey")
+                            break
+
+                        mrbuf_value = rlc_reass['MRbuf']
+                        logger.debug(f"[GNB] Found '{KW_RLC}' and '{snp}' in line {line_number-(self.index.seq-seq)}, len:{rlc_reass['length']}, timestamp: {rlc_reass['timestamp']}, MRBuf:{mrbuf_value}")
+                        lengths.append(rlc_reass['length'])
+
+                        # Check RLC_decoded for each RLC_reassembeled
+                        mrbufstr = 'MRbuf'+mrbuf_value
+                        found = self.index.latest(KW_RLC_DC, mrbuf_value)
+                        rlc_dc = None
+                        if found is not None:
+                            seq, rlc_dc = found
+                            if rlc_dc is None:
+                                logger.warning(f"[GNB] For {KW_RLC_DC}, could not find properties in line {line_number-(self.index.seq-seq)}. Skipping this '{KW_R}' journey")
+
+                        if rlc_dc is None:
+                            logger.warning(f"[GNB] Could not find '{KW_RLC_DC}' and '{mrbufstr}' in {depth} lines before {line_number}. Skipping this '{KW_R}' journey")
+                            continue
+
+                        logger.debug(f"[GNB] Found '{KW_RLC_DC}' and '{mrbufstr}' in line {line_number-(self.index.seq-seq)}, len:{rlc_dc['length']}, timestamp: {rlc_dc['timestamp']}, harq pid: {rlc_dc['hqpid']}")
+                        fm_value = rlc_dc['frame']
+                        sl_value = rlc_dc['slot']
+                        hqpid_value = rlc_dc['hqpid']
+
+                        # Check MAC_demuxed for each RLC_decoded
+                        frstr = 'fm' + str(fm_value)
+                        slstr = 'sl' + str(sl_value)
+                        hqstr = 'hqpid' + str(hqpid_value)
+                        found = self.index.latest(KW_MAC_DEM, (fm_value, sl_value, hqpid_value))
+                        mac_dem = None
+                        if found is not None:
+                            seq, mac_dem = found
+                            if mac_dem is None:
+                                logger.warning(f"[GNB] For {KW_MAC_DEM}, could not find properties in line {line_number-(self.index.seq-seq)}. Skipping this '{KW_R}' journey")
+
+                        if mac_dem is None:
+                            logger.warning(f"[GNB] Could not find '{KW_MAC_DEM}', '{frstr}', '{slstr}', and '{hqstr}' in {depth} lines before {line_number}. Skipping this '{KW_R}' journey")
+                            continue
+
+                        hq_value = mac_dem['hqround']
+                        logger.debug(f"[GNB] Found '{KW_MAC_DEM}', '{frstr}', '{slstr}', and '{hqstr}' in line {line_number-(self.index.seq-seq)}, len:{mac_dem['length']}, timestamp: {mac_dem['timestamp']}, harq attempts: {hq_value+1}")
+
+                        mac_demuxed_dict = {
+                            'frame':fm_value,
+                            'slot':sl_value,
+                            'ldpciter': mac_dem['ldpciter'],
+                            'mcs': mac_dem['mcs'],
+                            'hqpid': hqpid_value,
+                            'hqround': hq_value,
+                            'timestamp' : mac_dem['timestamp'],
+                            'length' : mac_dem['length'],
+                        }
+
+                        # segment fields under 'rlc.reassembled.{segment}.'
+                        prefix = f'{KW_RLC}.{segments}'
+                        put(journey, f'{prefix}.{KW_RLC}', rlc_reass)
+                        put(journey, f'{prefix}.{KW_RLC_DC}', rlc_dc)
+                        put(journey, f'{prefix}.{KW_MAC_DEM}', mac_demuxed_dict)
+                        for hqround, mac_dec in enumerate(find_MAC_DEC(hqpid_value,hq_value,self.index,line_number)):
+                            put(journey, f'{prefix}.{KW_MAC_DEM}.{KW_MAC_DEC}.{hqround}', mac_dec)
+                        segments = segments+1
+                        if sum(lengths) >= pdcp['length']:
+                            break
+
                     # result
                     journeys.append(journey)
                     ip_packets_counter = ip_packets_counter+1
@@ -343,4 +314,4 @@ class ProcessULGNB:
             logger.debug(f"[GNB] '{KW_R}' no more in the file.")
 
         logger.info(f"[GNB] Found {ip_packets_counter} ip packets.")
-        return journeys
+        return GNB_SCHEMA.batch(journeys)
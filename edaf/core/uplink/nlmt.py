@@ -1,32 +1,96 @@
-def process_ul_nlmt(lines):
-    # lines = lines.splitlines()
-    # Find the index of the line containing [CloseConn]
-    close_conn_index = None
-    for i, line in enumerate(lines):
-        if '[CloseConn]' in line:
-            close_conn_index = i
-            break
+import sys, json
+from loguru import logger
 
-    # If [CloseConn] is not found, return an empty list
-    if close_conn_index is not None:
-        filteredlines = lines[0:close_conn_index]
-    else:
-        filteredlines = lines
+import os
+if not os.getenv('DEBUG'):
+    logger.remove()
+    logger.add(sys.stdout, level="INFO")
 
-    parsed_logs = []
-    source_ip = None
-    # Process the lines after [CloseConn]
-    for line in filteredlines:
-        # Separate the line by white space
-        line_parts = line.split()
-        source_ip = line_parts[0][1:-1]
-
-        # Create a dictionary for each line
-        log_dict = {"source": source_ip}
-        for part in line_parts[1:]:
-            key, value = part.split('=')
-            log_dict[key] = value
+NLMT_READ_SIZE = 1 << 20 # characters
 
+def process_ul_nlmt(lines):
+    # One entry per line, lines come in batches. [CloseConn] lines carry no packet and
+    # lines that do not parse are skipped, the rest of the batch is kept
+    parsed_logs = []
+    for line in lines:
+        if '[CloseConn]' in line:
+            continue
+        log_dict = parse_nlmt_line(line)
+        if log_dict is None:
+            logger.warning(f"[UPF] unusual nlmt line: {line}")
+            continue
         parsed_logs.append(log_dict)
 
     return parsed_logs
+
+def parse_nlmt_line(line):
+    # '[10.0.0.1] seq=1 st=... rt=...' -> {"source": "10.0.0.1", "seq": "1", ...}, None if it does not parse
+    # Separate the line by white space
+    line_parts = line.split()
+    if len(line_parts) < 2:
+        return None
+    source_ip = line_parts[0][1:-1]
+
+    # Create a dictionary for each line
+    log_dict = {"source": source_ip}
+    for part in line_parts[1:]:
+        key_value = part.split('=')
+        if len(key_value) != 2:
+            return None
+        log_dict[key_value[0]] = key_value[1]
+    return log_dict
+
+def iter_nlmt_trips(file, key='oneway_trips', read_size=NLMT_READ_SIZE):
+    # yields the entries of the `key` array of an nlmt json file one at a time,
+    # only a read_size window of the file is kept in memory
+    decoder = json.JSONDecoder()
+    marker = f'"{key}"'
+    buffer = ''
+    pos = 0
+
+    def skip(chars):
+        # move pos past chars, reading more of the file if needed. False at the end of the file
+        nonlocal buffer, pos
+        while True:
+            while pos < len(buffer) and buffer[pos] in chars:
+                pos = pos + 1
+            if pos < len(buffer):
+                return True
+            chunk = file.read(read_size)
+            if not chunk:
+                return False
+            buffer, pos = chunk, 0
+
+    # find the array
+    while True:
+        chunk = file.read(read_size)
+        if not chunk:
+            return
+        buffer = buffer + chunk
+        found = buffer.find(marker)
+        if found >= 0:
+            pos = found + len(marker)
+            break
+        buffer = buffer[-len(marker):]
+
+    for expected in (':', '['):
+        if not skip(' \t\r\n') or buffer[pos] != expected:
+            raise ValueError(f"'{key}' in the nlmt file is not a json array")
+        pos = pos + 1
+
+    while True:
+        if not skip(' \t\r\n,'):
+            raise ValueError(f"'{key}' array in the nlmt file is not terminated")
+        if buffer[pos] == ']':
+            return
+        try:
+            entry, end = decoder.raw_decode(buffer, pos)
+        except json.JSONDecodeError:
+            # the entry continues in the next chunk
+            chunk = file.read(read_size)
+            if not chunk:
+                raise
+            buffer, pos = buffer[pos:] + chunk, 0
+            continue
+        yield entry
+        pos = end
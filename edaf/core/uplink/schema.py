@@ -0,0 +1,331 @@
+import sys
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+from loguru import logger
+
+import os
+if not os.getenv('DEBUG'):
+    logger.remove()
+    logger.add(sys.stdout, level="INFO")
+
+# fixed slots of the combined uplink journeys
+MAX_SEGMENTS = 20
+MAX_HQROUND = 5
+
+# column types, pandas dtype and arrow type. The integer fields are kept as floats
+# in pandas, NaN where a journey does not have them, so the columns of a type stay
+# in one block. The arrow types are the ones they are written with, see JourneySchema.table
+TIMESTAMP = (np.dtype(np.float64), pa.float64())
+SMALL_INT = (np.dtype(np.float32), pa.int16())    # frame, slot, mcs, harq, ...
+INT = (np.dtype(np.float64), pa.int32())          # lengths, sizes
+SEQNO = (np.dtype(np.float64), pa.int64())        # sequence numbers
+BUFFER = (np.dtype(np.float64), pa.int64())       # buffer addresses
+STRING = (np.dtype(object), pa.string())
+
+NLMT_FIELDS = [
+    ('seqno', *SEQNO),
+    ('send.timestamp', *TIMESTAMP),
+    ('receive.timestamp', *TIMESTAMP),
+]
+
+# ue journey, see ProcessULUE
+UE_FIELDS = [
+    ('ip.in.timestamp', *TIMESTAMP),
+    ('ip.in.length', *INT),
+    ('ip.in.PBuf', *BUFFER),
+    ('pdcp.cipher.timestamp', *TIMESTAMP),
+    ('pdcp.cipher.length', *INT),
+    ('pdcp.cipher.PCBuf', *BUFFER),
+    ('pdcp.pdu.timestamp', *TIMESTAMP),
+    ('pdcp.pdu.length', *INT),
+    ('pdcp.pdu.R1buf', *BUFFER),
+    ('rlc.queue.timestamp', *TIMESTAMP),
+    ('rlc.queue.length', *INT),
+    ('rlc.queue.R2buf', *BUFFER),
+    ('rlc.queue.queue', *INT),
+    ('rlc.queue.sn', *SEQNO),
+]
+# under 'rlc.queue.segments.{seg}.'
+UE_SEGMENT_FIELDS = [
+    ('rlc.txpdu.M1buf', *BUFFER),
+    ('rlc.txpdu.sn', *SEQNO),
+    ('rlc.txpdu.srn', *SEQNO),
+    ('rlc.txpdu.tbs', *INT),
+    ('rlc.txpdu.timestamp', *TIMESTAMP),
+    ('rlc.txpdu.length', *INT),
+    ('rlc.txpdu.leno', *INT),
+    ('rlc.txpdu.ENTno', *INT),
+    ('mac.sdu.lcid', *SMALL_INT),
+    ('mac.sdu.tbs', *INT),
+    ('mac.sdu.frame', *SMALL_INT),
+    ('mac.sdu.slot', *SMALL_INT),
+    ('mac.sdu.timestamp', *TIMESTAMP),
+    ('mac.sdu.length', *INT),
+    ('mac.sdu.M2buf', *BUFFER),
+    ('mac.harq.hqpid', *SMALL_INT),
+    ('mac.harq.frame', *SMALL_INT),
+    ('mac.harq.slot', *SMALL_INT),
+    ('mac.harq.timestamp', *TIMESTAMP),
+    ('mac.harq.length', *INT),
+    ('mac.harq.M3buf', *BUFFER),
+    ('mac.harq.Hbuf', *BUFFER),
+    ('phy.tx.hqpid', *SMALL_INT),
+    ('phy.tx.frame', *SMALL_INT),
+    ('phy.tx.slot', *SMALL_INT),
+    ('phy.tx.timestamp', *TIMESTAMP),
+    ('phy.tx.length', *INT),
+    ('phy.tx.mod_or', *SMALL_INT),
+    ('phy.tx.nb_sym', *SMALL_INT),
+    ('phy.tx.nb_rb', *SMALL_INT),
+    ('phy.tx.rnti', *STRING),
+]
+
+# gnb journey, see ProcessULGNB
+GNB_FIELDS = [
+    ('gtp.out.timestamp', *TIMESTAMP),
+    ('gtp.out.length', *INT),
+    ('gtp.out.SBuf', *STRING),
+    ('gtp.out.sn', *SEQNO),
+    ('sdap.sdu.timestamp', *TIMESTAMP),
+    ('sdap.sdu.length', *INT),
+    ('sdap.sdu.PBuf', *STRING),
+    ('pdcp.decoded.timestamp', *TIMESTAMP),
+    ('pdcp.decoded.length', *INT),
+    ('pdcp.decoded.PIBuf', *STRING),
+    ('pdcp.ind.timestamp', *TIMESTAMP),
+    ('pdcp.ind.length', *INT),
+]
+# under 'rlc.reassembled.{seg}.'
+GNB_SEGMENT_FIELDS = [
+    ('rlc.reassembled.MRbuf', *STRING),
+    ('rlc.reassembled.timestamp', *TIMESTAMP),
+    ('rlc.reassembled.length', *INT),
+    ('rlc.decoded.lcid', *SMALL_INT),
+    ('rlc.decoded.hqpid', *SMALL_INT),
+    ('rlc.decoded.frame', *SMALL_INT),
+    ('rlc.decoded.slot', *SMALL_INT),
+    ('rlc.decoded.timestamp', *TIMESTAMP),
+    ('rlc.decoded.length', *INT),
+    ('mac.demuxed.frame', *SMALL_INT),
+    ('mac.demuxed.slot', *SMALL_INT),
+    ('mac.demuxed.ldpciter', *SMALL_INT),
+    ('mac.demuxed.mcs', *SMALL_INT),
+    ('mac.demuxed.hqpid', *SMALL_INT),
+    ('mac.demuxed.hqround', *SMALL_INT),
+    ('mac.demuxed.timestamp', *TIMESTAMP),
+    ('mac.demuxed.length', *INT),
+]
+# under 'rlc.reassembled.{seg}.mac.demuxed.mac.decoded.{hqround}.'
+GNB_HQROUND_FIELDS = [
+    ('timestamp', *TIMESTAMP),
+    ('frame', *SMALL_INT),
+    ('slot', *SMALL_INT),
+    ('hqpid', *SMALL_INT),
+    ('hqround', *SMALL_INT),
+]
+
+def ue_fields():
+    fields = list(UE_FIELDS)
+    for seg in range(MAX_SEGMENTS):
+        fields.extend((f'rlc.queue.segments.{seg}.{name}', dtype, arrow) for name, dtype, arrow in UE_SEGMENT_FIELDS)
+    return fields
+
+def gnb_fields():
+    fields = list(GNB_FIELDS)
+    for seg in range(MAX_SEGMENTS):
+        fields.extend((f'rlc.reassembled.{seg}.{name}', dtype, arrow) for name, dtype, arrow in GNB_SEGMENT_FIELDS)
+        for hqround in range(MAX_HQROUND):
+            prefix = f'rlc.reassembled.{seg}.mac.demuxed.mac.decoded.{hqround}'
+            fields.extend((f'{prefix}.{name}', dtype, arrow) for name, dtype, arrow in GNB_HQROUND_FIELDS)
+    return fields
+
+def put(row, prefix, entry):
+    # adds the fields of entry to a flat journey row, under prefix
+    for key, value in entry.items():
+        row[f'{prefix}.{key}'] = value
+
+# schemas by name, batches are pickled with the name of their schema
+SCHEMAS = {}
+
+class JourneySchema:
+    # Declared columns of the combined journeys, so every batch has the same
+    # columns and dtypes, whatever the number of segments and harq rounds in it.
+    def __init__(self, name, fields):
+        self.name = name
+        self.names = [name for name, _, _ in fields]
+        self.arrow = pa.schema([pa.field(name, arrow) for name, _, arrow in fields])
+        # integer fields, held as floats in the frames
+        self.integers = {name for name, _, arrow in fields if pa.types.is_integer(arrow)}
+        # the columns are filled in one 2d array per dtype
+        self.dtypes = list(dict.fromkeys(dtype for _, dtype, _ in fields))
+        self.blocks = [[name for name, dtype, _ in fields if dtype == block] for block in self.dtypes]
+        self.positions = {
+            name : (block, i)
+            for block, names in enumerate(self.blocks)
+            for i, name in enumerate(names)
+        }
+        SCHEMAS[name] = self
+
+    def __len__(self):
+        return len(self.names)
+
+    def __contains__(self, name):
+        return name in self.positions
+
+    def empty(self, n):
+        return [
+            np.full((n, len(names)), None if dtype == object else np.nan, dtype=dtype)
+            for dtype, names in zip(self.dtypes, self.blocks)
+        ]
+
+    def batch(self, rows):
+        # batch of flat journey rows, {'gtp.out.sn' : 5, ...}. Keys outside the
+        # schema, segments or harq rounds beyond the slots, are dropped.
+        blocks = self.empty(len(rows))
+        dropped = set()
+        for i, row in enumerate(rows):
+            for key, value in row.items():
+                position = self.positions.get(key)
+                if position is None:
+                    dropped.add(key)
+                elif value is not None:
+                    blocks[position[0]][i, position[1]] = value
+        if dropped:
+            logger.warning(f"{len(dropped)} journey fields are not in the {self.name} schema, dropped: {sorted(dropped)[:5]}")
+        return JourneyBatch(self, blocks)
+
+    def frame(self, rows, index=None):
+        # dataframe of flat journey rows
+        return self.batch(rows).frame(index)
+
+    def stack(self, rows):
+        # batch of rows taken from other batches of this schema, see JourneyBatch.row
+        if len(rows) == 0:
+            return JourneyBatch(self, self.empty(0))
+        return JourneyBatch(self, [np.stack(block) for block in zip(*rows)])
+
+    def concat(self, batches):
+        if len(batches) == 0:
+            return JourneyBatch(self, self.empty(0))
+        return JourneyBatch(self, [np.concatenate(blocks) for blocks in zip(*(batch.blocks for batch in batches))])
+
+    def join(self, batches):
+        # batch of this schema from batches of schemas that make it up side by side,
+        # e.g. the nlmt, ue and gnb batches of the same journeys
+        n = len(batches[0])
+        blocks = []
+        for dtype in self.dtypes:
+            parts = [
+                batch.blocks[batch.schema.dtypes.index(dtype)]
+                for batch in batches if dtype in batch.schema.dtypes
+            ]
+            blocks.append(np.hstack(parts) if parts else np.empty((n, 0), dtype=dtype))
+        return JourneyBatch(self, blocks)
+
+    def from_buffers(self, parts):
+        # batch of the flat arrays of JourneyBatch.buffers, e.g. views of shared memory.
+        # The values are copied into the batch, the parts can be released after
+        header = np.frombuffer(parts[0], dtype=np.int64)
+        n = int(header[0])
+        widths = iter(header[1+len(self.dtypes):].tolist())
+        parts = iter(parts[1:])
+        blocks = self.empty(n)
+        for block, k in zip(blocks, header[1:1+len(self.dtypes)].tolist()):
+            used = np.frombuffer(next(parts), dtype=np.int64)
+            if block.dtype == object:
+                mask = np.frombuffer(next(parts), dtype=bool).reshape(n, k)
+                values = np.frombuffer(next(parts), dtype=f'<U{next(widths)}').reshape(n, k).astype(object)
+                values[~mask] = None
+            else:
+                values = np.frombuffer(next(parts), dtype=block.dtype).reshape(n, k)
+            block[:, used] = values
+        return JourneyBatch(self, blocks)
+
+    def value(self, name, value):
+        # a field value as it should be written out, integer fields as ints
+        if name in self.integers and value == value:
+            return int(value)
+        return value
+
+    def table(self, df):
+        # arrow table of df, the schema columns cast to their declared types
+        table = pa.Table.from_pandas(df, preserve_index=False).replace_schema_metadata(None)
+        fields = [self.arrow.field(name) if name in self else field for name, field in zip(table.column_names, table.schema)]
+        columns = [column.cast(field.type) for column, field in zip(table.columns, fields)]
+        return pa.Table.from_arrays(columns, schema=pa.schema(fields))
+
+def load_batch(name, n, columns, values):
+    schema = SCHEMAS[name]
+    blocks = schema.empty(n)
+    for block, used, used_values in zip(blocks, columns, values):
+        block[:, used] = used_values
+    return JourneyBatch(schema, blocks)
+
+class JourneyBatch:
+    # Journeys in the columns of a schema, one journeys x columns array per dtype.
+    # Missing fields are NaN (None for strings). It pickles as these few arrays,
+    # so a batch of journeys crosses process boundaries in bulk. Only the columns
+    # in use are pickled, most segment and harq round slots are empty.
+    def __init__(self, schema, blocks):
+        self.schema = schema
+        self.blocks = blocks
+
+    def __reduce__(self):
+        columns = self.used()
+        values = [block[:, used] for block, used in zip(self.blocks, columns)]
+        return (load_batch, (self.schema.name, len(self), columns, values))
+
+    def used(self):
+        # indices of the columns with values, per block
+        return [
+            np.flatnonzero((block != None).any(axis=0) if block.dtype == object else (~np.isnan(block)).any(axis=0))
+            for block in self.blocks
+        ]
+
+    def buffers(self):
+        # the batch as a few flat arrays of fixed layout, no pickling, see JourneySchema.from_buffers.
+        # A header with the number of rows and used columns per block, then for each block
+        # the used column indices and their values. Strings go as fixed width unicode with a mask.
+        columns = self.used()
+        header = [len(self)] + [len(used) for used in columns]
+        parts = []
+        for block, used in zip(self.blocks, columns):
+            values = block[:, used]
+            if block.dtype == object:
+                mask = values != None
+                values = np.where(mask, values, '').astype(str)
+                header.append(values.dtype.itemsize // 4)
+                parts.extend([used, mask, values])
+            else:
+                parts.extend([used, values])
+        return [np.array(header, dtype=np.int64)] + parts
+
+    def __len__(self):
+        return len(self.blocks[0])
+
+    def __getitem__(self, rows):
+        # rows: slice, index array or boolean mask
+        return JourneyBatch(self.schema, [block[rows] for block in self.blocks])
+
+    def column(self, name):
+        block, i = self.schema.positions[name]
+        return self.blocks[block][:, i]
+
+    def row(self, i):
+        # one journey as views of the blocks, see JourneySchema.stack
+        return tuple(block[i] for block in self.blocks)
+
+    def frame(self, index=None):
+        df = pd.concat([
+            pd.DataFrame(values, columns=names, copy=False)
+            for values, names in zip(self.blocks, self.schema.blocks)
+        ], axis=1)[self.schema.names]
+        if index is not None:
+            df.index = index
+        return df
+
+NLMT_SCHEMA = JourneySchema('NLMT', NLMT_FIELDS)
+UE_SCHEMA = JourneySchema('UE', ue_fields())
+GNB_SCHEMA = JourneySchema('GNB', gnb_fields())
+UL_SCHEMA = JourneySchema('UL', NLMT_FIELDS + ue_fields() + gnb_fields())
@@ -1,28 +1,14 @@
 import sys
-import re
 from loguru import logger
-from collections import deque
+
+from edaf.core.common.index import WindowIndex
+from edaf.core.uplink.schema import UE_SCHEMA, put
 
 import os
 if not os.getenv('DEBUG'):
     logger.remove()
     logger.add(sys.stdout, level="INFO")
 
-class RingBuffer:
-    def __init__(self, size):
-        self.size = size
-        self.buffer = deque(maxlen=size)
-
-    def append(self, item):
-        self.buffer.append(item)
-
-    def get_items(self):
-        return list(self.buffer)
-    
-    def reverse_items(self):
-        return list(reversed(self.buffer))
-
-
 KW_R = 'ip.in'    # first, find the lines including this, then read 'PbufXXXXXX'.
 
 # go back a few lines, find the first line that includes
@@ -45,351 +31,315 @@ KW_MAC_3 = 'phy.tx'
 
 MAX_DEPTH = 500
 
+
+# mac.harq lines that miss properties, they stop the search for a harq buffer
+KW_MAC_2_PARTIAL = KW_MAC_2+'.partial'
+
+def index_line(index, record):
+    # store the parsed line under the keys the journeys are joined on
+    f = record.fields
+    event = record.event
+
+    if event == KW_PDCPC:
+        if 'Pbuf' in f:
+            entry = None
+            if 'len' in f and 'PCbuf' in f:
+                entry = {
+                    'timestamp' : record.timestamp,
+                    'length' : f['len'],
+                    'PCBuf' : f['PCbuf']
+                }
+            index.add(KW_PDCPC, f['Pbuf'], entry)
+
+    elif event == KW_PDCP:
+        if 'PCbuf' in f:
+            entry = None
+            if 'len' in f and 'R1buf' in f:
+                entry = {
+                    'timestamp' : record.timestamp,
+                    'length' : f['len'],
+                    'R1buf' : f['R1buf']
+                }
+            index.add(KW_PDCP, f['PCbuf'], entry)
+
+    elif event == KW_RLC:
+        if 'R1buf' in f:
+            entry = None
+            if 'len' in f and 'R2buf' in f and 'queue' in f and 'sn' in f:
+                entry = {
+                    'timestamp' : record.timestamp,
+                    'length' : f['len'],
+                    'R2buf' : f['R2buf'],
+                    'queue' : f['queue'],
+                    'sn' : f['sn'],
+                }
+            index.add(KW_RLC, f['R1buf'], entry)
+
+    elif event == KW_RLC_TX:
+        if 'R2buf' in f and 'sn' in f:
+            entry = None
+            if 'len' in f and 'leno' in f and 'tbs' in f and 'M1buf' in f and 'ENTno' in f and 'srn' in f:
+                entry = {
+                    'M1buf' : f['M1buf'],
+                    'sn' : f['sn'],
+                    'srn' : f['srn'],
+                    'tbs' : f['tbs'],
+                    'timestamp' : record.timestamp,
+                    'length' : f['len'],
+                    'leno' : f['leno'],
+                    'ENTno' : f['ENTno'],
+                }
+            index.add(KW_RLC_TX, (f['R2buf'], f['sn']), entry)
+
+    elif event == KW_MAC_1:
+        if 'M1buf' in f and 'ENTno' in f:
+            entry = None
+            if 'len' in f and 'fm' in f and 'sl' in f and 'lcid' in f and 'tbs' in f and 'M2buf' in f:
+                entry = {
+                    'lcid': f['lcid'],
+                    'tbs': f['tbs'],
+                    'frame': f['fm'],
+                    'slot': f['sl'],
+                    'timestamp' : record.timestamp,
+                    'length' : f['len'],
+                    'M2buf' : f['M2buf'],
+                }
+            index.add(KW_MAC_1, (f['M1buf'], f['ENTno']), entry)
+
+    elif event == KW_MAC_2:
+        if 'fm' in f and 'sl' in f:
+            key = (f['fm'], f['sl'])
+            if 'len' in f and 'hqpid' in f and 'M3buf' in f and 'Hbuf' in f:
+                # the harq buffer covers [M3buf : M3buf+M3len]
+                entry = {
+                    'hqpid': f['hqpid'],
+                    'frame': f['fm'],
+                    'slot': f['sl'],
+                    'timestamp' : record.timestamp,
+                    'length' : f['len'],
+                    'M3buf' : f['M3buf'],
+                    'Hbuf' : f['Hbuf'],
+                }
+                index.add_interval(KW_MAC_2, key, f['M3buf'], f['M3buf'] + f['len'], entry)
+            else:
+                index.add(KW_MAC_2_PARTIAL, key, None)
+
+    elif event == KW_MAC_3:
+        if 'Hbuf' in f:
+            entry = None
+            if 'len' in f and 'fm' in f and 'sl' in f and 'hqpid' in f and 'mod_or' in f and 'nb_sym' in f and 'nb_rb' in f and record.rnti is not None:
+                entry = {
+                    'hqpid': f['hqpid'],
+                    'frame': f['fm'],
+                    'slot': f['sl'],
+                    'timestamp' : record.timestamp,
+                    'length' : f['len'],
+                    'mod_or' : f['mod_or'],
+                    'nb_sym' : f['nb_sym'],
+                    'nb_rb' : f['nb_rb'],
+                    'rnti' : record.rnti,
+                }
+            index.add(KW_MAC_3, f['Hbuf'], entry)
+
 #def sort_key(line):
 #    return float(line.split()[0])
 
+class LookaheadULUE:
+    # Runs ProcessULUE over records that arrive in time order, a chunk at a time. UE lines
+    # are processed backwards, so a chunk needs the lines that follow it: the newest
+    # lookahead records are held back and primed as the lookback of the chunk before
+    # them, as offline_edaf.run_ue_chunk does. flush processes the held records without.
+    # A chunk is processed once it has min_chunk records, so priming the lookahead costs
+    # at most as much as the chunk itself.
+    def __init__(self, lookahead=MAX_DEPTH, min_chunk=MAX_DEPTH):
+        self.lookahead = lookahead
+        self.min_chunk = min_chunk
+        self.pending = []
+
+    def __len__(self):
+        return len(self.pending)
+
+    def run(self, records):
+        self.pending.extend(records)
+        split = len(self.pending) - self.lookahead
+        if split <= 0 or split < self.min_chunk:
+            return []
+        chunk = self.pending[:split]
+        self.pending = self.pending[split:]
+        return self.process(chunk, self.pending)
+
+    def flush(self):
+        chunk = self.pending
+        self.pending = []
+        return self.process(chunk, [])
+
+    def process(self, chunk, lookahead):
+        if len(chunk) == 0:
+            return []
+        proc = ProcessULUE()
+        proc.prime(reversed(lookahead))
+        return proc.run(chunk[::-1])[::-1]
+
 class ProcessULUE:
     def __init__(self):
-        self.previous_lines = RingBuffer(MAX_DEPTH)
-
-    def run(self, lines):
-        # we sort in the rdt process instead
-        #lines = sorted(unsortedlines, key=sort_key, reverse=False)
+        # lookback window over the previous lines, indexed by join keys
+        self.index = WindowIndex(MAX_DEPTH)
+
+    def lookup(self, name, key, line_number):
+        # newest complete entry under key and the line it was found in
+        found = self.index.latest(name, key)
+        if found is None:
+            return None, None
+        seq, entry = found
+        return entry, line_number-(self.index.seq-seq)
+
+    def prime(self, records):
+        # index records as lookback context only, no journeys start from them
+        for record in records:
+            self.index.advance()
+            index_line(self.index, record)
+
+    def run(self, records):
+        # records are parsed lseq lines with their timestamps converted, see rdtsctotsOnline.return_records.
+        # They are passed in reverse order, so the lookback window holds the events after each 'ip.in'.
 
         journeys = []
         ip_packets_counter = 0
-        for line_number, line in enumerate(lines):
-            self.previous_lines.append(line)
+        for line_number, record in enumerate(records):
+            self.index.advance()
+            index_line(self.index, record)
             #set_exit = False
-            if KW_R in line:
-                line = line.replace('\n', '')
-                
-                # Use regular expressions to extract the numbers
-                timestamp_match = re.search(r'^(\d+\.\d+)', line)
-                len_match = re.search(r'len(\d+)', line)
-                pbuf_match = re.search(r'Pbuf(\d+)', line)
-
-                if len_match and pbuf_match and timestamp_match:
+            if record.touches(KW_R):
+                f = record.fields
+                if 'len' in f and 'Pbuf' in f:
 
-                    timestamp = float(timestamp_match.group(1))
-                    len_value = int(len_match.group(1))
-                    pbuf_value = int(pbuf_match.group(1))
+                    timestamp = record.timestamp
+                    len_value = f['len']
+                    pbuf_value = f['Pbuf']
 
                     logger.debug(f"[UE] Found '{KW_R}' in line {line_number}, len:{len_value}, PBuf: {pbuf_value}, ts: {timestamp}")
 
+                    # flat journey row, see schema.UE_FIELDS
                     journey = {
-                        KW_R : {
-                            'timestamp' : timestamp,
-                            'length' : len_value,
-                            'PBuf' : pbuf_value
-                        }
+                        f'{KW_R}.timestamp' : timestamp,
+                        f'{KW_R}.length' : len_value,
+                        f'{KW_R}.PBuf' : pbuf_value,
                     }
                     pbufp = f"Pbuf{pbuf_value}"
-
-                    # lets go back in lines
-                    prev_lines = self.previous_lines.reverse_items()
+                    depth = len(self.index)
 
                     # check for KW_PDCPC
-                    found_KW_PDCPC = False
-                    for id,prev_line in enumerate(prev_lines):
-                        if ("--"+KW_PDCPC in prev_line) and (pbufp in prev_line):
-                            timestamp_match = re.search(r'^(\d+\.\d+)', prev_line)
-                            len_match = re.search(r'len(\d+)', prev_line)
-                            pcbuf_match = re.search(r'PCbuf(\d+)', prev_line)
-                            if len_match and pcbuf_match and timestamp_match:
-                                timestamp = float(timestamp_match.group(1))
-                                len_value = int(len_match.group(1))
-                                pcbuf_value = int(pcbuf_match.group(1))
-                            else:
-                                logger.warning(f"[UE] For {KW_PDCPC}, could not found timestamp or length in line {line_number-id-1}. Skipping this '{KW_R}' journey")
-                                break
-
-                            logger.debug(f"[UE] Found '{KW_PDCPC}' and '{pbufp}' in line {line_number-id-1}, len:{len_value}, timestamp: {timestamp}, PCbuf: {pcbuf_value}")
-                            journey[KW_PDCPC] = {
-                                'timestamp' : timestamp,
-                                'length' : len_value,
-                                'PCBuf' : pcbuf_value
-                            }
-                            pcbufp = f"PCbuf{pcbuf_value}"
-                            found_KW_PDCPC = True
-                            break
-
-                    if not found_KW_PDCPC:
-                        logger.warning(f"[UE] Could not find '{KW_PDCPC}' and '{pbufp}' in {len(prev_lines)} lines before {line_number}. Skipping this '{KW_R}' journey")
+                    pdcpc, found_line = self.lookup(KW_PDCPC, pbuf_value, line_number)
+                    if pdcpc is None:
+                        if found_line is not None:
+                            logger.warning(f"[UE] For {KW_PDCPC}, could not found timestamp or length in line {found_line}. Skipping this '{KW_R}' journey")
+                        logger.warning(f"[UE] Could not find '{KW_PDCPC}' and '{pbufp}' in {depth} lines before {line_number}. Skipping this '{KW_R}' journey")
                         continue
 
+                    logger.debug(f"[UE] Found '{KW_PDCPC}' and '{pbufp}' in line {found_line}, len:{pdcpc['length']}, timestamp: {pdcpc['timestamp']}, PCbuf: {pdcpc['PCBuf']}")
+                    put(journey, KW_PDCPC, pdcpc)
+                    pcbufp = f"PCbuf{pdcpc['PCBuf']}"
+
                     # check for KW_PDCP
-                    found_KW_PDCP = False
-                    for id,prev_line in enumerate(prev_lines):
-                        if ("--"+KW_PDCP in prev_line) and (pcbufp in prev_line):
-                            timestamp_match = re.search(r'^(\d+\.\d+)', prev_line)
-                            len_match = re.search(r'len(\d+)', prev_line)
-                            r1buf_match = re.search(r'R1buf(\d+)', prev_line)
-                            if len_match and timestamp_match and r1buf_match:
-                                timestamp = float(timestamp_match.group(1))
-                                len_value = int(len_match.group(1))
-                                r1buf_value = int(r1buf_match.group(1))
-                            else:
-                                logger.warning(f"[UE] For {KW_PDCP}, could not found timestamp or length in in line {line_number-id-1}. Skipping this '{KW_R}' journey")
-                                break
-
-                            logger.debug(f"[UE] Found '{KW_PDCP}' and '{pcbufp}' in line {line_number-id-1}, len:{len_value}, timestamp: {timestamp}")
-                            journey[KW_PDCP] = {
-                                'timestamp' : timestamp,
-                                'length' : len_value,
-                                'R1buf' : r1buf_value
-                            }
-                            r1bufp = f"R1buf{r1buf_value}"
-                            found_KW_PDCP = True
-                            break
-                    
-                    if not found_KW_PDCP:
-                        logger.warning(f"[UE] Could not find '{KW_PDCP}' and '{pcbufp}' in {len(prev_lines)} lines before {line_number}. Skipping this '{KW_R}' journey")
+                    pdcp, found_line = self.lookup(KW_PDCP, pdcpc['PCBuf'], line_number)
+                    if pdcp is None:
+                        if found_line is not None:
+                            logger.warning(f"[UE] For {KW_PDCP}, could not found timestamp or length in in line {found_line}. Skipping this '{KW_R}' journey")
+                        logger.warning(f"[UE] Could not find '{KW_PDCP}' and '{pcbufp}' in {depth} lines before {line_number}. Skipping this '{KW_R}' journey")
                         continue
 
+                    logger.debug(f"[UE] Found '{KW_PDCP}' and '{pcbufp}' in line {found_line}, len:{pdcp['length']}, timestamp: {pdcp['timestamp']}")
+                    put(journey, KW_PDCP, pdcp)
+                    r1bufp = f"R1buf{pdcp['R1buf']}"
 
                     # check for KW_RLC
-                    found_KW_RLC = False
-                    for id,prev_line in enumerate(prev_lines):
-                        if ("--"+KW_RLC in prev_line) and (r1bufp in prev_line):
-                            timestamp_match = re.search(r'^(\d+\.\d+)', prev_line)
-                            len_match = re.search(r'len(\d+)', prev_line)
-                            r2buf_match = re.search(r'R2buf(\d+)', prev_line)
-                            sn_match = re.search(r'sn(\d+)', prev_line)
-                            q_match = re.search(r'queue(\d+)', prev_line)
-                            if len_match and timestamp_match and r2buf_match and q_match and sn_match:
-                                timestamp = float(timestamp_match.group(1))
-                                len_value = int(len_match.group(1))
-                                r2buf_value = int(r2buf_match.group(1))
-                                queue_value = int(q_match.group(1))
-                                sn_value = int(sn_match.group(1))
-                            else:
-                                logger.warning(f"For {KW_RLC}, could not found timestamp or length in in line {line_number-id-1}. Skipping this '{KW_R}' journey")
-                                break
-
-                            logger.debug(f"[UE] Found '{KW_RLC}' and '{r1bufp}' in line {line_number-id-1}, len:{len_value}, sn:{sn_value}, timestamp: {timestamp}")
-                            journey[KW_RLC] = {
-                                'timestamp' : timestamp,
-                                'length' : len_value,
-                                'R2buf' : r2buf_value,
-                                'queue' : queue_value,
-                                'sn' : sn_value,
-                                'segments' : {},
-                            }
-                            r2bufp = f"R2buf{r2buf_value}"
-                            snp = f"sn{sn_value}"
-                            found_KW_RLC = True
-                            break
-                    
-                    if not found_KW_RLC:
-                        logger.warning(f"[UE] Could not find '{KW_RLC}' and '{r1bufp}' in {len(prev_lines)} lines before {line_number}. Skipping this '{KW_R}' journey")
+                    rlc, found_line = self.lookup(KW_RLC, pdcp['R1buf'], line_number)
+                    if rlc is None:
+                        if found_line is not None:
+                            logger.warning(f"For {KW_RLC}, could not found timestamp or length in in line {found_line}. Skipping this '{KW_R}' journey")
+                        logger.warning(f"[UE] Could not find '{KW_RLC}' and '{r1bufp}' in {depth} lines before {line_number}. Skipping this '{KW_R}' journey")
                         continue
 
-                    
+                    logger.debug(f"[UE] Found '{KW_RLC}' and '{r1bufp}' in line {found_line}, len:{rlc['length']}, sn:{rlc['sn']}, timestamp: {rlc['timestamp']}")
+                    put(journey, KW_RLC, rlc)
+                    r2buf_value = rlc['R2buf']
+                    sn_value = rlc['sn']
+                    r2bufp = f"R2buf{r2buf_value}"
+                    snp = f"sn{sn_value}"
+
                     # check for KW_RLC_TX
-                    RLC_ARR = []
+                    segments = 0
                     lengths = []
-                    for id,prev_line in enumerate(prev_lines):
-                        if ("--"+KW_RLC_TX in prev_line) and (r2bufp in prev_line) and (snp in prev_line):
-                            timestamp_match = re.search(r'^(\d+\.\d+)', prev_line)
-                            len_match = re.search(r'len(\d+)', prev_line)
-                            leno_match = re.search(r'leno(\d+)', prev_line)
-                            tbs_match = re.search(r'tbs(\d+)\.', prev_line)
-                            sn_match = re.search(r'sn(\d+)\.', prev_line)
-                            srn_match = re.search(r'srn(\d+)\.', prev_line)
-                            m1buf_match = re.search(r'M1buf(\d+)\.', prev_line)
-                            ent_match = re.search(r'ENTno(\d+)', prev_line)
-                            if len_match and timestamp_match and tbs_match and sn_match and m1buf_match and ent_match and srn_match:
-                                timestamp = float(timestamp_match.group(1))
-                                len_value = int(len_match.group(1))
-                                leno_value = int(leno_match.group(1))
-                                tbs_value = int(tbs_match.group(1))
-                                sn_value = int(sn_match.group(1))
-                                srn_value = int(srn_match.group(1))
-                                m1buf_value = int(m1buf_match.group(1))
-                                ent_value = int(ent_match.group(1))
-                            else:
-                                logger.warning(f"[UE] For {KW_RLC_TX}, could not found timestamp, length, M1buf, or ENTno in in line {line_number-id-1}. Skipping this '{KW_R}' journey")
-                                break
-
-                            logger.debug(f"[UE] Found '{KW_RLC_TX}' and '{r2bufp}' in line {line_number-id-1}, len:{len_value}, timestamp: {timestamp}, Mbuf:{m1buf_value}, sn: {sn_value}, srn: {srn_value}, tbs: {tbs_value}, ENTno: {ent_value}")
-                            #lengths.append(len_value)
-                            lengths.append(leno_value)
-                            rlc_tx_reass_dict = {
-                                'M1buf' : m1buf_value,
-                                'sn' : sn_value,
-                                'srn' : srn_value,
-                                'tbs' : tbs_value,
-                                'timestamp' : timestamp,
-                                'length' : len_value,
-                                'leno' : leno_value,
-                                'ENTno' : ent_value,
-                            }
-                            m1bufp = f"M1buf{m1buf_value}"
-                            entnop = f"ENTno{ent_value}"
+                    for seq, rlc_tx in self.index.newest_first(KW_RLC_TX, (r2buf_value, sn_value)):
+                        if rlc_tx is None:
+                            logger.warning(f"[UE] For {KW_RLC_TX}, could not found timestamp, length, M1buf, or ENTno in in line {line_number-(self.index.seq-seq)}. Skipping this '{KW_R}' journey")
+                            break
 
-                            # Check RLC_decoded for each RLC_reassembeled
-                            found_MAC_1 = False
-                            for jd,prev_ljne in enumerate(prev_lines):
-                                if ("--"+KW_MAC_1 in prev_ljne) and (m1bufp in prev_ljne) and (entnop in prev_ljne):
-                                    timestamp_match = re.search(r'^(\d+\.\d+)', prev_ljne)
-                                    len_match = re.search(r'len(\d+)', prev_ljne)
-                                    fm_match = re.search(r'fm(\d+)', prev_ljne)
-                                    sl_match = re.search(r'sl(\d+)', prev_ljne)
-                                    lcid_match = re.search(r'lcid(\d+)', prev_ljne)
-                                    tbs_match = re.search(r'tbs(\d+)', prev_ljne)
-                                    m2buf_match = re.search(r'M2buf(\d+)', prev_ljne)
-                                    if len_match and timestamp_match and fm_match and sl_match and lcid_match and tbs_match and m2buf_match:
-                                        timestamp = float(timestamp_match.group(1))
-                                        len_value = int(len_match.group(1))
-                                        fm_value = int(fm_match.group(1))
-                                        sl_value = int(sl_match.group(1))
-                                        lcid_value = int(lcid_match.group(1))
-                                        tbs_value = int(tbs_match.group(1))
-                                        m2buf_value = int(m2buf_match.group(1))
-                                    else:
-                                        logger.warning(f"[UE] For {KW_MAC_1}, could not find properties in line {line_number-jd-1}. Skipping this '{KW_R}' journey")
-                                        break
-
-                                    logger.debug(f"[UE] Found '{KW_MAC_1}' and '{m1bufp}' in line {line_number-jd-1}, len:{len_value}, timestamp: {timestamp}, frame: {fm_value}, slot: {sl_value}")
-
-                                    mac_1_dict = {
-                                        'lcid': lcid_value,
-                                        'tbs': tbs_value,
-                                        'frame': fm_value,
-                                        'slot': sl_value,
-                                        'timestamp' : timestamp,
-                                        'length' : len_value,
-                                        'M2buf' : m2buf_value,
-                                    }
-
-                                    # NOTE: M3buf should not necessarily be equal to M2buf. 
-                                    # It is important that [M2buf: M2buf+M2len] be inside [M3buf : M3buf+M3len].
-                                    m2len = len_value
-                                    frmp = f"fm{fm_value}"
-                                    slp = f"sl{sl_value}"
-                                    found_MAC_1 = True
-                                    break
-
-                            if not found_MAC_1:
-                                logger.warning(f"[UE] Could not find '{KW_MAC_1}' and '{m1bufp}' in {len(prev_lines)} lines before {line_number}. Skipping this '{KW_R}' journey")
-                                continue
+                        logger.debug(f"[UE] Found '{KW_RLC_TX}' and '{r2bufp}' in line {line_number-(self.index.seq-seq)}, len:{rlc_tx['length']}, timestamp: {rlc_tx['timestamp']}, Mbuf:{rlc_tx['M1buf']}, sn: {rlc_tx['sn']}, srn: {rlc_tx['srn']}, tbs: {rlc_tx['tbs']}, ENTno: {rlc_tx['ENTno']}")
+                        #lengths.append(len_value)
+                        lengths.append(rlc_tx['leno'])
+                        m1bufp = f"M1buf{rlc_tx['M1buf']}"
+
+                        # Check RLC_decoded for each RLC_reassembeled
+                        mac_1, found_line = self.lookup(KW_MAC_1, (rlc_tx['M1buf'], rlc_tx['ENTno']), line_number)
+                        if mac_1 is None:
+                            if found_line is not None:
+                                logger.warning(f"[UE] For {KW_MAC_1}, could not find properties in line {found_line}. Skipping this '{KW_R}' journey")
+                            logger.warning(f"[UE] Could not find '{KW_MAC_1}' and '{m1bufp}' in {depth} lines before {line_number}. Skipping this '{KW_R}' journey")
+                            continue
+
+                        logger.debug(f"[UE] Found '{KW_MAC_1}' and '{m1bufp}' in line {found_line}, len:{mac_1['length']}, timestamp: {mac_1['timestamp']}, frame: {mac_1['frame']}, slot: {mac_1['slot']}")
+
+                        # NOTE: M3buf should not necessarily be equal to M2buf.
+                        # It is important that [M2buf: M2buf+M2len] be inside [M3buf : M3buf+M3len].
+                        m2buf_value = mac_1['M2buf']
+                        m2len = mac_1['length']
+                        frmp = f"fm{mac_1['frame']}"
+                        slp = f"sl{mac_1['slot']}"
+
+                        # Check RLC_decoded for each RLC_reassembeled
+                        # this is harq that can carry other drbs data
+                        key = (mac_1['frame'], mac_1['slot'])
+                        found = self.index.containing(KW_MAC_2, key, m2buf_value, m2buf_value + m2len)
+                        partial = self.index.latest(KW_MAC_2_PARTIAL, key)
+                        if partial is not None and (found is None or partial[0] > found[0]):
+                            logger.warning(f"[UE] For {KW_MAC_2}, could not find properties in line {line_number-(self.index.seq-partial[0])}. Skipping this '{KW_R}' journey")
+                            found = None
+
+                        if found is None:
+                            logger.warning(f"[UE] Could not find '{KW_MAC_2}', '{frmp}', or '{slp}' in {depth} lines before {line_number} where [M2buf: M2buf+M2len] was inside [M3buf : M3buf+M3len]. MAC dicts of '{KW_R}' journey set empty.")
+                            mac_2 = {}
+                            mac_3 = {}
+                        else:
+                            seq, mac_2 = found
+                            logger.debug(f"[UE] Found '{KW_MAC_2}', '{frmp}', and '{slp}' in a line where [M2buf: M2buf+M2len] was inside [M3buf : M3buf+M3len] {line_number-(self.index.seq-seq)}, len:{mac_2['length']}, timestamp: {mac_2['timestamp']}, frame: {mac_2['frame']}, slot: {mac_2['slot']}")
+                            hbufp = f"Hbuf{mac_2['Hbuf']}"
 
                             # Check RLC_decoded for each RLC_reassembeled
-                            found_MAC_2 = False
-                            for jd,prev_ljne in enumerate(prev_lines):
-                                if ("--"+KW_MAC_2 in prev_ljne) and (frmp in prev_ljne) and (slp in prev_ljne):
-                                    timestamp_match = re.search(r'^(\d+\.\d+)', prev_ljne)
-                                    len_match = re.search(r'len(\d+)', prev_ljne)
-                                    fm_match = re.search(r'fm(\d+)', prev_ljne)
-                                    sl_match = re.search(r'sl(\d+)', prev_ljne)
-                                    hqpid_match = re.search(r'hqpid(\d+)', prev_ljne)
-                                    m3buf_match = re.search(r'M3buf(\d+)', prev_ljne)
-                                    hbuf_match = re.search(r'Hbuf(\d+)', prev_ljne)
-                                    if len_match and timestamp_match and fm_match and sl_match and hqpid_match and m3buf_match and hbuf_match:
-                                        timestamp = float(timestamp_match.group(1))
-                                        len_value = int(len_match.group(1))
-                                        fm_value = int(fm_match.group(1))
-                                        sl_value = int(sl_match.group(1))
-                                        hqpid_value = int(hqpid_match.group(1))
-                                        m3buf_value = int(m3buf_match.group(1))
-                                        hbuf_value = int(hbuf_match.group(1))
-                                    else:
-                                        logger.warning(f"[UE] For {KW_MAC_2}, could not find properties in line {line_number-jd-1}. Skipping this '{KW_R}' journey")
-                                        break
-
-                                    # important check: only [M2buf: M2buf+M2len] must be inside [M3buf : M3buf+M3len]
-                                    # this is harq that can carry other drbs data
-                                    m3len = len_value
-                                    isInside = (m2buf_value >= m3buf_value) and ((m2buf_value + m2len) <= (m3buf_value + m3len))
-                                    if (isInside):
-                                        logger.debug(f"[UE] Found '{KW_MAC_2}', '{frmp}', and '{slp}' in a line where [M2buf: M2buf+M2len] was inside [M3buf : M3buf+M3len] {line_number-jd-1}, len:{len_value}, timestamp: {timestamp}, frame: {fm_value}, slot: {sl_value}")
-
-                                        mac_2_dict = {
-                                            'hqpid': hqpid_value,
-                                            'frame': fm_value,
-                                            'slot': sl_value,
-                                            'timestamp' : timestamp,
-                                            'length' : len_value,
-                                            'M3buf' : m3buf_value,
-                                            'Hbuf' : hbuf_value,
-                                        }
-                                        hbufp = f"Hbuf{hbuf_value}"
-                                        found_MAC_2 = True
-                                        break
-
-                            if not found_MAC_2:
-                                logger.warning(f"[UE] Could not find '{KW_MAC_2}', '{frmp}', or '{slp}' in {len(prev_lines)} lines before {line_number} where [M2buf: M2buf+M2len] was inside [M3buf : M3buf+M3len]. MAC dicts of '{KW_R}' journey set empty.")
-                                mac_2_dict = {}
-                                mac_3_dict = {}
+                            mac_3, found_line = self.lookup(KW_MAC_3, mac_2['Hbuf'], line_number)
+                            if mac_3 is None:
+                                if found_line is not None:
+                                    logger.warning(f"[UE] For {KW_MAC_3}, could not find properties in line {found_line}. Skipping this '{KW_R}' journey")
+                                logger.warning(f"[UE] Could not find '{KW_MAC_3}' and '{hbufp}' in {depth} lines before {line_number}. Mac dicts 3 of '{KW_R}' journey set empty.")
+                                mac_3 = {}
                             else:
-                                # Check RLC_decoded for each RLC_reassembeled
-                                found_MAC_3 = False
-                                for jd,prev_ljne in enumerate(prev_lines):
-                                    if ("--"+KW_MAC_3 in prev_ljne) and (hbufp in prev_ljne):
-                                        timestamp_match = re.search(r'^(\d+\.\d+)', prev_ljne)
-                                        len_match = re.search(r'len(\d+)', prev_ljne)
-                                        fm_match = re.search(r'fm(\d+)', prev_ljne)
-                                        sl_match = re.search(r'sl(\d+)', prev_ljne)
-                                        hqpid_match = re.search(r'hqpid(\d+)', prev_ljne)
-                                        mod_or_match = re.search(r'mod_or(\d+)', prev_ljne)
-                                        nb_sym_match = re.search(r'nb_sym(\d+)', prev_ljne)
-                                        nb_rb_match = re.search(r'nb_rb(\d+)', prev_ljne)
-                                        rnti_match = re.search(r'rnti([0-9a-fA-F]+)', prev_ljne)
-                                        if len_match and timestamp_match and fm_match and sl_match and hqpid_match and mod_or_match and nb_sym_match and nb_rb_match and rnti_match:
-                                            timestamp = float(timestamp_match.group(1))
-                                            len_value = int(len_match.group(1))
-                                            fm_value = int(fm_match.group(1))
-                                            sl_value = int(sl_match.group(1))
-                                            hqpid_value = int(hqpid_match.group(1))
-                                            mod_or_value = int(mod_or_match.group(1))
-                                            nb_sym_value = int(nb_sym_match.group(1))
-                                            nb_rb_value = int(nb_rb_match.group(1))
-                                            rnti_value = rnti_match.group(1)
-                                        else:
-                                            logger.warning(f"[UE] For {KW_MAC_3}, could not find properties in line {line_number-jd-1}. Skipping this '{KW_R}' journey")
-                                            break
-    
-                                        logger.debug(f"[UE] Found '{KW_MAC_3}' and '{hbufp}' in line {line_number-jd-1}, len:{len_value}, timestamp: {timestamp}, frame: {fm_value}, slot: {sl_value}")
-    
-                                        mac_3_dict = {
-                                            'hqpid': hqpid_value,
-                                            'frame': fm_value,
-                                            'slot': sl_value,
-                                            'timestamp' : timestamp,
-                                            'length' : len_value,
-                                            'mod_or' : mod_or_value,
-                                            'nb_sym' : nb_sym_value,
-                                            'nb_rb' : nb_rb_value,
-                                            'rnti' : rnti_value,
-                                        }
-                                        found_MAC_3 = True
-                                        break
-    
-                                if not found_MAC_3:
-                                    logger.warning(f"[UE] Could not find '{KW_MAC_3}' and '{hbufp}' in {len(prev_lines)} lines before {line_number}. Mac dicts 3 of '{KW_R}' journey set empty.")
-                                    mac_3_dict = {}
-
-                            RLC_ARR.append(
-                                {
-                                    KW_RLC_TX : rlc_tx_reass_dict,
-                                    KW_MAC_1 : mac_1_dict,
-                                    KW_MAC_2 : mac_2_dict,
-                                    KW_MAC_3 : mac_3_dict
-                                }
-                            )
-                            if sum(lengths) >= journey[KW_RLC]['length']:
-                                logger.debug(f"[UE] segments lengths parsed: {lengths}, total length: {journey[KW_RLC]['length']}, breaking segments search.")
-                                break
-
-                    if len(RLC_ARR) == 0:
-                        logger.warning(f"[UE] Could not find any segments! no '{KW_RLC_TX}', '{r2bufp}', or '{snp}' in {len(prev_lines)} lines before {line_number}. Skipping this '{KW_R}' journey")
-                        journey[KW_RLC]['segments'] = []
-                    else:
-                        if sum(lengths) != journey[KW_RLC]['length']:
-                            logger.warning(f"[UE] Sum of the segements' lengths: {lengths}, is not equal to the packet length: {journey[KW_RLC]['length']}")
-
-                        journey[KW_RLC]['segments'] = RLC_ARR
+                                logger.debug(f"[UE] Found '{KW_MAC_3}' and '{hbufp}' in line {found_line}, len:{mac_3['length']}, timestamp: {mac_3['timestamp']}, frame: {mac_3['frame']}, slot: {mac_3['slot']}")
+
+                        # segment fields under 'rlc.queue.segments.{segment}.'
+                        prefix = f'{KW_RLC}.segments.{segments}'
+                        put(journey, f'{prefix}.{KW_RLC_TX}', rlc_tx)
+                        put(journey, f'{prefix}.{KW_MAC_1}', mac_1)
+                        put(journey, f'{prefix}.{KW_MAC_2}', mac_2)
+                        put(journey, f'{prefix}.{KW_MAC_3}', mac_3)
+                        segments = segments+1
+                        if sum(lengths) >= rlc['length']:
+                            logger.debug(f"[UE] segments lengths parsed: {lengths}, total length: {rlc['length']}, breaking segments search.")
+                            break
+
+                    if segments == 0:
+                        logger.warning(f"[UE] Could not find any segments! no '{KW_RLC_TX}', '{r2bufp}', or '{snp}' in {depth} lines before {line_number}. Skipping this '{KW_R}' journey")
+                    elif sum(lengths) != rlc['length']:
+                        logger.warning(f"[UE] Sum of the segements' lengths: {lengths}, is not equal to the packet length: {rlc['length']}")
 
                     # result
                     journeys.append(journey)
@@ -406,4 +356,4 @@ class ProcessULUE:
             logger.debug(f"[UE] '{KW_R}' no more in the file.")
 
         logger.info(f"[UE] Found {ip_packets_counter} ip packets.")
-        return journeys
+        return UE_SCHEMA.batch(journeys)
@@ -1,20 +1,38 @@
-import os, sys, gzip, json
+import os, sys, gzip, math
 from pathlib import Path
+from itertools import islice
+from bisect import bisect_left, bisect_right
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
 from loguru import logger
 from collections import deque
 import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from edaf.core.common.lseq import tokenize
 from edaf.core.common.timestamp import rdtsctotsOnline
-from edaf.core.uplink.gnb import ProcessULGNB
-from edaf.core.uplink.ue import ProcessULUE
-from edaf.core.uplink.nlmt import process_ul_nlmt
-from edaf.core.uplink.combine import CombineUL
-from edaf.core.uplink.decompose import process_ul_journeys
+from edaf.core.common.reorder import ReorderBuffer
+from edaf.core.uplink.gnb import ProcessULGNB, KW_R as GNB_KW_R, MAX_DEPTH as GNB_MAX_DEPTH
+from edaf.core.uplink.ue import ProcessULUE, KW_R as UE_KW_R, MAX_DEPTH as UE_MAX_DEPTH
+from edaf.core.uplink.nlmt import iter_nlmt_trips
+from edaf.core.uplink.combine import TimeJoinUL
+from edaf.core.uplink.schema import UL_SCHEMA, UE_SCHEMA, GNB_SCHEMA
+from edaf.core.uplink.decompose import process_ul_journeys, new_drops
     
 if not os.getenv('DEBUG'):
     logger.remove()
     logger.add(sys.stdout, level="INFO")
 
-NUM_POP = 10000
+# combined journeys decomposed and written at once
+NUM_POP = int(os.getenv('NUM_POP', 10000))
+# lseq lines read and converted at once
+CHUNK_LINES = int(os.getenv('CHUNK_LINES', 100000))
+# worker processes, 1 runs everything in this process
+WORKERS = int(os.getenv('WORKERS', os.cpu_count() or 1))
+# duration of the gnb and ue shards given to the workers
+SHARD_SECONDS = float(os.getenv('SHARD_SECONDS', 60))
+# lines read before and after each shard, has to cover the correlation lookback (MAX_DEPTH lines)
+OVERLAP_MARGIN_SECONDS = float(os.getenv('OVERLAP_MARGIN_SECONDS', 1))
 
 # in case you have offline parquet journey files, you can use this script to decompose delay
 # pass the address of a folder in argv with the following structure:
@@ -51,6 +69,211 @@ class RingBuffer:
     def get_length(self):
         return len(self.buffer)
 
+def scan_sync_lines(lseq_file):
+    # (byte offset, line) of every clock sync 'S' line of an lseq file
+    sync_lines = []
+    offset = 0
+    with open(lseq_file, 'rb') as file:
+        for line in file:
+            if b' S ' in line:
+                sync_lines.append((offset, line.decode()))
+            offset = offset + len(line)
+    return sync_lines
+
+def read_lines(lseq_file, start=0, end=None):
+    # yields the lines from byte offset start up to end, CHUNK_LINES lines at a time
+    with open(lseq_file, 'rb') as file:
+        file.seek(start)
+        offset = start
+        lines = []
+        for line in file:
+            if end is not None and offset >= end:
+                break
+            offset = offset + len(line)
+            lines.append(line.decode())
+            if len(lines) == CHUNK_LINES:
+                yield lines
+                lines = []
+        if len(lines) > 0:
+            yield lines
+
+def read_records(lseq_file, rdts, start=0, end=None):
+    # yields the converted records of an lseq file in time order, CHUNK_LINES lines at a time.
+    # rdts is calibrated from all the sync lines of the file first, as if it was converted at once
+    reorder = ReorderBuffer()
+    for lines in read_lines(lseq_file, start, end):
+        reorder.push(rdts.return_records(lines, sort=False))
+        records = reorder.pop_ready()
+        if len(records) > 0:
+            yield records
+    records = reorder.flush()
+    if len(records) > 0:
+        yield records
+    if reorder.late > 0:
+        logger.warning(f"{rdts.name} lseq had {reorder.late} lines out of order by more than {reorder.slack_ns} ns")
+
+def gnb_journeys(chunks):
+    proc = ProcessULGNB()
+    for records in chunks:
+        yield proc.run(records)
+
+def run_ue_chunk(chunk, lookahead):
+    # UE lines are processed backwards, so a chunk needs the lines that follow it as lookback context
+    proc = ProcessULUE()
+    proc.prime(reversed(lookahead))
+    return proc.run(chunk[::-1])[::-1]
+
+def ue_journeys(chunks):
+    pending = []
+    for records in chunks:
+        pending.extend(records)
+        while len(pending) >= CHUNK_LINES + UE_MAX_DEPTH:
+            yield run_ue_chunk(pending[:CHUNK_LINES], pending[CHUNK_LINES:CHUNK_LINES+UE_MAX_DEPTH])
+            pending = pending[CHUNK_LINES:]
+    if len(pending) > 0:
+        yield run_ue_chunk(pending, [])
+
+JOURNEYS = {
+    'GNB' : (gnb_journeys, GNB_KW_R, GNB_MAX_DEPTH, GNB_SCHEMA),
+    'UE' : (ue_journeys, UE_KW_R, UE_MAX_DEPTH, UE_SCHEMA),
+}
+
+def calibrate(name, sync_lines):
+    rdts = rdtsctotsOnline(name, window=None)
+    rdts.calibrate(line for _, line in sync_lines)
+    logger.info(f"{name} clock: {rdts.metrics()}")
+    return rdts
+
+def plan_shards(rdts, sync_lines):
+    # Splits an lseq file into time shards of SHARD_SECONDS, cut at sync lines.
+    # A shard owns the journeys that start in [owned_from, owned_to) and reads
+    # OVERLAP_MARGIN_SECONDS more on both sides, so the journeys it owns see the
+    # same lookback lines as in a serial run.
+    # returns (start byte, end byte, owned_from, owned_to) tuples, times in seconds
+    if len(sync_lines) < 2 or not rdts.clock.ready():
+        return [(0, None, -math.inf, math.inf)]
+    offsets = [offset for offset, _ in sync_lines]
+    cycles = np.array([tokenize(line).cycles for _, line in sync_lines], dtype=np.int64)
+    times = (rdts.clock.to_ns(cycles)/1.0e9).tolist()
+    shards = []
+    owned_from, first = -math.inf, 0
+    boundary = times[0] + SHARD_SECONDS
+    for i, time in enumerate(times):
+        if time >= boundary and i > first:
+            shards.append((owned_from, first, time, i))
+            owned_from, first = time, i
+            boundary = time + SHARD_SECONDS
+    shards.append((owned_from, first, math.inf, None))
+
+    plan = []
+    for owned_from, first, owned_to, last in shards:
+        start = bisect_right(times, owned_from - OVERLAP_MARGIN_SECONDS) - 1
+        end = bisect_left(times, owned_to + OVERLAP_MARGIN_SECONDS)
+        plan.append((
+            offsets[start] if first > 0 and start > 0 else 0,
+            offsets[end] if last is not None and end < len(offsets) else None,
+            owned_from,
+            owned_to
+        ))
+    return plan
+
+def shard_journeys(name, lseq_file, rdts, shard):
+    # runs in a worker process, returns the batch of journeys the shard owns in order
+    start, end, owned_from, owned_to = shard
+    journeys_fn, kw_r, max_depth, schema = JOURNEYS[name]
+    margins = [0, 0]
+
+    def count_margins(chunks):
+        for records in chunks:
+            for record in records:
+                if record.timestamp < owned_from:
+                    margins[0] = margins[0] + 1
+                elif record.timestamp >= owned_to:
+                    margins[1] = margins[1] + 1
+            yield records
+
+    owned = []
+    for journeys in journeys_fn(count_margins(read_records(lseq_file, rdts, start, end))):
+        timestamps = journeys.column(f'{kw_r}.timestamp')
+        owned.append(journeys[(timestamps >= owned_from) & (timestamps < owned_to)])
+    owned = schema.concat(owned)
+
+    for margin, bound, cut in zip(margins, (owned_from, owned_to), (start > 0, end is not None)):
+        if cut and margin < max_depth:
+            logger.warning(f"{name} shard at {bound} has {margin} lines of overlap, less than the {max_depth} lines lookback. Increase OVERLAP_MARGIN_SECONDS.")
+    logger.info(f"{name} shard [{owned_from}, {owned_to}): {len(owned)} trips")
+    return owned
+
+def ordered_results(executor, fn, args_list, ahead):
+    # submits fn(*args) for all args, at most `ahead` at a time, and yields the results in order
+    futures = deque()
+    for args in args_list:
+        futures.append(executor.submit(fn, *args))
+        if len(futures) >= ahead:
+            yield futures.popleft().result()
+    while futures:
+        yield futures.popleft().result()
+
+def nlmt_journeys(upf_file):
+    with gzip.open(upf_file, 'rt', encoding='utf-8') as file:
+        trips = iter_nlmt_trips(file)
+        while True:
+            batch = list(islice(trips, NUM_POP))
+            if not batch:
+                break
+            yield batch
+
+def joined_batches(join, sources, size):
+    # Feeds the join from the source that is furthest behind in event time, so they advance together,
+    # and yields dataframes of about `size` combined journeys.
+    counts = { name : 0 for name in sources }
+    active = dict(sources)
+    frames, rows = [], 0
+    while active:
+        name = min(active, key=join.watermark)
+        journeys = next(active[name], None)
+        if journeys is None:
+            del active[name]
+            join.finish(name)
+        else:
+            counts[name] = counts[name] + len(journeys)
+            join.push(name, journeys)
+        combined = join.pop_ready()
+        if len(combined) > 0:
+            frames.append(combined)
+            rows = rows + len(combined)
+        if rows >= size or (not active and rows > 0):
+            yield pd.concat(frames, ignore_index=True)
+            frames, rows = [], 0
+    logger.info(f"Loaded {counts['NLMT']} NLMT trips, {counts['GNB']} GNB trips and {counts['UE']} UE trips")
+    logger.info(f"Join: {join.stats}")
+
+class ParquetResult:
+    # The result batches share the journey schema, so they are streamed into one
+    # parquet file, the schema columns with their declared types, see JourneySchema.table
+    def __init__(self, result_parquet_file):
+        self.result_parquet_file = result_parquet_file
+        self.writer = None
+        self.rows = 0
+
+    def write(self, df):
+        if df is None or len(df) == 0:
+            return
+        table = UL_SCHEMA.table(df)
+        if self.writer is None:
+            self.writer = pq.ParquetWriter(self.result_parquet_file, table.schema)
+        elif not table.schema.equals(self.writer.schema):
+            # e.g. a string column that is all null in this batch
+            table = table.select(self.writer.schema.names).cast(self.writer.schema)
+        self.writer.write_table(table)
+        self.rows = self.rows + len(table)
+
+    def close(self):
+        if self.writer is None:
+            pq.write_table(pa.table({}), self.result_parquet_file)
+        else:
+            self.writer.close()
+
 if __name__ == "__main__":
 
     if len(sys.argv) != 3:
@@ -73,62 +296,54 @@ if __name__ == "__main__":
     upf_file = list(upf_path.glob("se_*.json.gz"))[0]
     logger.info(f"found upf json file: {upf_file}")
 
-    gnbrdts = rdtsctotsOnline("GNB")
-    gnbproc = ProcessULGNB()
-    uerdts = rdtsctotsOnline("UE")
-    ueproc = ProcessULUE()
-    combineul = CombineUL(max_depth=NUM_POP)
+    # one pass over each lseq file finds the sync lines, to calibrate and to plan the shards with
+    gnb_sync_lines = scan_sync_lines(gnb_lseq_file)
+    ue_sync_lines = scan_sync_lines(ue_lseq_file)
+    gnb_rdts = calibrate("GNB", gnb_sync_lines)
+    ue_rdts = calibrate("UE", ue_sync_lines)
+    join = TimeJoinUL()
+    result = ParquetResult(result_parquet_file)
 
-    # NLMT
-    with gzip.open(upf_file, 'rt', encoding='utf-8') as file:
-        nlmt_journeys = json.load(file)['oneway_trips']
-    logger.info(f"Loaded {len(nlmt_journeys)} NLMT trips")
-
-    # GNB
-    gnb_lseq_file = open(gnb_lseq_file, 'r')
-    gnb_lines = gnb_lseq_file.readlines()
-    l1linesgnb = gnbrdts.return_rdtsctots(gnb_lines)
-    if len(l1linesgnb) > 0:
-        gnb_journeys = gnbproc.run(l1linesgnb)
-    logger.info(f"Loaded {len(gnb_journeys)} GNB trips")
-
-    # UE
-    ue_lseq_file = open(ue_lseq_file, 'r')
-    ue_lines = ue_lseq_file.readlines()
-    l1linesue = uerdts.return_rdtsctots(ue_lines)
-    l1linesue.reverse()
-    if len(l1linesue) > 0:
-        ue_journeys = ueproc.run(l1linesue)
-    logger.info(f"Loaded {len(ue_journeys)} UE trips")
-    ue_journeys.reverse()
-
-    ind = 0
-    df = pd.DataFrame()
-    while True:
-        if ind+NUM_POP > len(nlmt_journeys) or ind+NUM_POP > len(nlmt_journeys) or ind+NUM_POP > len(nlmt_journeys):
-            # process all the rest
-            df_combined = combineul.run(
-                nlmt_journeys[ind:-1],
-                gnb_journeys[ind:-1],
-                ue_journeys[ind:-1]
-            )
-        else:
-            # process a batch of size NUM_POP
-            df_combined = combineul.run(
-                nlmt_journeys[ind:ind+NUM_POP],
-                gnb_journeys[ind:ind+NUM_POP],
-                ue_journeys[ind:ind+NUM_POP]
-            )
-
-        logger.info(f'Combined len: {len(df_combined)}')
-        df_to_append = process_ul_journeys(df_combined)
-        logger.info(f'Processed len: {len(df_to_append)}')
-        df = pd.concat([df, df_to_append], ignore_index=True)
-        
-        ind += NUM_POP
-        if ind > len(nlmt_journeys) or ind > len(nlmt_journeys) or ind > len(nlmt_journeys):
-            break
-    
-    logger.info(f"Combines logs, created a df with {len(df)} entries.")
-    df.to_parquet(result_parquet_file, engine='pyarrow')
+    if WORKERS > 1:
+        # gnb and ue time shards are correlated, and the combined batches decomposed, in worker processes.
+        # Joining stays serial, so the result is the same as a serial run.
+        executor = ProcessPoolExecutor(WORKERS)
+        gnb_shards = plan_shards(gnb_rdts, gnb_sync_lines)
+        ue_shards = plan_shards(ue_rdts, ue_sync_lines)
+        logger.info(f"Processing {len(gnb_shards)} GNB and {len(ue_shards)} UE shards with {WORKERS} workers")
+        sources = {
+            'NLMT' : nlmt_journeys(upf_file),
+            'GNB' : ordered_results(executor, shard_journeys, [("GNB", gnb_lseq_file, gnb_rdts, shard) for shard in gnb_shards], WORKERS),
+            'UE' : ordered_results(executor, shard_journeys, [("UE", ue_lseq_file, ue_rdts, shard) for shard in ue_shards], WORKERS),
+        }
+        decompose = lambda batches: ordered_results(executor, process_ul_journeys, ((df,) for df in batches), WORKERS)
+    else:
+        # the files are read, correlated, combined and decomposed batch by batch
+        executor = None
+        sources = {
+            'NLMT' : nlmt_journeys(upf_file),
+            'GNB' : gnb_journeys(read_records(gnb_lseq_file, gnb_rdts)),
+            'UE' : ue_journeys(read_records(ue_lseq_file, ue_rdts)),
+        }
+        decompose = lambda batches: map(process_ul_journeys, batches)
+
+    def combined_batches():
+        for df_combined in joined_batches(join, sources, NUM_POP):
+            logger.info(f'Combined len: {len(df_combined)}')
+            yield df_combined
+
+    # packets dropped by the decomposition, per reason
+    dropped = new_drops()
+    try:
+        for df_to_append, drops in decompose(combined_batches()):
+            logger.info(f'Processed len: {len(df_to_append)}')
+            for reason, count in drops.items():
+                dropped[reason] = dropped[reason] + count
+            result.write(df_to_append)
+    finally:
+        if executor is not None:
+            executor.shutdown()
 
+    result.close()
+    logger.info(f"Combines logs, created a df with {result.rows} entries.")
+    logger.info(f"Dropped journeys: {dropped}")